@@ -22,20 +22,69 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import argparse
 import asyncio
+import functools
+import sys
 
 from tfmplugins.network import NetworkScanner
-from tfmplugins.network.drivers.windivert import WinDivertDriver
-from tfmplugins.tfm import TFMConnection, main_ip
+from tfmplugins.tfm import SessionRecorder, TFMClient, TFMConnection, main_ip
+from tfmplugins.utils import metrics
 
 
 if __name__ == '__main__':
-	network = NetworkScanner(WinDivertDriver, TFMConnection)
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--replay", metavar="FILE", help="replay a pcap or pcapng capture")
+	parser.add_argument(
+		"--speed", type=float, default=1.0,
+		help="replay speed: 1 is real time (default) and 0 is as fast as possible"
+	)
+	parser.add_argument(
+		"--driver", choices=("windivert", "afpacket"),
+		default="windivert" if sys.platform == "win32" else "afpacket",
+		help="how to scan the network: WinDivert (Windows) or AF_PACKET (Linux)"
+	)
+	parser.add_argument("--interface", help="the interface to scan with AF_PACKET (default: all)")
+	parser.add_argument("--record", metavar="DIR", help="record every packet in a directory")
+	parser.add_argument("--compress", action="store_true", help="gzip the recorded segments")
+	parser.add_argument(
+		"--metrics-port", type=int, metavar="PORT",
+		help="serve latency metrics in the Prometheus format at http://127.0.0.1:PORT/metrics"
+	)
+	parser.add_argument(
+		"--metrics-interval", type=float, metavar="SECONDS",
+		help="print a latency summary to stderr every SECONDS"
+	)
+	args = parser.parse_args()
+
+	if args.record:
+		TFMConnection.recorder = SessionRecorder(args.record, compress=args.compress)
+
+	if args.metrics_port:
+		metrics.serve(args.metrics_port)
+	if args.metrics_interval:
+		metrics.report(args.metrics_interval)
+
+	if args.replay:
+		from tfmplugins.network.drivers.pcap import PcapDriver, ReplayClock
+		driver = functools.partial(PcapDriver, path=args.replay, clock=ReplayClock(args.speed))
+	elif args.driver == "afpacket":
+		from tfmplugins.network.drivers.afpacket import AFPacketDriver
+		driver = functools.partial(AFPacketDriver, interface=args.interface)
+	else:
+		from tfmplugins.network.drivers.windivert import WinDivertDriver
+		driver = WinDivertDriver
+
+	network = NetworkScanner(driver, TFMConnection)
 	network.add(main_ip)
 	print("Network scanner running.")
 
+	loop = asyncio.get_event_loop()
 	try:
-		asyncio.get_event_loop().run_forever()
+		loop.run_forever()
 	except KeyboardInterrupt:
 		network.stop()
+		loop.run_until_complete(TFMClient.watcher.close())
+		if TFMConnection.recorder is not None:
+			TFMConnection.recorder.close()
 		print("\rBye bye!")
\ No newline at end of file
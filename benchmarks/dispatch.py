@@ -0,0 +1,97 @@
+"""Dispatches events from a thread at a fixed rate (20k/s by default) and
+counts how many times the loop is woken up and how many tasks are created,
+with the batched delivery and with the previous one (a wakeup and a task
+per event).
+
+Usage: python -m benchmarks.dispatch [rate] [seconds]
+"""
+
+import asyncio
+import sys
+import threading
+import time
+
+from tfmplugins.utils import EventBased
+
+
+class Counter(EventBased):
+	def __init__(self, loop):
+		self.loop = loop
+		self.received = 0
+		super().__init__()
+
+	async def on_packet(self, packet):
+		self.received += 1
+
+
+class LegacyCounter(Counter):
+	def dispatch(self, event, *args, **kwargs):
+		"""The dispatch as it was before batching."""
+		method = 'on_' + event
+		coro = getattr(self, method, None)
+		if coro is not None:
+			dispatch = self._run_event(coro, method, *args, **kwargs)
+			return self.loop.call_soon_threadsafe(
+				self.loop.create_task,
+				dispatch
+			)
+
+
+class CountingLoop(asyncio.SelectorEventLoop):
+	def __init__(self):
+		super().__init__()
+		self.wakeups = 0
+		self.tasks = 0
+		self.set_task_factory(self._count_task)
+
+	def _count_task(self, loop, coro, **kwargs):
+		self.tasks += 1
+		return asyncio.Task(coro, loop=loop, **kwargs)
+
+	def _write_to_self(self):
+		self.wakeups += 1
+		super()._write_to_self()
+
+
+def produce(client, rate, seconds):
+	"""Dispatches `rate` events per second, in 1ms bursts."""
+	per_tick = rate // 1000
+	start = time.perf_counter()
+	for tick in range(int(seconds * 1000)):
+		for _ in range(per_tick):
+			client.dispatch("packet", b"")
+
+		delay = start + (tick + 1) / 1000 - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+
+
+def run(factory, rate, seconds):
+	loop = CountingLoop()
+	client = factory(loop)
+
+	async def main():
+		thread = threading.Thread(target=produce, args=(client, rate, seconds))
+		thread.start()
+		await loop.run_in_executor(None, thread.join)
+		while client.received < rate * seconds:
+			await asyncio.sleep(0.01)
+
+	start = time.perf_counter()
+	loop.run_until_complete(main())
+	taken = time.perf_counter() - start
+	loop.close()
+	return client.received / taken, loop.wakeups / taken, loop.tasks / taken
+
+
+def main():
+	rate = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+
+	print("{:>8} {:>12} {:>12} {:>12}".format("mode", "events/s", "wakeups/s", "tasks/s"))
+	for name, factory in (("legacy", LegacyCounter), ("batched", Counter)):
+		print("{:>8} {:>12,.0f} {:>12,.0f} {:>12,.0f}".format(name, *run(factory, rate, seconds)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+"""Compares the packet reader against the previous implementation, which
+popped the length prefix byte by byte and deleted every packet from the
+front of its buffer.
+
+Usage: python -m benchmarks.reader
+"""
+
+import random
+import time
+
+from tfmplugins.tfm.network import TFMPacketReader
+from tfmplugins.tfm.packet import Packet
+
+
+class LegacyPacketReader:
+	"""The packet reader as it was before the offset based one."""
+	def __init__(self, extra):
+		self.extra = extra
+
+		self.buffer = bytearray()
+		self.length = 0
+
+	def consume_payload(self, payload):
+		self.buffer.extend(payload)
+
+		while len(self.buffer) > self.length:
+			if self.length == 0:
+				for i in range(5):
+					byte = self.buffer.pop(0)
+					self.length |= (byte & 0x7f) << (i * 7)
+
+					if not byte & 0x80:
+						break
+
+				else:
+					raise Exception("Malformed TFM packet payload")
+
+				self.length += self.extra
+
+			if len(self.buffer) >= self.length:
+				yield Packet(self.buffer[:self.length])
+				del self.buffer[:self.length]
+				self.length = 0
+
+
+def encode_length(length):
+	prefix = bytearray()
+	while True:
+		byte = length & 0x7f
+		length >>= 7
+		if length:
+			prefix.append(byte | 0x80)
+		else:
+			prefix.append(byte)
+			return prefix
+
+
+def make_burst(size, rng):
+	"""Builds a payload of roughly `size` bytes made of small inbound packets."""
+	burst = bytearray()
+	frames = 0
+	while len(burst) < size:
+		body = bytes(rng.randrange(256) for _ in range(rng.randrange(2, 200)))
+		burst += encode_length(len(body)) + body
+		frames += 1
+	return bytes(burst), frames
+
+
+def run(factory, burst, frames, min_time=0.5):
+	iterations = 0
+	start = time.perf_counter()
+	while True:
+		reader = factory(0)
+		for _ in reader.consume_payload(burst):
+			pass
+
+		iterations += 1
+		taken = time.perf_counter() - start
+		if taken >= min_time:
+			return frames * iterations / taken
+
+
+def main():
+	rng = random.Random(0)
+
+	print("{:>8} {:>8} {:>16} {:>16} {:>8}".format("burst", "frames", "legacy fps", "offset fps", "speedup"))
+	for label, size in (("1 KB", 1 << 10), ("64 KB", 1 << 16), ("1 MB", 1 << 20)):
+		burst, frames = make_burst(size, rng)
+
+		legacy = run(LegacyPacketReader, burst, frames)
+		current = run(TFMPacketReader, burst, frames)
+		print("{:>8} {:>8} {:>16,.0f} {:>16,.0f} {:>7.1f}x".format(
+			label, frames, legacy, current, current / legacy
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,57 @@
+"""Compares decoding a packet with a compiled schema against reading its
+fields one by one with the Packet methods.
+
+Usage: python -m benchmarks.schema
+"""
+
+import time
+
+from tfmplugins.tfm.schema import PacketSchema, registry
+
+
+def at_body(packet):
+	packet.pos = 2
+	return packet
+
+
+def run(function, packet, min_time=0.5):
+	iterations = 0
+	start = time.perf_counter()
+	while True:
+		for _ in range(1000):
+			packet.pos = 2
+			function(packet)
+
+		iterations += 1000
+		taken = time.perf_counter() - start
+		if taken >= min_time:
+			return iterations / taken
+
+
+def main():
+	login = registry.get((26, 2))
+	login_packet = login.encode(id=12345678, name="Tocutoeltuco#0000", played_time=3600, community=5, pid=42)
+
+	def read_login(packet):
+		return (packet.read32(), packet.readUTF(), packet.read32(), packet.read8(), packet.read32())
+
+	fixed = PacketSchema((5, 5), "Fixed", [("field{}".format(i), "32") for i in range(10)])
+	fixed_packet = fixed.encode(*range(10))
+
+	def read_fixed(packet):
+		return tuple(packet.read32() for _ in range(10))
+
+	print("{:>16} {:>16} {:>16} {:>8}".format("packet", "sequential/s", "compiled/s", "speedup"))
+	for name, schema, packet, sequential in (
+		("login (26, 2)", login, login_packet, read_login),
+		("10 x int", fixed, fixed_packet, read_fixed),
+	):
+		assert tuple(schema.decode(at_body(packet))) == sequential(at_body(packet))
+
+		seq = run(sequential, packet)
+		compiled = run(schema.decode, packet)
+		print("{:>16} {:>16,.0f} {:>16,.0f} {:>7.1f}x".format(name, seq, compiled, compiled / seq))
+
+
+if __name__ == '__main__':
+	main()
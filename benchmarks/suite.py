@@ -0,0 +1,274 @@
+"""Runs every throughput benchmark on the traffic of benchmarks.traffic and
+writes the results as JSON, so runs can be compared:
+
+- reader: frames/s framed by TFMPacketReader out of captured TCP payloads
+- packet: Packet reads and writes, and PacketBuilder frames, per second
+- dispatch: events/s delivered by EventBased.dispatch from a driver thread, to a
+  coroutine handler and to a plain function one
+- pipeline: frames/s from a replayed capture (PcapDriver) to a plugin
+
+Usage: python -m benchmarks.suite [--quick] [--seed N] [--output FILE]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.traffic import TrafficGenerator
+from tfmplugins.network import NetworkScanner
+from tfmplugins.network.drivers.pcap import PcapDriver
+from tfmplugins.tfm import PacketBuilder, TFMClient, TFMConnection, main_ip
+from tfmplugins.tfm import packet as packet_module
+from tfmplugins.tfm.network import TFMPacketReader
+from tfmplugins.tfm.packet import Packet
+from tfmplugins.utils import EventBased, PluginRouter, PluginWorker
+
+
+def measure(function, min_time):
+	"""Calls function until min_time has passed.
+	:return: (calls, seconds)
+	"""
+	calls = 0
+	start = time.perf_counter()
+	while True:
+		function()
+		calls += 1
+		taken = time.perf_counter() - start
+		if taken >= min_time:
+			return calls, taken
+
+
+def bench_reader(generator, sessions, packets, min_time):
+	payloads = generator.payloads(sessions, packets)
+	flows = {}
+	for index, server, outbound, payload in payloads:
+		flows.setdefault((index, server, outbound), []).append(payload)
+	frames = sessions * (4 + packets)
+	size = sum(len(payload) for *_, payload in payloads)
+
+	def run():
+		for (_, _, outbound), flow in flows.items():
+			reader = TFMPacketReader(1 if outbound else 0)
+			for payload in flow:
+				for _ in reader.consume_payload(payload):
+					pass
+
+	calls, taken = measure(run, min_time)
+	return {
+		"frames_per_second": frames * calls / taken,
+		"megabytes_per_second": size * calls / taken / 1e6,
+		"segments": len(payloads),
+		"frames": frames,
+	}
+
+
+def bench_packet(generator, min_time):
+	chat = Packet(generator.chat("Souris#0000", False).buffer)
+	movement = Packet(generator.movement(False).buffer)
+
+	def read():
+		chat.pos = 0
+		chat.readCode(), chat.readUTF(), chat.readUTF()
+		movement.pos = 0
+		movement.readCode(), movement.read32(), movement.read32(), movement.readBool()
+		movement.read16(), movement.read16(), movement.read32()
+
+	def write():
+		Packet.new(6, 6).writeUTF("Souris#0000").writeUTF("hi hi hi")
+		Packet.new(4, 4).write32(1).write32(2).writeBool(True).write16(3).write16(4).write32(5)
+
+	# A captured chat packet, read by two plugins
+	shared = Packet(memoryview(bytes(chat.buffer)))
+
+	def shared_read():
+		shared.cache.clear()
+		for _ in range(2):
+			view = shared.view()
+			view.readCode(), view.readUTF(), view.readUTF()
+
+	builder = PacketBuilder()
+
+	def build():
+		builder.reset().writeCode(6, 6).writeUTF("Souris#0000").writeUTF("hi hi hi").frame(1)
+		builder.reset().pack("BBII?HHI", 4, 4, 1, 2, True, 3, 4, 5).frame(2)
+
+	results = {}
+	for name, function in (("reads", read), ("shared_reads", shared_read), ("writes", write), ("builds", build)):
+		calls, taken = measure(lambda: [function() for _ in range(1000)], min_time)
+		results["{}_per_second".format(name)] = 2000 * calls / taken # two packets per call
+	return results
+
+
+class Counter(EventBased):
+	def __init__(self, loop, expected):
+		self.loop = loop
+		self.expected = expected
+		self.received = 0
+		self.done = asyncio.Event()
+		super().__init__()
+
+	async def on_packet(self, packet):
+		self.received += 1
+		if self.received == self.expected:
+			self.done.set()
+
+
+class SyncCounter(Counter):
+	def on_packet(self, packet):
+		self.received += 1
+		if self.received == self.expected:
+			self.done.set()
+
+
+def bench_dispatch(events):
+	return {
+		"events_per_second": dispatch_rate(Counter, events),
+		"sync_events_per_second": dispatch_rate(SyncCounter, events),
+		"events": events,
+	}
+
+
+def dispatch_rate(factory, events):
+	loop = asyncio.get_event_loop()
+	counter = factory(loop, events)
+
+	def produce():
+		for _ in range(events):
+			counter.dispatch("packet", None)
+
+	async def main():
+		thread = threading.Thread(target=produce)
+		start = time.perf_counter()
+		thread.start()
+		await counter.done.wait()
+		taken = time.perf_counter() - start
+		thread.join()
+		return taken
+
+	taken = loop.run_until_complete(main())
+	return events / taken
+
+
+class CountingPlugin:
+	def __init__(self, expected, done):
+		self.expected = expected
+		self.done = done
+		self.received = 0
+
+	async def tear_down(self):
+		pass
+
+	async def packet_sent(self, client, conn, fp, packet):
+		self.count()
+
+	async def packet_received(self, client, conn, packet):
+		self.count()
+
+	def count(self):
+		self.received += 1
+		if self.received == self.expected:
+			self.done.set()
+
+
+class StaticWatcher:
+	"""Routes every packet to a fixed set of plugins instead of the plugins directory."""
+	def __init__(self, workers):
+		self.router = PluginRouter(workers)
+
+	def route(self, ccc, outbound):
+		return self.router.route(ccc, outbound)
+
+	def observers(self):
+		return self.router.observers
+
+
+def bench_pipeline(generator, sessions, packets):
+	loop = asyncio.get_event_loop()
+	fd, path = tempfile.mkstemp(suffix=".pcap")
+	os.close(fd)
+
+	try:
+		frames = generator.write_pcap(path, sessions, packets)
+
+		done = asyncio.Event()
+		plugin = CountingPlugin(frames, done)
+		worker = PluginWorker("counter", plugin, loop)
+		watcher = TFMClient.watcher
+		TFMClient.watcher = StaticWatcher([worker])
+
+		async def main():
+			network = NetworkScanner(functools.partial(PcapDriver, path=path, speed=0), TFMConnection)
+			start = time.perf_counter()
+			network.add(main_ip)
+			try:
+				await asyncio.wait_for(done.wait(), 60)
+			finally:
+				taken = time.perf_counter() - start
+				network.stop()
+			return taken
+
+		try:
+			# The driver prints its own summary.
+			with contextlib.redirect_stdout(io.StringIO()):
+				taken = loop.run_until_complete(main())
+		finally:
+			TFMClient.watcher = watcher
+			loop.run_until_complete(worker.close())
+
+		return {"frames_per_second": frames / taken, "frames": frames, "delivered": plugin.received}
+
+	finally:
+		os.remove(path)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--quick", action="store_true", help="smaller and shorter runs")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the generated traffic")
+	parser.add_argument("--output", metavar="FILE", help="write the results to a file instead of stdout")
+	args = parser.parse_args()
+
+	sessions, packets, min_time, events = (2, 2000, 0.2, 20000) if args.quick else (8, 10000, 1.0, 200000)
+
+	results = {
+		"reader": bench_reader(TrafficGenerator(args.seed), sessions, packets, min_time),
+		"packet": bench_packet(TrafficGenerator(args.seed), min_time),
+		"dispatch": bench_dispatch(events),
+		"pipeline": bench_pipeline(TrafficGenerator(args.seed), sessions, packets),
+	}
+	report = {
+		"meta": {
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+			"python": sys.version.split()[0],
+			"implementation": platform.python_implementation(),
+			"platform": platform.platform(),
+			"xor_backend": "numpy" if packet_module.numpy is not None else "int.from_bytes",
+			"seed": args.seed,
+			"sessions": sessions,
+			"packets": packets,
+		},
+		"results": results,
+	}
+
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump(report, file, indent=2)
+		for name, result in results.items():
+			print("{:>10} {}".format(name, ", ".join(
+				"{} {:,.0f}".format(key, value) for key, value in result.items()
+			)))
+	else:
+		print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,219 @@
+"""A deterministic generator of Transformice traffic: the frames of a few game
+sessions (main server handshake and login, bulle switch and handshake, chat
+and movement) cut into TCP segments the way the network would, and written
+to a pcap file when a driver has to replay them.
+
+Usage: python -m benchmarks.traffic <file.pcap> [sessions] [packets] [seed]
+"""
+
+import random
+import socket
+import struct
+import sys
+
+from tfmplugins.tfm.network import main_ip
+from tfmplugins.tfm.packet import Packet
+
+
+MSS = 1460
+
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+IPV4_HEADER = struct.Struct(">BBHHHBBH4s4s")
+TCP_HEADER = struct.Struct(">HHIIBBHHH")
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH_ACK = 0x18
+
+WORDS = (
+	"hi", "cheese", "hole", "shaman", "map", "lol", "gg", "room", "tribe",
+	"go", "left", "right", "jump", "wait", "nice", "bootcamp", "racing",
+)
+
+
+def encode_length(length):
+	"""Returns the varint a frame length is prefixed with."""
+	prefix = bytearray()
+	while True:
+		byte = length & 0x7f
+		length >>= 7
+		if length:
+			prefix.append(byte | 0x80)
+		else:
+			prefix.append(byte)
+			return bytes(prefix)
+
+
+def frame(body, outbound, fp=0):
+	"""Prefixes a packet (CCC and body) with its length, and its fingerprint if
+	it is outbound. The fingerprint isn't counted in the length."""
+	body = bytes(body)
+	if outbound:
+		return encode_length(len(body)) + bytes((fp,)) + body
+	return encode_length(len(body)) + body
+
+
+class TrafficGenerator:
+	"""Generates the same traffic for the same seed.
+
+	Parameters
+	----------
+	seed: :class:`int`
+		The random seed
+	client_ip: :class:`str`
+		The local address of every session
+	bulle_ip: :class:`str`
+		The bulle every session switches to
+	"""
+	def __init__(self, seed=0, client_ip="10.0.0.2", bulle_ip="37.187.29.20"):
+		self.rng = random.Random(seed)
+		self.client_ip = client_ip
+		self.bulle_ip = bulle_ip
+
+	def sentence(self, words):
+		return " ".join(self.rng.choice(WORDS) for _ in range(words))
+
+	def chat(self, name, outbound):
+		"""A (6, 6) chat message: ciphered text when sent, sender and text when received."""
+		if outbound:
+			size = self.rng.randrange(21, 120)
+			return Packet.new(6, 6).writeBytes(bytes(self.rng.randrange(256) for _ in range(size)))
+		return Packet.new(6, 6).writeUTF(name).writeUTF(self.sentence(self.rng.randrange(4, 16)))
+
+	def movement(self, outbound):
+		"""A (4, 4) movement packet."""
+		packet = Packet.new(4, 4).write32(self.rng.randrange(1 << 31)).write32(self.rng.randrange(1 << 16))
+		packet.writeBool(self.rng.random() < 0.5).write16(self.rng.randrange(800)).write16(self.rng.randrange(400))
+		if not outbound:
+			packet.write32(self.rng.randrange(1 << 31))
+		return packet
+
+	def other(self):
+		"""Any other packet: a random code and body."""
+		packet = Packet.new(self.rng.randrange(1, 150), self.rng.randrange(1, 50))
+		return packet.writeBytes(bytes(self.rng.randrange(256) for _ in range(self.rng.randrange(0, 400))))
+
+	def session(self, index, packets=1000):
+		"""Returns the frames of a game session, in order.
+		:param index: :class:`int` the session number (it gives its name and keys)
+		:param packets: :class:`int` the number of game packets after the handshakes
+		:return: List[:class:`tuple`] (server, outbound, frame) where server is "main" or "bulle"
+		"""
+		name = "Souris{}#0000".format(index)
+		key = struct.pack(">I", index) + bytes(self.rng.randrange(256) for _ in range(8))
+		fps = {"main": self.rng.randrange(100), "bulle": self.rng.randrange(100)}
+		frames = []
+
+		def add(server, outbound, packet):
+			if outbound:
+				fps[server] = (fps[server] + 1) % 100
+			frames.append((server, outbound, frame(packet.buffer, outbound, fps[server])))
+
+		add("main", True, Packet.new(28, 1).write16(666).writeUTF("en").writeUTF("x" * 20))
+		add("main", False, Packet.new(26, 2).write32(index + 1).writeUTF(name).write32(3600).write8(1).write32(index))
+		add("main", False, Packet.new(44, 1).writeBytes(key).writeUTF(self.bulle_ip))
+		add("bulle", True, Packet.new(44, 1).writeBytes(key))
+
+		for _ in range(packets):
+			server = "bulle" if self.rng.random() < 0.8 else "main"
+			outbound = self.rng.random() < 0.3
+			kind = self.rng.random()
+			if kind < 0.2:
+				add(server, outbound, self.chat(name, outbound))
+			elif kind < 0.7:
+				add(server, outbound, self.movement(outbound))
+			else:
+				add(server, outbound, self.other())
+		return frames
+
+	def segments(self, frames):
+		"""Cuts a stream of frames in TCP payloads: small frames are coalesced, and
+		payloads are split at the MSS and sometimes in the middle of a frame.
+		:param frames: Iterable[:class:`bytes`] the frames of a single direction
+		:return: List[:class:`bytes`]
+		"""
+		stream = b"".join(frames)
+		segments = []
+		pos = 0
+		while pos < len(stream):
+			size = MSS if self.rng.random() < 0.5 else self.rng.randrange(1, MSS)
+			segments.append(stream[pos:pos + size])
+			pos += size
+		return segments
+
+	def payloads(self, sessions=1, packets=1000):
+		"""Returns the TCP payloads of some sessions, as they are captured: consecutive
+		frames of the same connection and direction are coalesced, then split.
+		:return: List[:class:`tuple`] (session, server, outbound, payload), in capture order
+		"""
+		payloads = []
+
+		def flush(index, flow, frames):
+			for payload in self.segments(frames):
+				payloads.append((index,) + flow + (payload,))
+
+		for index in range(sessions):
+			flow, pending, burst = None, [], 0
+			for server, outbound, data in self.session(index, packets):
+				if (server, outbound) != flow or len(pending) >= burst:
+					if pending:
+						flush(index, flow, pending)
+					flow, pending, burst = (server, outbound), [], self.rng.randrange(1, 8)
+				pending.append(data)
+
+			if pending:
+				flush(index, flow, pending)
+		return payloads
+
+	def write_pcap(self, path, sessions=1, packets=1000):
+		"""Writes the sessions to a pcap file (Ethernet, IPv4, TCP), with their SYN and FIN.
+		:return: :class:`int` the number of frames the sessions have
+		"""
+		servers = {"main": (main_ip, 443), "bulle": (self.bulle_ip, 5555)}
+		timestamp = 1600000000.0
+
+		def segment(index, server, outbound, flags, payload=b""):
+			nonlocal timestamp
+			timestamp += 0.0005
+			local = (self.client_ip, 50000 + index * 2 + (server == "bulle"))
+			remote = servers[server]
+			src, dst = (local, remote) if outbound else (remote, local)
+
+			tcp = TCP_HEADER.pack(src[1], dst[1], 0, 0, 5 << 4, flags, 65535, 0, 0) + payload
+			ip = IPV4_HEADER.pack(
+				0x45, 0, 20 + len(tcp), 0, 0, 64, socket.IPPROTO_TCP, 0,
+				socket.inet_aton(src[0]), socket.inet_aton(dst[0])
+			)
+			data = b"\x00" * 12 + b"\x08\x00" + ip + tcp
+			file.write(PCAP_RECORD.pack(int(timestamp), int(timestamp % 1 * 1e6), len(data), len(data)))
+			file.write(data)
+
+		with open(path, "wb") as file:
+			file.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+			started = set()
+			for index, server, outbound, payload in self.payloads(sessions, packets):
+				if (index, server) not in started:
+					started.add((index, server))
+					segment(index, server, True, TCP_SYN)
+				segment(index, server, outbound, TCP_PSH_ACK, payload)
+
+			for index, server in sorted(started):
+				segment(index, server, True, TCP_FIN)
+
+		return sessions * (4 + packets)
+
+
+def main():
+	path = sys.argv[1]
+	sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	packets = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+	seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+	frames = TrafficGenerator(seed).write_pcap(path, sessions, packets)
+	print("Wrote {} sessions ({} frames) to {}".format(sessions, frames, path))
+
+
+if __name__ == '__main__':
+	main()
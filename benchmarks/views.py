@@ -0,0 +1,53 @@
+"""Measures the memory allocated per packet when it is handed to N plugins,
+using Packet.copy (what the client used to do) and Packet.view.
+
+The view column must not grow with the packet size: plugins share the
+buffer, so only their cursors are allocated. The script fails otherwise.
+
+Usage: python -m benchmarks.views
+"""
+
+import tracemalloc
+
+from tfmplugins.tfm.packet import Packet
+
+
+PACKETS = 200
+
+
+def allocated(method, plugins, size):
+	"""Returns the bytes allocated per packet while giving it to every plugin."""
+	payload = memoryview(bytes(size))
+	received = []
+
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+
+	for _ in range(PACKETS):
+		packet = Packet(payload)
+		for _ in range(plugins):
+			received.append(method(packet))
+
+	total = tracemalloc.get_traced_memory()[0] - before
+	tracemalloc.stop()
+	return total / PACKETS
+
+
+def main():
+	small, big = 64, 16384
+
+	print("{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+		"plugins", "copy 64B", "copy 16KB", "view 64B", "view 16KB"
+	))
+	for plugins in (1, 4, 16, 64):
+		copies = [allocated(Packet.copy, plugins, size) for size in (small, big)]
+		views = [allocated(Packet.view, plugins, size) for size in (small, big)]
+
+		print("{:>8} {:>12,.0f} {:>12,.0f} {:>12,.0f} {:>12,.0f}".format(plugins, *copies, *views))
+
+		# The buffer itself must never be copied for a plugin.
+		assert views[1] - views[0] < big - small, "Packet.view copied the buffer"
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,58 @@
+"""Compares the XOR cipher against the previous per-byte implementation,
+both packet by packet and with Packet.xor_decipher_many.
+
+Usage: python -m benchmarks.xor
+"""
+
+import random
+import time
+
+from tfmplugins.tfm import packet as packet_module
+from tfmplugins.tfm.packet import Packet
+
+
+def legacy_decipher(packet, key, fp):
+	"""The XOR decipher as it was before the bulk one."""
+	buffer = packet.writable()
+	buffer[3:] = (byte ^ key[i % 20] for i, byte in enumerate(buffer[3:], fp + 1))
+	return packet
+
+
+def run(function, payloads, min_time=0.5):
+	iterations = 0
+	start = time.perf_counter()
+	while True:
+		function([Packet(payload) for payload in payloads])
+
+		iterations += 1
+		taken = time.perf_counter() - start
+		if taken >= min_time:
+			return len(payloads) * iterations / taken
+
+
+def main():
+	rng = random.Random(0)
+	key = [rng.randrange(256) for _ in range(20)]
+
+	def legacy(packets):
+		for packet in packets:
+			legacy_decipher(packet, key, packet.buffer[0])
+
+	def bulk(packets):
+		for packet in packets:
+			packet.xor_decipher(key, packet.buffer[0])
+
+	def batch(packets):
+		Packet.xor_decipher_many(key, packets)
+
+	print("backend: {}".format("numpy" if packet_module.numpy is not None else "int.from_bytes"))
+	print("{:>8} {:>14} {:>14} {:>14}".format("size", "legacy pps", "bulk pps", "batch pps"))
+	for size in (32, 256, 4096):
+		payloads = [bytes(rng.randrange(256) for _ in range(size)) for _ in range(100)]
+
+		results = [run(function, payloads) for function in (legacy, bulk, batch)]
+		print("{:>8} {:>14,.0f} {:>14,.0f} {:>14,.0f}".format(size, *results))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import socket
+import sys
+
+import pytest
+
+from tfmplugins.network import NetworkScanner
+from tfmplugins.network.connection import Connection
+
+
+pytestmark = pytest.mark.skipif(
+	not sys.platform.startswith("linux") or os.geteuid() != 0,
+	reason="AF_PACKET sockets need Linux and root"
+)
+
+SERVER = "127.0.0.3"
+MESSAGES = 50
+
+
+class Recorder(Connection):
+	received = []
+
+	def parse_packet(self, payload, outbound):
+		self.received.append((outbound, bytes(payload)))
+
+
+def exchange():
+	"""Sends every message in its own segment, both ways, and returns what was sent."""
+	server = socket.socket()
+	server.bind((SERVER, 0))
+	server.listen()
+	client = socket.create_connection(server.getsockname(), source_address=("127.0.0.1", 0))
+	peer, _ = server.accept()
+	sent = []
+
+	try:
+		for sock in (client, peer):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		for i in range(MESSAGES):
+			request = "request {}".format(i).encode()
+			response = "response {}".format(i).encode()
+			# Waiting for the other end keeps the messages from being coalesced.
+			client.sendall(request)
+			assert peer.recv(100) == request
+			peer.sendall(response)
+			assert client.recv(100) == response
+			sent += [(True, request), (False, response)]
+	finally:
+		client.close()
+		peer.close()
+		server.close()
+	return sent
+
+
+def test_loopback_payloads_are_delivered_once():
+	from tfmplugins.network.drivers.afpacket import AFPacketDriver
+
+	loop = asyncio.new_event_loop()
+	network = NetworkScanner(
+		lambda *args: AFPacketDriver(*args, interface="lo"),
+		Recorder, loop=loop, restart=False
+	)
+	Recorder.received = []
+
+	async def capture():
+		network.add(SERVER)
+		sent = await loop.run_in_executor(None, exchange)
+		for _ in range(100):
+			if len(Recorder.received) >= len(sent):
+				break
+			await asyncio.sleep(0.05)
+		await asyncio.sleep(0.1) # catches the duplicates
+		return sent
+
+	try:
+		sent = loop.run_until_complete(capture())
+	finally:
+		network.stop()
+		loop.close()
+
+	assert Recorder.received == sent
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import socket
+import struct
+import sys
+
+import pytest
+
+from tfmplugins.network.connection import Connection
+from tfmplugins.network.drivers import afpacket
+from tfmplugins.network.drivers.afpacket import bpf_filter
+from tfmplugins.network.drivers.driver_base import DriverBase
+
+
+LOCAL = "192.168.1.2"
+SERVER = "37.187.29.8"
+ACK, SYN, PSH = 0x10, 0x02, 0x08
+
+
+def address(ip):
+	return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def servers(*ips):
+	return [(address(ip), 0xffffffff) for ip in ips]
+
+
+def segment(src, dst, sport, dport, payload=b"", flags=ACK | PSH, protocol=socket.IPPROTO_TCP):
+	"""Builds an IPv4 packet (with a 24 bytes header, to check the IP header length is used)."""
+	tcp = struct.pack("!HHIIBBHHH", sport, dport, 0, 0, 5 << 4, flags, 0, 0, 0) + payload
+	ip = struct.pack(
+		"!BBHHHBBH4s4s", 0x46, 0, 24 + len(tcp), 0, 0, 64, protocol, 0,
+		socket.inet_aton(src), socket.inet_aton(dst)
+	)
+	return ip + b"\x00" * 4 + tcp
+
+
+def run(program, packet):
+	"""Runs a classic BPF program like the kernel does and returns what it accepts."""
+	instructions = list(struct.iter_unpack("=HBBI", program))
+	a = x = pc = 0
+	memory = [0] * 16
+
+	def load(offset, size):
+		if offset + size > len(packet):
+			raise IndexError
+		return int.from_bytes(packet[offset:offset + size], "big")
+
+	try:
+		while True:
+			code, jt, jf, k = instructions[pc]
+			pc += 1
+			if code == afpacket.BPF_LD_W_ABS:
+				a = load(k, 4)
+			elif code == afpacket.BPF_LD_H_ABS:
+				a = load(k, 2)
+			elif code == afpacket.BPF_LD_B_ABS:
+				a = load(k, 1)
+			elif code == afpacket.BPF_LD_H_IND:
+				a = load(x + k, 2)
+			elif code == afpacket.BPF_LD_B_IND:
+				a = load(x + k, 1)
+			elif code == afpacket.BPF_LD_MEM:
+				a = memory[k]
+			elif code == afpacket.BPF_LDX_B_MSH:
+				x = (load(k, 1) & 0xf) * 4
+			elif code == afpacket.BPF_ST:
+				memory[k] = a
+			elif code == afpacket.BPF_ALU_SUB_X:
+				a = (a - x) & 0xffffffff
+			elif code == afpacket.BPF_ALU_AND_K:
+				a &= k
+			elif code == afpacket.BPF_ALU_RSH_K:
+				a >>= k
+			elif code == afpacket.BPF_TAX:
+				x = a
+			elif code == afpacket.BPF_JA:
+				pc += k
+			elif code == afpacket.BPF_JEQ_K:
+				pc += jt if a == k else jf
+			elif code == afpacket.BPF_JSET_K:
+				pc += jt if a & k else jf
+			elif code == afpacket.BPF_RET_K:
+				return k
+			else:
+				raise AssertionError("unknown opcode {:#x}".format(code))
+	except IndexError:
+		return 0
+
+
+def accepted(program, packet):
+	return run(program, packet) != 0
+
+
+def test_filter_matches_the_servers_both_ways():
+	program = bpf_filter(servers(SERVER))
+
+	assert accepted(program, segment(LOCAL, SERVER, 50000, 443, b"hi"))
+	assert accepted(program, segment(SERVER, LOCAL, 443, 50000, b"hi"))
+	assert not accepted(program, segment(LOCAL, "1.2.3.4", 50000, 443, b"hi"))
+	assert not accepted(program, segment(LOCAL, SERVER, 50000, 443, b"hi", protocol=socket.IPPROTO_UDP))
+
+
+def test_filter_matches_ranges():
+	program = bpf_filter([(address("37.187.29.0"), 0xffffff00)])
+
+	assert accepted(program, segment(LOCAL, "37.187.29.200", 50000, 443))
+	assert not accepted(program, segment(LOCAL, "37.187.30.1", 50000, 443))
+
+
+def test_filter_drops_the_excluded_ports():
+	program = bpf_filter(servers(SERVER), [50000, 50002])
+
+	for port in (50000, 50002):
+		assert not accepted(program, segment(LOCAL, SERVER, port, 443, b"hi"))
+		assert not accepted(program, segment(SERVER, LOCAL, 443, port, b"hi"))
+	assert accepted(program, segment(LOCAL, SERVER, 50001, 443, b"hi"))
+	assert accepted(program, segment(SERVER, LOCAL, 443, 50001, b"hi"))
+
+
+def test_filter_drops_the_segments_without_payload():
+	program = bpf_filter(servers(SERVER), [50002], payload_only=True)
+
+	assert accepted(program, segment(LOCAL, SERVER, 50000, 443, b"hi"))
+	assert accepted(program, segment(SERVER, LOCAL, 443, 50000, flags=SYN | ACK))
+	assert not accepted(program, segment(SERVER, LOCAL, 443, 50000, flags=ACK))
+	assert not accepted(program, segment(LOCAL, SERVER, 50002, 443, b"hi"))
+
+
+def test_filter_scales_past_short_jumps():
+	ips = ["10.0.{}.{}".format(i // 256, i % 256) for i in range(200)]
+	ports = list(range(40000, 40400))
+	program = bpf_filter(servers(*ips), ports, payload_only=True)
+
+	for ip in (ips[0], ips[-1]):
+		assert accepted(program, segment(LOCAL, ip, 50000, 443, b"hi"))
+		assert accepted(program, segment(ip, LOCAL, 443, 50000, b"hi"))
+		assert not accepted(program, segment(LOCAL, ip, ports[-1], 443, b"hi"))
+		assert not accepted(program, segment(ip, LOCAL, 443, ports[0], b"hi"))
+	assert not accepted(program, segment(LOCAL, "10.1.0.0", 50000, 443, b"hi"))
+
+
+def test_filter_longer_than_the_kernel_accepts():
+	with pytest.raises(ValueError, match="excluded ports"):
+		bpf_filter(servers(SERVER), range(afpacket.BPF_MAXINSNS))
+
+
+@pytest.mark.skipif(
+	not sys.platform.startswith("linux") or os.geteuid() != 0,
+	reason="AF_PACKET sockets need Linux and root"
+)
+def test_kernel_accepts_large_filters():
+	ips = ["10.0.{}.{}".format(i // 256, i % 256) for i in range(200)]
+	sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(afpacket.ETH_P_IP))
+	try:
+		afpacket.attach_filter(sock, bpf_filter(servers(*ips), range(40000, 40400), True))
+	finally:
+		sock.close()
+
+
+class BrokenFilterDriver(DriverBase):
+	def update_filter(self):
+		if self.excluded:
+			raise OSError("filter rejected")
+
+
+def test_failed_exclusion_is_undone():
+	loop = asyncio.new_event_loop()
+	try:
+		driver = BrokenFilterDriver(type("Network", (), {"loop": loop})(), SERVER, Connection)
+		conn = driver.get_connection((LOCAL, 50000), (SERVER, 443), True)
+
+		conn.ignore()
+
+		assert conn.ignored
+		assert driver.excluded == {}
+		assert not driver.ignoring
+		driver.rebuild_filter() # still works
+	finally:
+		loop.close()
@@ -0,0 +1,29 @@
+from tfmplugins.tfm.network import TFMConnection, main_ip
+
+
+class Network:
+	def add(self, ip, ttl=None):
+		pass
+
+
+def outbound(*frame):
+	"""An outbound payload: the length prefix (without the fingerprint) and the frame."""
+	return bytes([len(frame) - 1]) + bytes(frame)
+
+
+def test_truncated_bulle_handshake_is_rejected():
+	conn = TFMConnection(Network(), ("127.0.0.1", 5000), ("1.2.3.4", 5555))
+	assert conn.name == "bulle"
+
+	conn.parse_packet(outbound(0, 44, 1, 0, 0), True)
+
+	assert conn.rejected
+	assert conn.ignored
+
+
+def test_short_handshake_frame_is_rejected():
+	conn = TFMConnection(Network(), ("127.0.0.1", 5001), (main_ip, 5555))
+
+	conn.parse_packet(outbound(0, 28), True)
+
+	assert conn.rejected
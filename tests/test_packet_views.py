@@ -0,0 +1,66 @@
+import tracemalloc
+
+from tfmplugins.tfm.packet import Packet
+
+
+PACKETS = 200
+
+
+def allocated(plugins, size):
+	"""Returns the bytes allocated per packet while giving a view of it to every plugin."""
+	payload = memoryview(bytes(size))
+	received = []
+
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		for _ in range(PACKETS):
+			packet = Packet(payload)
+			for _ in range(plugins):
+				received.append(packet.view())
+		return (tracemalloc.get_traced_memory()[0] - before) / PACKETS
+	finally:
+		tracemalloc.stop()
+
+
+def test_views_dont_copy_the_buffer():
+	small, big = 64, 16384
+	for plugins in (1, 16):
+		# The payload size must not show up in what every packet costs.
+		assert allocated(plugins, big) - allocated(plugins, small) < 1024
+
+
+def test_views_only_cost_a_cursor_per_plugin():
+	one = allocated(1, 16384)
+	many = allocated(16, 16384)
+	# Only the cursors are allocated for the extra plugins, never the buffer.
+	assert (many - one) / 15 < 512
+
+
+def test_view_shares_the_buffer():
+	packet = Packet(memoryview(b"\x06\x06\x00\x02hi"))
+	view = packet.view()
+
+	assert view.buffer is packet.buffer
+	assert view.pos == 0
+
+
+def test_view_of_a_writable_packet_freezes_it():
+	packet = Packet.new(6, 6).writeUTF("hi")
+	view = packet.view()
+
+	assert isinstance(packet.buffer, memoryview)
+	assert view.buffer is packet.buffer
+
+
+def test_view_copies_on_first_write():
+	packet = Packet(memoryview(b"\x06\x06\x00\x02hi"))
+	view = packet.view()
+	other = packet.view()
+
+	view.write8(1)
+
+	assert isinstance(view.buffer, bytearray)
+	assert bytes(view) == b"\x06\x06\x00\x02hi\x01"
+	assert bytes(packet) == b"\x06\x06\x00\x02hi"
+	assert other.buffer is packet.buffer
@@ -0,0 +1,21 @@
+from tfmplugins.tfm.packet import Packet
+
+
+KEYS = list(range(7, 27))
+
+
+def test_decipher_many_matches_decipher():
+	buffers = [bytes([fp, 6, 6]) + bytes(i % 256 for i in range(size)) for fp, size in ((1, 5), (19, 0), (4, 300))]
+
+	many = Packet.xor_decipher_many(KEYS, [Packet(buffer) for buffer in buffers])
+	single = [Packet(buffer).xor_decipher(KEYS, buffer[0]) for buffer in buffers]
+
+	assert [bytes(packet) for packet in many] == [bytes(packet) for packet in single]
+
+
+def test_decipher_many_skips_empty_packets():
+	packets = Packet.xor_decipher_many(KEYS, [Packet(), Packet(b"\x05"), Packet(b"\x05\x06\x06\x01")])
+
+	assert bytes(packets[0]) == b""
+	assert bytes(packets[1]) == b"\x05"
+	assert bytes(packets[2]) == bytes(Packet(b"\x05\x06\x06\x01").xor_decipher(KEYS, 5))
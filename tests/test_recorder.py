@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from tfmplugins.tfm.recorder import SessionReader, SessionRecorder
+
+
+MAIN = SimpleNamespace(name="main")
+
+
+def test_records_are_stamped_at_capture_time(tmp_path):
+	recorder = SessionRecorder(str(tmp_path))
+	recorder.record(MAIN, False, b"\x06\x06hi", 1000.5)
+	recorder.record(MAIN, True, b"\x01\x06\x06hey", 1001.25)
+	recorder.close()
+
+	with SessionReader(str(tmp_path)) as reader:
+		frames = list(reader.read())
+
+	assert [frame.timestamp for frame in frames] == [1000.5, 1001.25]
+	assert [frame.ccc for frame in frames] == [(6, 6), (6, 6)]
+
+
+def test_reader_unmaps_the_segments(tmp_path):
+	recorder = SessionRecorder(str(tmp_path))
+	recorder.record(MAIN, False, b"\x06\x06hi")
+	recorder.close()
+
+	reader = SessionReader(str(tmp_path))
+	assert len(list(reader.read())) == 1
+	assert reader.mapping is None
+
+	with reader:
+		frames = reader.read()
+		next(frames)
+		assert reader.mapping is not None
+	assert reader.mapping is None and reader.data is None
+
+
+def test_failed_writer_drops_packets(tmp_path):
+	recorder = SessionRecorder(str(tmp_path))
+
+	def fail():
+		raise OSError("disk full")
+	recorder.flush = fail
+	recorder.record(MAIN, False, b"\x06\x06hi")
+	recorder.close()
+
+	assert isinstance(recorder.error, OSError)
+	assert recorder.pending == []
+	recorder.record(MAIN, False, b"\x06\x06hi")
+	assert recorder.dropped == 1 and recorder.pending == []
+
+
+def test_pending_packets_are_capped(tmp_path):
+	recorder = SessionRecorder(str(tmp_path), flush_interval=60)
+	recorder.MAX_PENDING = 2
+	try:
+		for _ in range(5):
+			recorder.record(MAIN, False, b"\x06\x06hi")
+		assert len(recorder.pending) == 2
+		assert recorder.dropped == 3
+	finally:
+		recorder.close()
@@ -0,0 +1,41 @@
+from tfmplugins.tfm.builder import PacketBuilder
+from tfmplugins.tfm.packet import Packet
+
+
+def test_packet_double_release_is_ignored():
+	Packet._pool.clear()
+	packet = Packet.acquire(b"\x06\x06")
+
+	packet.release()
+	packet.release()
+
+	assert Packet._pool == [packet]
+	first, second = Packet.acquire(b"\x01\x01"), Packet.acquire(b"\x02\x02")
+	assert first is not second
+
+
+def test_builder_double_release_is_ignored():
+	PacketBuilder._pool.clear()
+	builder = PacketBuilder.acquire()
+
+	builder.release()
+	builder.release()
+
+	assert PacketBuilder._pool == [builder]
+	again = PacketBuilder.acquire()
+	assert again is builder
+	again.release()
+	assert PacketBuilder._pool == [builder]
+
+
+def test_builder_grows_while_a_view_is_alive():
+	builder = PacketBuilder(capacity=4)
+	builder.writeCode(6, 6)
+	body = builder.body()
+	frame = builder.frame(3)
+
+	builder.writeString("hello world")
+
+	assert bytes(body) == b"\x06\x06"
+	assert bytes(frame) == b"\x02\x03\x06\x06"
+	assert bytes(builder.body()) == b"\x06\x06\x00\x0bhello world"
@@ -0,0 +1,39 @@
+import asyncio
+
+from tfmplugins.utils.watchdog import PluginsWatcher
+
+
+class FakeWatcher:
+	def __init__(self, name, events):
+		self.name = name
+		self.plugin = object()
+		self.events = events
+
+	async def tear_down(self):
+		self.events.append(("tear_down", self.name))
+
+
+def test_close_tears_down_every_plugin(tmp_path):
+	events = []
+
+	async def deliver(plugin, name):
+		await asyncio.sleep(0)
+		events.append(("packet", name))
+
+	async def run():
+		watcher = PluginsWatcher(str(tmp_path))
+		watcher.watchers = {name: FakeWatcher(name, events) for name in ("a", "b")}
+		watcher.start()
+
+		for worker in watcher.router.plugins:
+			await worker.put(deliver, worker.name)
+		await watcher.close()
+		return watcher
+
+	watcher = asyncio.new_event_loop().run_until_complete(run())
+
+	assert not watcher.thread.is_alive()
+	assert watcher.router.plugins == []
+	# The queued packets are delivered before the plugins are torn down.
+	assert sorted(events[:2]) == [("packet", "a"), ("packet", "b")]
+	assert sorted(events[2:]) == [("tear_down", "a"), ("tear_down", "b")]
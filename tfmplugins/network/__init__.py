@@ -23,4 +23,5 @@ SOFTWARE.
 """
 
 from tfmplugins.network.connection import Connection
-from tfmplugins.network.scanner import NetworkScanner
\ No newline at end of file
+from tfmplugins.network.scanner import NetworkScanner
+from tfmplugins.network.servers import ServerSet
\ No newline at end of file
@@ -51,36 +51,73 @@ class Connection:
 		Whether the connection is flagged as closing
 	closing_at: :class:`int`
 		The time when the connection will be considered as fully closed
+	driver: Optional[:class:`network.drivers.driver_base.DriverBase`]
+		The driver that captures the connection, set when it creates it
+	payload_only: :class:`bool`
+		Whether the connection only needs the segments with payload (and the ones
+		that open or close it). Drivers push this down to their filter.
+	captured_at: :class:`int`
+		The :func:`time.perf_counter_ns` when the driver captured the payload being
+		parsed. Only set when the metrics are enabled.
+	capture_time: :class:`float`
+		The :func:`time.time` when the driver captured the payload being parsed (the
+		capture timestamp, for a replay)
+
+	Every packet is captured by the driver thread but parsed by the event loop (see
+	:class:`network.ring.PayloadRing`). Flags set by the driver (closing) are read by
+	the loop and the other way around (ignored), so a few payloads may still be queued
+	for a connection that has just been ignored: they are dropped.
 	"""
+	payload_only = False
+
 	def __init__(self, network, local, remote):
 		self.network = network
 		self.local = local
 		self.remote = remote
+		self.driver = None
 
 		self.ignored = False
 		self.closing = False
 		self.closed_at = 0
+		self.captured_at = 0
+		self.capture_time = 0.0
 
 	def ignore(self):
-		"""Flags the connection as ignored (don't do anything with its packets)
+		"""Flags the connection as ignored (don't do anything with its packets).
+		Unless it is closing, its driver stops capturing it.
 		"""
 		self.ignored = True
 
+		if self.driver is not None and not self.closing:
+			self.driver.exclude(self)
+
 	def close(self):
 		"""Flags the connection as closing. This also flags it as ignored.
 		This method should only be called when a TCP packet has the FIN flag
 		set to it.
 		"""
-		self.ignore()
-
 		self.closing = True
 		self.closed_at = time.perf_counter() + 1.0
 
+		self.ignore()
+
+	def ready(self, callback):
+		"""Tells whether the connection can parse another payload now, or whether
+		whatever consumes its packets is too far behind. Called from the loop.
+		:param callback: the function to call (without arguments) once it can, if it
+			can't yet
+		:return: :class:`bool` whether it can parse a payload now
+		"""
+		return True
+
 	def parse_packet(self, payload, outbound):
-		"""Parses a packet (only called if the connection is not flagged as ignored)
-		:param payload: :class:`bytes` or :class:`bytearray` the packet payload
+		"""Parses a packet (only called if the connection is not flagged as ignored).
+		Called from the event loop, in the order the payloads have been captured.
+		:param payload: :class:`bytes`, :class:`bytearray` or :class:`memoryview` the packet
+			payload. It is only valid during the call.
 		:param outbound: :class:`bool` whether the packet direction is outbound (True)
 			or inbound (False)
-		:return: :class:`bool` whether to send the packet to the other end or not
+		:return: :class:`bool` whether to send the packet to the other end or not. Drivers
+			forward it before it is parsed, so this is not used anymore.
 		"""
 		raise NotImplementedError
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import ctypes
+import mmap
+import select
+import socket
+import struct
+
+from tfmplugins.network.drivers.driver_base import TCP_FIN, TCP_RST, TCP_SYN, DriverBase, parse_tcp
+
+
+ETH_P_IP = 0x0800
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+
+# classic BPF opcodes
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LD_MEM = 0x60
+BPF_LDX_B_MSH = 0xb1
+BPF_ST = 0x02
+BPF_ALU_SUB_X = 0x1c
+BPF_ALU_AND_K = 0x54
+BPF_ALU_RSH_K = 0x74
+BPF_JA = 0x05
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+BPF_TAX = 0x07
+# the longest program the kernel accepts
+BPF_MAXINSNS = 4096
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct("=7I")
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1:
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK_HEADER = struct.Struct("=III")
+BLOCK_STATUS = 8
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac, tp_net
+PACKET_HEADER = struct.Struct("=IIIIIIHH")
+# struct sockaddr_ll, right after the (aligned) tpacket3_hdr: family, protocol, ifindex, hatype, pkttype
+SOCKADDR_LL = struct.Struct("=HHiHB")
+SOCKADDR_LL_OFFSET = 48
+
+
+def bpf_filter(ips, excluded=(), payload_only=False):
+	"""Compiles a classic BPF program that only accepts the TCP segments from or to
+	some IPv4 addresses. The program runs on packets that start with the IP header.
+	:param ips: List[:class:`tuple`] (address, netmask) pairs, as big endian :class:`int`
+	:param excluded: Iterable[:class:`int`] the local ports whose segments are dropped
+	:param payload_only: :class:`bool` whether to drop the segments without payload,
+		unless they open or close the connection (SYN, FIN or RST)
+	:return: :class:`bytes` the packed struct sock_filter array
+	:raise ValueError: if the program would be longer than the kernel accepts
+	"""
+	program = []
+	labels = {}
+
+	def emit(code, k=0, jt=0, jf=0):
+		program.append((code, jt, jf, k))
+
+	emit(BPF_LD_B_ABS, 9) # protocol
+	emit(BPF_JEQ_K, socket.IPPROTO_TCP, 1, 0)
+	emit(BPF_RET_K, 0)
+	emit(BPF_LDX_B_MSH, 0) # X = IP header length
+
+	# A packet to a server is outbound, and one from a server is inbound.
+	# Conditional jumps can only skip 255 instructions: a match skips to a JA, which
+	# goes anywhere.
+	for field, direction in ((16, "outbound"), (12, "inbound")):
+		for address, netmask in ips:
+			emit(BPF_LD_W_ABS, field)
+			emit(BPF_ALU_AND_K, netmask)
+			emit(BPF_JEQ_K, address, 0, 1)
+			emit(BPF_JA, direction)
+	emit(BPF_RET_K, 0)
+
+	# The local port is the source port of outbound segments and the dest port of inbound ones.
+	ports = sorted(set(excluded))
+	for direction, offset in (("outbound", 0), ("inbound", 2)):
+		labels[direction] = len(program)
+		if ports:
+			emit(BPF_LD_H_IND, offset)
+			for port in ports:
+				emit(BPF_JEQ_K, port, 0, 1)
+				emit(BPF_RET_K, 0)
+		if direction == "outbound":
+			emit(BPF_JA, "payload")
+
+	labels["payload"] = len(program)
+	if payload_only:
+		emit(BPF_LD_B_IND, 13) # flags
+		emit(BPF_JSET_K, TCP_SYN | TCP_FIN | TCP_RST, "accept", 0)
+		emit(BPF_LD_H_ABS, 2) # total length
+		emit(BPF_ALU_SUB_X, 0)
+		emit(BPF_ST, 0)
+		emit(BPF_LD_B_IND, 12) # data offset, in words, in the high nibble
+		emit(BPF_ALU_RSH_K, 2)
+		emit(BPF_ALU_AND_K, 0x3c)
+		emit(BPF_TAX)
+		emit(BPF_LD_MEM, 0)
+		emit(BPF_ALU_SUB_X, 0)
+		emit(BPF_JEQ_K, 0, 0, "accept")
+		emit(BPF_RET_K, 0)
+
+	labels["accept"] = len(program)
+	emit(BPF_RET_K, 0x40000)
+
+	if len(program) > BPF_MAXINSNS:
+		raise ValueError("The BPF filter of {} servers and {} excluded ports needs {} instructions, "
+			"more than the {} the kernel accepts".format(len(ips), len(ports), len(program), BPF_MAXINSNS))
+
+	def resolve(index, target):
+		if not isinstance(target, str):
+			return target
+		return labels[target] - index - 1
+
+	instructions = []
+	for index, (code, jt, jf, k) in enumerate(program):
+		if code == BPF_JA:
+			k = labels[k] - index - 1
+		instructions.append(struct.pack("=HBBI", code, resolve(index, jt), resolve(index, jf), k))
+	return b"".join(instructions)
+
+
+def attach_filter(sock, program):
+	"""Attaches a classic BPF program to a socket.
+	:param sock: :class:`socket.socket` the socket
+	:param program: :class:`bytes` the result of :func:`bpf_filter`
+	"""
+	instructions = ctypes.create_string_buffer(program, len(program))
+	fprog = struct.pack("@HP", len(program) // 8, ctypes.addressof(instructions))
+	sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class AFPacketDriver(DriverBase):
+	"""Linux implementation of a driver (ip scanner). Uses a raw ``AF_PACKET`` socket with
+	a memory mapped ``TPACKET_V3`` ring: the kernel fills whole blocks of packets, so
+	the scanner only makes a syscall when there's nothing left to read.
+	Scans a set of server IPs for different connections and identifies them by local ip
+	and port.
+
+	Packets are only captured (they can't be blocked like with WinDivert). A BPF filter
+	drops the packets of other IPs, of the ignored connections and, if the connection
+	factory asks for it, the segments without payload in the kernel. It is replaced
+	(atomically) whenever one of them changes, so a single socket scans every server. The headers are read in place:
+	payloads are :class:`memoryview` of the ring that are only valid while they are
+	being parsed.
+
+	Parameters
+	----------
+	network: :class:`network.scanner.NetworkScanner`
+		The network scanner this driver belongs to to
+	ip: :class:`str`
+		The first ip to scan
+	connection: :class:`network.connection.Connection`
+		The connection factory used to represent a connection
+	interface: Optional[:class:`str`]
+		The interface to capture (``"lo"`` for example). None (default) captures all of them.
+	block_size: :class:`int`
+		The size of every ring block. Must be a multiple of the page size.
+	block_count: :class:`int`
+		The number of blocks in the ring
+	block_timeout: :class:`int`
+		Milliseconds after which the kernel hands a block that isn't full
+
+	Attributes
+	----------
+	network: :class:`network.scanner.NetworkScanner`
+		The network scanner this driver belongs to to
+	ip: :class:`str`
+		The first ip to scan
+	connection: :class:`network.connection.Connection`
+		The connection factory used to represent a connection
+	connections: :class:`network.flows.FlowTable`
+		The connections, by local address
+	servers: :class:`network.servers.ServerSet`
+		The server IPs and CIDR ranges being scanned
+	sock: :class:`socket.socket`
+		The packet socket
+	ring: :class:`mmap.mmap`
+		The memory mapped ring
+	"""
+	FRAME_SIZE = 2048
+
+	def __init__(self, network, ip, connection, interface=None,
+				block_size=1 << 20, block_count=16, block_timeout=10):
+		super().__init__(network, ip, connection)
+
+		self.block_size = block_size
+		self.block_count = block_count
+		self.closed = False
+
+		# SOCK_DGRAM removes the link layer header, so every packet starts with the
+		# IP header whatever the interface is.
+		self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+		self.update_filter()
+		if interface is not None:
+			self.sock.bind((interface, ETH_P_IP))
+
+		self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+		self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+			block_size, block_count,
+			self.FRAME_SIZE, block_size * block_count // self.FRAME_SIZE,
+			block_timeout, 0, 0
+		))
+		self.ring = mmap.mmap(
+			self.sock.fileno(), block_size * block_count,
+			mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE
+		)
+
+	def update_filter(self):
+		"""Replaces the BPF filter of the socket with one that matches the current servers
+		and exclusions. The kernel swaps it atomically. If there are too many exclusions
+		for a BPF program, the filter only matches the servers: the ignored connections
+		are then dropped by :meth:`scan`.
+		"""
+		servers = self.servers.networks()
+		try:
+			program = bpf_filter(servers, self.excluded_ports(), self.payload_only)
+		except ValueError:
+			program = bpf_filter(servers, (), self.payload_only)
+
+		try:
+			attach_filter(self.sock, program)
+		except OSError:
+			if not self.closed:
+				raise
+
+	def blocks(self):
+		"""Yields the ring blocks as soon as the kernel hands them, and gives them
+		back once they have been read.
+		:return: an iterator of :class:`memoryview`
+		"""
+		poll = select.poll()
+		poll.register(self.sock, select.POLLIN | select.POLLERR)
+		ring = memoryview(self.ring)
+
+		try:
+			index = 0
+			while not self.closed:
+				self.advance()
+
+				start = index * self.block_size
+				block = ring[start:start + self.block_size]
+
+				if not BLOCK_HEADER.unpack_from(block, BLOCK_STATUS)[0] & TP_STATUS_USER:
+					poll.poll(100)
+					continue
+
+				yield block
+
+				struct.pack_into("=I", block, BLOCK_STATUS, TP_STATUS_KERNEL)
+				block.release()
+				index = (index + 1) % self.block_count
+
+		finally:
+			ring.release()
+
+	def segments(self):
+		"""Yields the TCP segments from or to the scanned servers.
+		:return: an iterator of (source ip, source port, dest ip, dest port, outbound, fin, payload)
+			where the ips are packed
+		"""
+		servers = self.servers
+
+		for block in self.blocks():
+			_, count, offset = BLOCK_HEADER.unpack_from(block, BLOCK_STATUS)
+
+			for _ in range(count):
+				next_offset, _, _, snaplen, _, _, _, net = PACKET_HEADER.unpack_from(block, offset)
+				_, _, _, hatype, pkttype = SOCKADDR_LL.unpack_from(block, offset + SOCKADDR_LL_OFFSET)
+				frame = block[offset:offset + net + snaplen]
+				offset += next_offset
+
+				if pkttype == PACKET_OUTGOING and hatype == ARPHRD_LOOPBACK:
+					continue # the loopback interface shows every packet twice
+
+				segment = parse_tcp(frame, net)
+				if segment is None:
+					continue
+
+				src, dst, sport, dport, fin, payload = segment
+				# The ring may still hold packets that the previous filter accepted.
+				outbound = dst in servers
+				if not outbound and src not in servers:
+					continue
+
+				yield src, sport, dst, dport, outbound, fin, payload
+
+				payload.release()
+				frame.release()
+
+	def scan(self):
+		"""A loop that scans the ip until the scanner is closed.
+		"""
+		try:
+			for src, sport, dst, dport, outbound, fin, payload in self.segments():
+				conn = self.get_flow(src, sport, dst, dport, outbound)
+
+				if fin:
+					self.close_connection(conn)
+
+				elif conn.ignored:
+					continue
+
+				elif payload:
+					self.submit(conn, payload, outbound)
+
+		finally:
+			for conn in self.connections.values():
+				conn.close()
+
+			self.close()
+			try:
+				self.ring.close()
+			except BufferError: # a payload is still referenced
+				pass
+			self.sock.close()
+
+	def close(self):
+		"""Closes the scanner.
+		"""
+		self.closed = True
@@ -22,21 +22,64 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import time
+import socket
+import struct
+import threading
+import traceback
 
 from abc import ABC
+from collections import deque
+
+from tfmplugins.network.flows import FlowTable, flow_key
+from tfmplugins.network.ring import PayloadRing
+from tfmplugins.network.servers import ServerSet
+
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+IPPROTO_TCP = 6
+
+
+def parse_tcp(frame, ip):
+	"""Reads the headers of an IPv4 TCP segment in place.
+	:param frame: :class:`memoryview` the captured frame
+	:param ip: :class:`int` where the IPv4 header starts in the frame
+	:return: Optional[:class:`tuple`] (source ip, dest ip, source port, dest port, fin, payload)
+		where the ips are packed :class:`bytes` and the payload is a :class:`memoryview`
+		of the frame. None if it isn't a TCP segment.
+	"""
+	if len(frame) < ip + 20 or frame[ip] >> 4 != 4 or frame[ip + 9] != IPPROTO_TCP:
+		return None
+
+	total = struct.unpack_from(">H", frame, ip + 2)[0]
+	tcp = ip + (frame[ip] & 0x0f) * 4
+	if len(frame) < tcp + 20:
+		return None
+
+	sport, dport = struct.unpack_from(">HH", frame, tcp)
+	payload = tcp + (frame[tcp + 12] >> 4) * 4
+	return (
+		bytes(frame[ip + 12:ip + 16]),
+		bytes(frame[ip + 16:ip + 20]),
+		sport,
+		dport,
+		frame[tcp + 13] & TCP_FIN,
+		frame[payload:min(ip + total, len(frame))]
+	)
 
 
 class DriverBase(ABC):
 	"""Base implementation of a driver (ip scanner).
-	Scans a single IP for different connections and identifies them by local ip and port.
+	Scans a set of server IPs for different connections and identifies them by local ip
+	and port. The set starts with a single IP and can be updated while scanning.
 
 	Parameters
 	----------
 	network: :class:`network.scanner.NetworkScanner`
 		The network scanner this driver belongs to to
 	ip: :class:`str`
-		The ip to scan
+		The first ip to scan
 	connection: :class:`network.connection.Connection`
 		The connection factory used to represent a connection
 
@@ -45,18 +88,140 @@ class DriverBase(ABC):
 	network: :class:`network.scanner.NetworkScanner`
 		The network scanner this driver belongs to to
 	ip: :class:`str`
-		The ip to scan
+		The first ip to scan
 	connection: :class:`network.connection.Connection`
 		The connection factory used to represent a connection
-	connections: Dict[:class:`network.connection.Connection`]
-		The connection list
+	connections: :class:`network.flows.FlowTable`
+		The connections, by local address
+	servers: :class:`network.servers.ServerSet`
+		The server IPs and CIDR ranges being scanned
+	payloads: :class:`network.ring.PayloadRing`
+		The captured payloads waiting to be parsed by the loop
+	excluded: Dict[:class:`int`, :class:`int`]
+		The local ports the filter drops, by flow key
+	payload_only: :class:`bool`
+		Whether the filter drops the segments without payload (but not the SYN, FIN
+		and RST ones). Set by the connection factory.
 	"""
 	def __init__(self, network, ip, connection):
 		self.network = network
 		self.ip = ip
 		self.connection = connection
 
-		self.connections = {}
+		self.connections = FlowTable()
+		self.servers = ServerSet([ip])
+		self.payloads = PayloadRing(network.loop)
+
+		self.filter_lock = threading.RLock()
+		self.excluded = {}
+		self.ignoring = deque()
+		self.payload_only = getattr(connection, "payload_only", False)
+
+	def add_server(self, address, ttl=None):
+		"""Starts scanning another server IP or CIDR range with the same handle.
+		:param address: :class:`str` "ip" or "ip/prefix"
+		:param ttl: Optional[:class:`float`] seconds it is kept after its last connection.
+			None (default) keeps it until it is removed.
+		:return: :class:`bool` whether it wasn't already scanned
+		"""
+		if self.servers.add(address, ttl):
+			try:
+				self.rebuild_filter()
+			except Exception:
+				self.servers.discard(address)
+				raise
+			return True
+		return False
+
+	def remove_server(self, address):
+		"""Stops scanning a server IP or CIDR range.
+		:param address: :class:`str` "ip" or "ip/prefix"
+		"""
+		if self.servers.discard(address):
+			self.rebuild_filter()
+
+	def advance(self, now=None):
+		"""Evicts the expired flows and, once per tick, stops scanning the expired servers.
+		Called by the driver thread between packets.
+		:param now: Optional[:class:`float`] the current time (see :meth:`network.flows.FlowTable.advance`)
+		"""
+		# The wheel belongs to the driver thread: the loop only queues the flows it excludes.
+		while self.ignoring:
+			key, conn = self.ignoring.popleft()
+			self.connections.schedule(key, conn, self.connections.IGNORED_TIMEOUT)
+
+		if self.connections.advance(now):
+			if self.excluded:
+				self.include_evicted()
+
+			expired = self.expire()
+			if expired:
+				self.network.forget(self, expired)
+
+	def expire(self):
+		"""Stops scanning the servers that haven't had any connection for their ttl.
+		:return: List[:class:`str`] the expired servers
+		"""
+		active = {conn.remote[0] for conn in list(self.connections.values()) if not conn.closing}
+		expired = self.servers.expire(active)
+		if expired:
+			self.rebuild_filter()
+		return expired
+
+	def exclude(self, conn):
+		"""Makes the filter drop the segments of an ignored connection, so they don't
+		reach the driver at all. The rule is removed once its flow is evicted: since the
+		driver doesn't see the connection anymore, that happens
+		:attr:`network.flows.FlowTable.IGNORED_TIMEOUT` after it was excluded, and
+		a connection that is still open is ignored and excluded again.
+		If the filter can't be updated, the driver keeps capturing the connection and
+		skips its packets instead.
+		Called by :meth:`network.connection.Connection.ignore`.
+		:param conn: :class:`network.connection.Connection` the connection
+		"""
+		key = flow_key(*conn.local)
+		with self.filter_lock:
+			if key in self.excluded or self.connections.flows.get(key) is not conn:
+				return
+
+			self.excluded[key] = conn.local[1]
+			try:
+				self.rebuild_filter()
+			except Exception:
+				del self.excluded[key]
+				traceback.print_exc()
+				return
+			self.ignoring.append((key, conn))
+
+	def include_evicted(self):
+		"""Removes the exclusions of the flows that have been evicted."""
+		with self.filter_lock:
+			evicted = [key for key in self.excluded if key not in self.connections]
+			if evicted:
+				for key in evicted:
+					del self.excluded[key]
+				self.rebuild_filter()
+
+	def excluded_ports(self):
+		"""Returns the local ports the filter drops.
+		:return: List[:class:`int`]
+		"""
+		with self.filter_lock:
+			return sorted(set(self.excluded.values()))
+
+	def rebuild_filter(self):
+		"""Calls :meth:`update_filter` with the lock held, so concurrent changes (from
+		the driver thread and the loop) can't install an outdated filter.
+		"""
+		with self.filter_lock:
+			self.update_filter()
+
+	def update_filter(self):
+		"""Called when the server set or the exclusions change, so the driver can update
+		the filter of its handle (:attr:`servers`, :meth:`excluded_ports` and
+		:attr:`payload_only`). Drivers that filter every packet with :attr:`servers`
+		don't need it.
+		"""
 
 	def create_connection(self, network, local, remote):
 		"""Uses the connection factory to create and store a new connection
@@ -67,7 +232,8 @@ class DriverBase(ABC):
 		:return: :class:`network.connection.Connection`
 		"""
 		conn = self.connection(network, local, remote)
-		self.connections[local] = conn
+		conn.driver = self
+		self.connections.add(flow_key(*local), conn)
 		return conn
 
 	def get_connection(self, source, dest, outbound):
@@ -86,16 +252,66 @@ class DriverBase(ABC):
 			local = dest
 			remote = source
 
-		if local not in self.connections:
+		conn = self.connections.get(flow_key(*local))
+		if conn is None:
 			return self.create_connection(self.network, local, remote)
+		return conn
 
-		conn = self.connections[local]
-		if conn.closing and time.perf_counter() >= conn.closed_at:
-			del self.connections[local]
-			return self.create_connection(self.network, local, remote)
+	def get_flow(self, src, sport, dst, dport, outbound):
+		"""Same as :meth:`get_connection`, for drivers that read the headers in place: the
+		addresses are only converted when a connection is created.
+		:param src: :class:`bytes` the packed source ip
+		:param sport: :class:`int` the source port
+		:param dst: :class:`bytes` the packed dest ip
+		:param dport: :class:`int` the dest port
+		:param outbound: :class:`bool` whether the packet direction is outbound (True) or
+			inbound (False)
+		:return: :class:`network.connection.Connection`
+		"""
+		if outbound:
+			conn = self.connections.get(int.from_bytes(src, "big") << 16 | sport)
+		else:
+			conn = self.connections.get(int.from_bytes(dst, "big") << 16 | dport)
 
+		if conn is None:
+			source = (socket.inet_ntoa(src), sport)
+			dest = (socket.inet_ntoa(dst), dport)
+			if outbound:
+				return self.create_connection(self.network, source, dest)
+			return self.create_connection(self.network, dest, source)
 		return conn
 
+	def submit(self, conn, payload, outbound, timestamp=None):
+		"""Queues a payload to be parsed by its connection on the loop. Waits if the
+		loop is too far behind.
+		:param conn: :class:`network.connection.Connection` the connection
+		:param payload: :class:`bytes`, :class:`bytearray` or :class:`memoryview` the
+			payload. It is copied, so the driver can reuse its memory right after.
+		:param outbound: :class:`bool` whether the packet direction is outbound (True) or
+			inbound (False)
+		:param timestamp: Optional[:class:`float`] the :func:`time.time` when it was
+			captured. None (default) means now.
+		"""
+		self.payloads.put(conn, payload, outbound, timestamp)
+
+	def close_connection(self, conn):
+		"""Closes a connection (its TCP segment has the FIN flag set). It is evicted from
+		:attr:`connections` after a while.
+		:param conn: :class:`network.connection.Connection` the connection
+		"""
+		self.connections.close(flow_key(*conn.local))
+
+	def stats(self):
+		"""Returns the live, ignored, closing, created, evicted and excluded flows of this
+		driver, the payloads waiting to be parsed and how many times the ring was full.
+		:return: :class:`dict`
+		"""
+		stats = self.connections.stats()
+		stats["excluded"] = len(self.excluded)
+		stats["queued"] = len(self.payloads)
+		stats["ring_waits"] = self.payloads.waits
+		return stats
+
 	def scan(self):
 		"""A loop that scans the ip until the scanner is closed.
 		"""
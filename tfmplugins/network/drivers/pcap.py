@@ -0,0 +1,348 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import mmap
+import socket
+import struct
+import threading
+import time
+
+from tfmplugins.network.drivers.driver_base import DriverBase, parse_tcp
+
+
+PCAP_MAGIC = {
+	b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+	b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+	b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+	b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = b"\x0a\x0d\x0d\x0a"
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+
+class PcapFormatError(Exception):
+	"""Exception thrown when a capture file can't be read.
+	"""
+
+
+class ReplayClock:
+	"""Paces the replay of a capture. Every driver replaying the same capture should
+	share the same clock, so the connections opened later (bulles) stay in sync.
+
+	Parameters
+	----------
+	speed: :class:`float`
+		How many times faster than real time the capture is replayed. 1 replays it in
+		real time and 0 replays it as fast as possible.
+
+	Attributes
+	----------
+	speed: :class:`float`
+		How many times faster than real time the capture is replayed.
+	origin: Optional[:class:`tuple`]
+		The (capture timestamp, perf_counter) of the first replayed packet
+	"""
+	def __init__(self, speed=1.0):
+		self.speed = speed
+		self.origin = None
+		self.lock = threading.Lock()
+
+	def delay(self, timestamp):
+		"""Returns how many seconds to wait before replaying a packet.
+		:param timestamp: :class:`float` the packet timestamp in the capture
+		:return: :class:`float`
+		"""
+		if not self.speed:
+			return 0
+
+		with self.lock:
+			if self.origin is None:
+				self.origin = (timestamp, time.perf_counter())
+			first, start = self.origin
+
+		return start + (timestamp - first) / self.speed - time.perf_counter()
+
+
+def read_pcap(data):
+	"""Yields the packets of a pcap file.
+	:param data: :class:`memoryview` the file contents
+	:return: an iterator of (timestamp, linktype, :class:`memoryview`)
+	"""
+	order, resolution = PCAP_MAGIC[bytes(data[:4])]
+	linktype = struct.unpack_from(order + "I", data, 20)[0] & 0x0fffffff
+	record = struct.Struct(order + "IIII")
+
+	offset = 24
+	end = len(data) - record.size
+	while offset <= end:
+		seconds, fraction, length, _ = record.unpack_from(data, offset)
+		offset += record.size
+		yield seconds + fraction * resolution, linktype, data[offset:offset + length]
+		offset += length
+
+
+def read_pcapng(data):
+	"""Yields the packets of a pcapng file.
+	:param data: :class:`memoryview` the file contents
+	:return: an iterator of (timestamp, linktype, :class:`memoryview`)
+	"""
+	order = "<"
+	interfaces = []
+
+	offset = 0
+	while offset + 12 <= len(data):
+		block = bytes(data[offset:offset + 4])
+
+		if block == PCAPNG_SHB:
+			magic = bytes(data[offset + 8:offset + 12])
+			order = "<" if magic == b"\x4d\x3c\x2b\x1a" else ">"
+			interfaces = []
+
+		kind, length = struct.unpack_from(order + "II", data, offset)
+		if length < 12:
+			raise PcapFormatError("Invalid pcapng block length {} at {}".format(length, offset))
+		body = data[offset + 8:offset + length - 4]
+		offset += length
+
+		if kind == PCAPNG_IDB:
+			linktype = struct.unpack_from(order + "H", body)[0]
+			resolution = 1e-6
+
+			# options: look for if_tsresol (9)
+			pos = 8
+			while pos + 4 <= len(body):
+				code, size = struct.unpack_from(order + "HH", body, pos)
+				if code == 0:
+					break
+				if code == 9:
+					value = body[pos + 4]
+					resolution = 2 ** -(value & 0x7f) if value & 0x80 else 10 ** -value
+				pos += 4 + (size + 3) // 4 * 4
+
+			interfaces.append((linktype, resolution))
+
+		elif kind == PCAPNG_EPB:
+			interface, high, low, captured, _ = struct.unpack_from(order + "IIIII", body)
+			linktype, resolution = interfaces[interface]
+			yield ((high << 32) | low) * resolution, linktype, body[20:20 + captured]
+
+		elif kind == PCAPNG_SPB:
+			linktype, _ = interfaces[0]
+			yield None, linktype, body[4:]
+
+
+def ipv4_offset(linktype, frame):
+	"""Returns where the IPv4 header starts in a link layer frame.
+	:param linktype: :class:`int` the pcap link type
+	:param frame: :class:`memoryview` the frame
+	:return: Optional[:class:`int`] None if it isn't an IPv4 packet
+	"""
+	if linktype == LINKTYPE_ETHERNET:
+		offset, ethertype = 14, struct.unpack_from(">H", frame, 12)[0]
+		while ethertype in ETHERTYPE_VLAN:
+			ethertype = struct.unpack_from(">H", frame, offset + 2)[0]
+			offset += 4
+
+	elif linktype in LINKTYPE_RAW:
+		return 0 if frame[0] >> 4 == 4 else None
+
+	elif linktype == LINKTYPE_LINUX_SLL:
+		offset, ethertype = 16, struct.unpack_from(">H", frame, 14)[0]
+
+	elif linktype == LINKTYPE_LINUX_SLL2:
+		offset, ethertype = 20, struct.unpack_from(">H", frame, 0)[0]
+
+	elif linktype == LINKTYPE_NULL:
+		return 4 if frame[0] == socket.AF_INET or frame[3] == socket.AF_INET else None
+
+	else:
+		raise PcapFormatError("Unsupported link type {}".format(linktype))
+
+	return offset if ethertype == ETHERTYPE_IPV4 else None
+
+
+class PcapDriver(DriverBase):
+	"""Replays a pcap or pcapng capture file instead of scanning the network.
+	Scans a set of server IPs for different connections and identifies them by local ip
+	and port.
+
+	The file is memory mapped and parsed while it is replayed: headers are read in
+	place and payloads are passed to the connections as :class:`memoryview`.
+	Before skipping a segment of an unknown server, the driver waits for the queued
+	payloads to be parsed, in case they add it.
+	Give the scanner a factory like
+	``functools.partial(PcapDriver, path="session.pcapng", clock=ReplayClock(1.0))``.
+	The clock only needs to be shared when the scanner creates a driver per IP.
+
+	Parameters
+	----------
+	network: :class:`network.scanner.NetworkScanner`
+		The network scanner this driver belongs to to
+	ip: :class:`str`
+		The first ip to scan
+	connection: :class:`network.connection.Connection`
+		The connection factory used to represent a connection
+	path: :class:`str`
+		The capture file
+	speed: :class:`float`
+		How many times faster than real time the capture is replayed. 1 (default)
+		replays it in real time and 0 replays it as fast as possible.
+		Ignored if a clock is given.
+	clock: Optional[:class:`ReplayClock`]
+		The clock shared by the drivers replaying this capture
+
+	Attributes
+	----------
+	network: :class:`network.scanner.NetworkScanner`
+		The network scanner this driver belongs to to
+	ip: :class:`str`
+		The first ip to scan
+	connection: :class:`network.connection.Connection`
+		The connection factory used to represent a connection
+	connections: :class:`network.flows.FlowTable`
+		The connections, by local address
+	servers: :class:`network.servers.ServerSet`
+		The server IPs and CIDR ranges being scanned
+	path: :class:`str`
+		The capture file
+	clock: :class:`ReplayClock`
+		The clock pacing the replay
+	packets: :class:`int`
+		The number of packets read from the capture
+	segments: :class:`int`
+		The number of TCP segments of the scanned servers that have been replayed
+	"""
+	def __init__(self, network, ip, connection, path, speed=1.0, clock=None):
+		super().__init__(network, ip, connection)
+
+		self.path = path
+		self.clock = clock or ReplayClock(speed)
+
+		self.packets = 0
+		self.segments = 0
+		self.closed = threading.Event()
+
+	def read(self):
+		"""Yields the TCP segments from or to the scanned servers.
+		:return: an iterator of (timestamp, source ip, source port, dest ip, dest port, outbound,
+			fin, payload) where the ips are packed
+		"""
+		servers = self.servers
+
+		with open(self.path, "rb") as file:
+			data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		try:
+			view = memoryview(data)
+			if bytes(view[:4]) == PCAPNG_SHB:
+				records = read_pcapng(view)
+			elif bytes(view[:4]) in PCAP_MAGIC:
+				records = read_pcap(view)
+			else:
+				raise PcapFormatError("{} is not a pcap or pcapng file".format(self.path))
+
+			for timestamp, linktype, frame in records:
+				self.packets += 1
+
+				ip = ipv4_offset(linktype, frame)
+				segment = None if ip is None else parse_tcp(frame, ip)
+				if segment is None:
+					continue
+
+				src, dst, sport, dport, fin, payload = segment
+				outbound = dst in servers
+				if not outbound and src not in servers:
+					# The payloads being parsed may add this server: wait for them,
+					# since the replay is usually much faster than a real connection.
+					if not len(self.payloads) or not self.payloads.flush():
+						continue
+
+					outbound = dst in servers
+					if not outbound and src not in servers:
+						continue
+
+				yield timestamp, src, sport, dst, dport, outbound, fin, payload
+
+		finally:
+			try:
+				data.close()
+			except BufferError: # some payload is still referenced, let the GC close it
+				pass
+
+	def scan(self):
+		"""A loop that replays the capture until it ends or the scanner is closed.
+		"""
+		start = time.perf_counter()
+
+		try:
+			for timestamp, src, sport, dst, dport, outbound, fin, payload in self.read():
+				if timestamp is not None:
+					delay = self.clock.delay(timestamp)
+					if delay > 0:
+						self.closed.wait(delay)
+
+					# Flows expire in capture time, whatever the replay speed is.
+					self.advance(timestamp)
+
+				if self.closed.is_set():
+					break
+
+				self.segments += 1
+				conn = self.get_flow(src, sport, dst, dport, outbound)
+
+				if fin:
+					self.close_connection(conn)
+
+				elif conn.ignored:
+					continue
+
+				elif payload:
+					self.submit(conn, payload, outbound, timestamp)
+
+		finally:
+			for conn in self.connections.values():
+				conn.close()
+
+			self.close()
+
+			taken = time.perf_counter() - start
+			print("Replayed {} packets ({} TCP segments of {}) in {:.2f} seconds: {:.0f} packets/s".format(
+				self.packets, self.segments, ", ".join(self.servers), taken, self.packets / taken if taken else 0
+			))
+
+	def close(self):
+		"""Closes the scanner.
+		"""
+		self.closed.set()
@@ -24,21 +24,68 @@ SOFTWARE.
 
 import errno
 import socket
+import threading
 
 from pydivert import WinDivert
-from tfmplugins.network.drivers.driver_base import DriverBase
+from tfmplugins.network.drivers.driver_base import DriverBase, parse_tcp
+
+
+def windivert_filter(servers, excluded=(), payload_only=False):
+	"""Builds a WinDivert filter that matches the packets from or to some servers.
+	:param servers: :class:`network.servers.ServerSet` the servers
+	:param excluded: Iterable[:class:`int`] the local ports whose segments aren't diverted
+	:param payload_only: :class:`bool` whether to let the segments without payload
+		through, unless they open or close the connection (SYN, FIN or RST)
+	:return: :class:`str`
+	"""
+	clauses = []
+	for address, netmask in servers.networks():
+		if netmask == 0xffffffff:
+			ip = socket.inet_ntoa(address.to_bytes(4, "big"))
+			clauses.append("ip.DstAddr == {0} || ip.SrcAddr == {0}".format(ip))
+		else:
+			low = socket.inet_ntoa(address.to_bytes(4, "big"))
+			high = socket.inet_ntoa((address | (~netmask & 0xffffffff)).to_bytes(4, "big"))
+			clauses.append(
+				"(ip.DstAddr >= {0} && ip.DstAddr <= {1}) || (ip.SrcAddr >= {0} && ip.SrcAddr <= {1})"
+				.format(low, high)
+			)
+	if not clauses:
+		return "false"
+
+	# Other protocols are still diverted: closing the driver relies on a UDP packet.
+	rules = []
+	for port in sorted(set(excluded)):
+		rules.append("!(outbound && tcp.SrcPort == {0}) && !(inbound && tcp.DstPort == {0})".format(port))
+	if payload_only:
+		rules.append("(tcp.PayloadLength > 0 || tcp.Syn || tcp.Fin || tcp.Rst)")
+
+	if not rules:
+		return " || ".join(clauses)
+	return "({}) && (!tcp || ({}))".format(" || ".join(clauses), " && ".join(rules))
 
 
 class WinDivertDriver(DriverBase):
 	"""Base implementation of a driver (ip scanner). Uses WinDivert to do its job.
-	Scans a single IP for different connections and identifies them by local ip and port.
+	Scans a set of server IPs for different connections and identifies them by local ip
+	and port.
+
+	A WinDivert filter can't be changed, so when a server is added or removed, or a
+	connection is excluded, a handle with the new filter is opened before the previous
+	one is closed. Only one of them is used at a time. The segments of the excluded
+	connections and, if the connection factory asks for it, the ones without payload
+	aren't diverted at all.
+
+	The headers are read in place from the raw packet, and the flow table advances
+	once every ADVANCE_EVERY packets: WinDivert has no receive timeout, so when there
+	is no traffic, the flows and servers expire with the next packets.
 
 	Parameters
 	----------
 	network: :class:`network.scanner.NetworkScanner`
 		The network scanner this driver belongs to to
 	ip: :class:`str`
-		The ip to scan
+		The first ip to scan
 	connection: :class:`network.connection.Connection`
 		The connection factory used to represent a connection
 
@@ -47,45 +94,100 @@ class WinDivertDriver(DriverBase):
 	network: :class:`network.scanner.NetworkScanner`
 		The network scanner this driver belongs to to
 	ip: :class:`str`
-		The ip to scan
+		The first ip to scan
 	connection: :class:`network.connection.Connection`
 		The connection factory used to represent a connection
-	connections: Dict[:class:`network.connection.Connection`]
-		The connection list
+	connections: :class:`network.flows.FlowTable`
+		The connections, by local address
+	servers: :class:`network.servers.ServerSet`
+		The server IPs and CIDR ranges being scanned
 	w: :class:`pydivert.WinDivert`
 		The WinDivert instance
+	ADVANCE_EVERY: :class:`int`
+		The number of packets between two calls to :meth:`advance`
 	"""
+	ADVANCE_EVERY = 64
+
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 
-		self.w = WinDivert(
-			"ip.DstAddr == {0} || ip.SrcAddr == {0}".format(self.ip)
-		)
+		self.closed = False
+		self.lock = threading.Lock()
+		self.w = WinDivert(self.filter())
+
+	def filter(self):
+		"""Builds the filter of the current servers and exclusions."""
+		return windivert_filter(self.servers, self.excluded_ports(), self.payload_only)
+
+	def update_filter(self):
+		"""Replaces the WinDivert handle with one that matches the current servers and
+		exclusions.
+		"""
+		with self.lock:
+			if self.closed:
+				return
+
+			w = WinDivert(self.filter())
+			if not self.w.is_open: # not scanning yet
+				self.w = w
+				return
+
+			w.open()
+			old, self.w = self.w, w
+			try:
+				old.close()
+			except Exception:
+				pass
+
+	def send(self, w, packet):
+		"""Reinjects a packet with the handle that captured it. If that handle has been
+		replaced in the meantime, the packet is lost and TCP will send it again.
+		"""
+		try:
+			w.send(packet)
+		except OSError:
+			if w is self.w and not self.closed:
+				raise
 
 	def scan(self):
-		"""A loop that scans the ip until the scanner is closed.
+		"""A loop that scans the servers until the scanner is closed.
 		"""
 		try:
-			with self.w:
-				for packet in self.w:
-					conn = self.get_connection(
-						(packet.src_addr, packet.src_port),
-						(packet.dst_addr, packet.dst_port),
-						packet.is_outbound
-					)
-
-					if packet.tcp.fin:
-						conn.close()
-
-					elif conn.ignored:
-						self.w.send(packet)
+			with self.lock:
+				self.w.open()
+
+			received = 0
+			while not self.closed:
+				w = self.w
+				try:
+					packet = w.recv()
+				except OSError:
+					if w is not self.w or self.closed: # replaced or closed
 						continue
+					raise
+
+				received += 1
+				if received == self.ADVANCE_EVERY:
+					received = 0
+					self.advance()
+
+				segment = parse_tcp(packet.raw, 0)
+				if segment is None: # not IPv4 TCP
+					self.send(w, packet)
+					continue
 
-					elif packet.payload:
-						if not conn.parse_packet(packet.payload, packet.is_outbound):
-							continue
+				src, dst, sport, dport, fin, payload = segment
+				outbound = packet.is_outbound
+				conn = self.get_flow(src, sport, dst, dport, outbound)
 
-					self.w.send(packet)
+				if fin:
+					self.close_connection(conn)
+
+				elif payload and not conn.ignored:
+					self.submit(conn, payload, outbound)
+
+				payload.release()
+				self.send(w, packet)
 
 		except OSError as e:
 			if e.errno == errno.EACCES: # Missing privileges
@@ -103,14 +205,21 @@ class WinDivertDriver(DriverBase):
 	def close(self):
 		"""Closes the scanner.
 		"""
-		if self.w.is_open:
-			try:
-				self.w.close()
-			except Exception:
-				pass
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+
+			scanning = self.w.is_open
+			if scanning:
+				try:
+					self.w.close()
+				except Exception:
+					pass
 
+		if scanning:
 			# If the thread is stuck waiting for a packet, this will
 			# make it detect a new packet, so it will end. This is
 			# sent using UDP to make it quicker.
 			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-			sock.sendto(b"\x00", (self.ip, 6666))
\ No newline at end of file
+			sock.sendto(b"\x00", (self.ip, 6666))
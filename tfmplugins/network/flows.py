@@ -0,0 +1,218 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import socket
+import time
+
+
+def flow_key(ip, port):
+	"""Packs an address in a single integer.
+	:param ip: :class:`bytes` the packed IPv4 address, or :class:`str`
+	:param port: :class:`int` the port
+	:return: :class:`int`
+	"""
+	if isinstance(ip, str):
+		ip = socket.inet_aton(ip)
+	return int.from_bytes(ip, "big") << 16 | port
+
+
+class FlowTable:
+	"""The connections of a driver, indexed by their packed local address (see :func:`flow_key`).
+
+	A timer wheel evicts the flows that are closed, ignored or idle for long enough.
+	Lookups only store the current tick: the wheel checks a flow when its deadline
+	comes and schedules it again if it has been seen since. The wheel moves when
+	:meth:`advance` is called, which the drivers do once per batch of packets (a ring
+	block for AF_PACKET, ``ADVANCE_EVERY`` packets for WinDivert) or, for a replay,
+	with the capture timestamps.
+
+	Attributes
+	----------
+	TICK: :class:`float`
+		Seconds per wheel slot
+	SLOTS: :class:`int`
+		The number of wheel slots. Longer deadlines take several turns.
+	CLOSED_TIMEOUT: :class:`float`
+		Seconds a closed flow is kept, so its last packets are still ignored
+	IGNORED_TIMEOUT: :class:`float`
+		Seconds an ignored flow is kept after its last packet
+	IDLE_TIMEOUT: :class:`float`
+		Seconds any other flow is kept after its last packet
+	flows: Dict[:class:`int`, :class:`network.connection.Connection`]
+		The connections, by key
+	seen: Dict[:class:`int`, :class:`int`]
+		The tick when every flow has last been seen
+	closed: Dict[:class:`int`, :class:`int`]
+		The tick when the closing flows have been closed
+	tick: :class:`int`
+		The current tick
+	created: :class:`int`
+		The number of flows that have been added
+	evicted: :class:`int`
+		The number of flows that have been evicted
+	"""
+	TICK = 1.0
+	SLOTS = 64
+	CLOSED_TIMEOUT = 1.0
+	IGNORED_TIMEOUT = 30.0
+	IDLE_TIMEOUT = 300.0
+
+	def __init__(self):
+		self.flows = {}
+		self.seen = {}
+		self.closed = {}
+		self.wheel = [[] for _ in range(self.SLOTS)]
+
+		self.origin = None
+		self.tick = 0
+
+		self.created = 0
+		self.evicted = 0
+
+	def __len__(self):
+		return len(self.flows)
+
+	def __contains__(self, key):
+		return key in self.flows
+
+	def values(self):
+		return self.flows.values()
+
+	def get(self, key):
+		"""Gets a connection and marks it as seen.
+		:param key: :class:`int` the flow key
+		:return: Optional[:class:`network.connection.Connection`]
+		"""
+		conn = self.flows.get(key)
+		if conn is not None:
+			self.seen[key] = self.tick
+		return conn
+
+	def add(self, key, conn):
+		"""Adds a connection, replacing the previous one with the same key.
+		:param key: :class:`int` the flow key
+		:param conn: :class:`network.connection.Connection` the connection
+		"""
+		self.flows[key] = conn
+		self.seen[key] = self.tick
+		self.closed.pop(key, None)
+		self.created += 1
+		self.schedule(key, conn, self.IDLE_TIMEOUT)
+
+	def close(self, key):
+		"""Closes a connection and schedules its eviction.
+		:param key: :class:`int` the flow key
+		"""
+		conn = self.flows.get(key)
+		if conn is None or key in self.closed:
+			return
+
+		conn.close()
+		self.closed[key] = self.tick
+		self.schedule(key, conn, self.CLOSED_TIMEOUT)
+
+	def schedule(self, key, conn, delay):
+		ticks = max(1, -int(-delay // self.TICK))
+		deadline = self.tick + ticks
+		self.wheel[deadline % self.SLOTS].append((deadline, key, conn))
+
+	def advance(self, now=None):
+		"""Moves the wheel to the current time and evicts the expired flows.
+		:param now: Optional[:class:`float`] the current time, in seconds. Defaults to
+			:func:`time.monotonic`, but a replay can pass its capture timestamps.
+		:return: :class:`bool` whether the wheel has moved
+		"""
+		if now is None:
+			now = time.monotonic()
+		if self.origin is None:
+			self.origin = now
+
+		target = int((now - self.origin) // self.TICK)
+		if target <= self.tick:
+			return False
+
+		if target - self.tick >= self.SLOTS:
+			# A long jump: every slot is due at once.
+			entries = [entry for slot in self.wheel for entry in slot]
+			self.wheel = [[] for _ in range(self.SLOTS)]
+			self.tick = target
+			self.check(entries)
+			return True
+
+		while self.tick < target:
+			self.tick += 1
+			index = self.tick % self.SLOTS
+			entries, self.wheel[index] = self.wheel[index], []
+			self.check(entries)
+		return True
+
+	def check(self, entries):
+		tick = self.tick
+		for deadline, key, conn in entries:
+			if deadline > tick: # due in a later turn
+				self.wheel[deadline % self.SLOTS].append((deadline, key, conn))
+				continue
+
+			if self.flows.get(key) is not conn: # already replaced
+				continue
+
+			if key in self.closed:
+				since, timeout = self.closed[key], self.CLOSED_TIMEOUT
+			elif conn.ignored:
+				since, timeout = self.seen[key], self.IGNORED_TIMEOUT
+			else:
+				since, timeout = self.seen[key], self.IDLE_TIMEOUT
+
+			# The flow may have been seen at the very end of its tick.
+			left = (since + 1 - tick) * self.TICK + timeout
+			if left > 0:
+				self.schedule(key, conn, left)
+			else:
+				self.evict(key)
+
+	def evict(self, key):
+		"""Removes a connection, closing it if needed.
+		:param key: :class:`int` the flow key
+		"""
+		conn = self.flows.pop(key)
+		self.seen.pop(key, None)
+		self.closed.pop(key, None)
+		self.evicted += 1
+
+		if not conn.closing:
+			conn.close()
+
+	def stats(self):
+		"""Returns how many flows are live, ignored and closing, and how many have
+		been created and evicted.
+		:return: :class:`dict`
+		"""
+		flows = list(self.flows.values())
+		return {
+			"live": len(flows),
+			"ignored": sum(conn.ignored and not conn.closing for conn in flows),
+			"closing": sum(conn.closing for conn in flows),
+			"created": self.created,
+			"evicted": self.evicted,
+		}
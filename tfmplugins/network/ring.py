@@ -0,0 +1,209 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import threading
+import time
+import traceback
+
+from tfmplugins.utils.metrics import metrics
+
+
+class PayloadRing:
+	"""Hands the captured payloads of a driver thread over to the event loop.
+
+	A single producer, single consumer ring of preallocated slots: the driver thread
+	only copies the payload into the next slot, and the loop parses the queued
+	payloads in order, BATCH_SIZE at a time. Framing, the connection state and the
+	client state are only touched by the loop, like the plugins.
+
+	Each side only writes its own position, so the ring doesn't need a lock. The loop
+	is only woken up when it isn't already draining the ring, and the driver thread
+	waits when the ring is full, since dropping a payload would break the framing
+	of its connection. The loop stops draining while a connection isn't ready for
+	more payloads (:meth:`network.connection.Connection.ready`), so slow consumers
+	push back on the driver instead of piling the packets up in memory.
+
+	Parameters
+	----------
+	loop: event loop
+		The loop that parses the payloads
+	slots: :class:`int`
+		The number of slots
+	slot_size: :class:`int`
+		The size of every slot. Larger payloads are copied to a new buffer instead.
+
+	Attributes
+	----------
+	head: :class:`int`
+		The number of payloads put (only written by the driver thread)
+	tail: :class:`int`
+		The number of payloads parsed (only written by the loop)
+	waits: :class:`int`
+		The number of times the driver thread had to wait for a free slot
+	paused: :class:`bool`
+		Whether the loop is waiting for a connection to be ready
+	"""
+	SLOTS = 1024
+	SLOT_SIZE = 2048
+	BATCH_SIZE = 256
+
+	def __init__(self, loop, slots=SLOTS, slot_size=SLOT_SIZE):
+		self.loop = loop
+		self.slots = slots
+		self.slot_size = slot_size
+
+		self.buffers = [memoryview(bytearray(slot_size)) for _ in range(slots)]
+		self.large = [None] * slots
+		self.conns = [None] * slots
+		self.sizes = [0] * slots
+		self.outbound = [False] * slots
+		self.stamps = [0] * slots
+		self.times = [0.0] * slots
+
+		self.head = 0
+		self.tail = 0
+		self.waits = 0
+
+		self.scheduled = False
+		self.paused = False
+		self.space = threading.Event()
+		self.closed = False
+
+	def __len__(self):
+		return self.head - self.tail
+
+	def put(self, conn, payload, outbound, timestamp=None):
+		"""Queues a payload to be parsed by its connection. Called by the driver thread.
+		:param conn: :class:`network.connection.Connection` the connection
+		:param payload: :class:`bytes`, :class:`bytearray` or :class:`memoryview` the
+			payload. It is copied, so it can be released right after.
+		:param outbound: :class:`bool` whether the packet direction is outbound
+		:param timestamp: Optional[:class:`float`] the :func:`time.time` when the payload
+			was captured. None (default) uses the current time.
+		:return: :class:`bool` False if the ring has been closed or the loop has stopped
+			while waiting for a free slot
+		"""
+		head = self.head
+		while head - self.tail >= self.slots:
+			if self.closed or not self.loop.is_running():
+				return False
+
+			self.waits += 1
+			self.space.clear()
+			if head - self.tail >= self.slots:
+				self.space.wait(0.1)
+
+		index = head % self.slots
+		size = len(payload)
+		if size <= self.slot_size:
+			self.buffers[index][:size] = payload
+			self.large[index] = None
+		else:
+			self.large[index] = bytes(payload)
+
+		self.conns[index] = conn
+		self.sizes[index] = size
+		self.outbound[index] = outbound
+		self.stamps[index] = time.perf_counter_ns() if metrics.enabled else 0
+		self.times[index] = time.time() if timestamp is None else timestamp
+		self.head = head + 1
+
+		if not self.scheduled:
+			self.scheduled = True
+			self.loop.call_soon_threadsafe(self.drain)
+		return True
+
+	def flush(self):
+		"""Waits until every payload put so far has been parsed. Called by the driver thread.
+		:return: :class:`bool` False if the ring has been closed or the loop has stopped
+		"""
+		target = self.head
+		while self.tail < target:
+			if self.closed or not self.loop.is_running():
+				return False
+
+			self.space.clear()
+			if self.tail < target:
+				self.space.wait(0.1)
+		return True
+
+	def drain(self):
+		"""Parses up to BATCH_SIZE payloads, and schedules itself again if there are more.
+		Stops early if a connection isn't ready: it schedules the drain once it is.
+		Always called from the loop.
+		"""
+		tail = self.tail
+		end = min(self.head, tail + self.BATCH_SIZE)
+
+		try:
+			while tail < end:
+				index = tail % self.slots
+				conn = self.conns[index]
+
+				# A connection ignored by a previous payload drops the next ones, but a
+				# closing one still parses the payloads captured before its FIN.
+				if not conn.ignored or conn.closing:
+					if not conn.ready(self.resume):
+						self.paused = True
+						return
+
+					payload = self.large[index]
+					if payload is None:
+						payload = self.buffers[index][:self.sizes[index]]
+
+					conn.captured_at = self.stamps[index]
+					conn.capture_time = self.times[index]
+					try:
+						conn.parse_packet(payload, self.outbound[index])
+					except Exception:
+						conn.ignore()
+						traceback.print_exc()
+
+				self.conns[index] = None
+				tail += 1
+				self.tail = tail
+				self.space.set()
+
+		finally:
+			if self.paused:
+				pass # still scheduled: resume drains the ring again
+
+			elif self.tail < self.head:
+				self.loop.call_soon(self.drain)
+			else:
+				self.scheduled = False
+				# A payload may have been put right before the flag was cleared
+				if self.tail < self.head and not self.scheduled:
+					self.scheduled = True
+					self.loop.call_soon(self.drain)
+
+	def resume(self):
+		"""Drains the ring again once the connection it was waiting for is ready."""
+		self.paused = False
+		self.loop.call_soon(self.drain)
+
+	def close(self):
+		"""Stops waiting for free slots. The queued payloads are still parsed."""
+		self.closed = True
+		self.space.set()
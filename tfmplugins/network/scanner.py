@@ -22,15 +22,25 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import traceback
+import asyncio
+import threading
 import time
+import traceback
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 
 
 class NetworkScanner:
 	"""A simple network scanner. Handles all the IP scanners
 
+	By default, a single driver (one capture handle and one thread) scans every IP:
+	new IPs are added to its server set and the ones added with a ttl are removed once
+	they haven't had any connection for that long.
+
+	Every driver thread is supervised: when a driver crashes, its traceback is printed
+	right away and a new driver, scanning the same servers, is started after a delay
+	that doubles with every consecutive crash.
+
 	.. _executor: https://docs.python.org/3/library/concurrent.futures.html#executor-objects
 
 	Parameters
@@ -42,6 +52,18 @@ class NetworkScanner:
 	pool: Optional[executor]
 		The `executor`_ to use for every driver thread. If ``None`` is passed (default),
 		the pool used will be ``concurrent.futures.ThreadPoolExecutor()``
+	shared: :class:`bool`
+		Whether a single driver scans every IP (True, default) or every IP gets its own
+		driver (False)
+	restart: :class:`bool`
+		Whether to restart the drivers that crash (default True)
+	backoff: :class:`float`
+		Seconds before the first restart of a driver
+	max_backoff: :class:`float`
+		The maximum seconds between two restarts. A driver that has been running for
+		that long is considered stable again, and its next restart starts from ``backoff``.
+	loop: Optional[event loop]
+		The event loop that parses the captured payloads. Defaults to the current one.
 
 	Attributes
 	----------
@@ -52,76 +74,225 @@ class NetworkScanner:
 	pool: executor
 		The `executor`_ to use for every driver thread. If ``None`` is passed (default),
 		the pool used will be ``concurrent.futures.ThreadPoolExecutor()``
-	futures: List[:class:`concurrent.futures.Future`]
-		A list of futures created by this scanner that are running in the pool.
+	shared: :class:`bool`
+		Whether a single driver scans every IP
+	loop: event loop
+		The event loop that parses the captured payloads
+	futures: Dict[:class:`concurrent.futures.Future`, :class:`network.drivers.driver_base.DriverBase`]
+		The futures created by this scanner that are running in the pool, and their driver
 	scanners: Dict[:class:`network.drivers.driver_base.DriverBase`]
-		A dictionary with all the ip scanners
+		The driver scanning every ip, by ip
+	supervised: Dict[:class:`str`, :class:`dict`]
+		The start time, restart count and pending restart timer of every driver,
+		by the first ip it scanned
 	running: :class:`bool`
 		Whether the network scanner is running or not
 	"""
-	def __init__(self, driver, connection, pool=None):
+	def __init__(self, driver, connection, pool=None, shared=True,
+				restart=True, backoff=1.0, max_backoff=60.0, loop=None):
 		self.pool = pool or ThreadPoolExecutor()
+		self.loop = loop or asyncio.get_event_loop()
 
 		self.scanner = driver
 		self.connection = connection
+		self.shared = shared
+
+		self.restart = restart
+		self.backoff = backoff
+		self.max_backoff = max_backoff
 
-		self.futures = []
+		self.lock = threading.RLock()
+		self.futures = {}
 		self.scanners = {}
+		self.supervised = {}
 		self.running = True
 
-		self.pool.submit(self._watch_pool)
+	def start(self, scanner):
+		"""Runs a driver in the pool and supervises it.
+		:param scanner: :class:`network.drivers.driver_base.DriverBase` the driver
+		"""
+		state = self.supervised.setdefault(scanner.ip, {"restarts": 0, "delay": self.backoff, "timer": None})
+		state["started"] = time.monotonic()
+		state["driver"] = scanner
+
+		future = self.pool.submit(scanner.scan)
+		self.futures[future] = scanner
+		future.add_done_callback(self._done)
 
-	def _watch_pool(self):
-		"""A loop that watches all the futures added by this instance to the pool
-		If one of them throws an exception, it will be printed.
+	def _done(self, future):
+		"""Called (in the driver thread) when a driver stops. Prints its traceback and
+		schedules its restart if it crashed.
 		"""
-		while self.running:
-			to_remove = []
+		with self.lock:
+			scanner = self.futures.pop(future)
+			error = None if future.cancelled() else future.exception()
+			state = self.supervised[scanner.ip]
 
-			for future in self.futures:
-				if future.done():
-					try:
-						future.result()
-					except Exception:
-						traceback.print_exc()
+			if error is None or not self.restart:
+				# It won't scan anything anymore.
+				for ip, other in list(self.scanners.items()):
+					if other is scanner:
+						del self.scanners[ip]
 
-					to_remove.append(future)
+				if error is None:
+					return
 
-			for future in to_remove:
-				self.futures.remove(future)
+			traceback.print_exception(type(error), error, error.__traceback__)
+			if not self.running or not self.restart or state["driver"] is not scanner:
+				return
 
-			time.sleep(1)
+			if time.monotonic() - state["started"] >= self.max_backoff:
+				state["delay"] = self.backoff # it was stable
+			self._schedule(scanner)
 
-	def stop(self):
-		"""Stops the network scanner and closes all the ip scanners.
+	def _schedule(self, crashed):
+		"""Restarts a crashed driver after its backoff delay, and doubles the delay.
 		"""
-		if not self.running:
-			return
+		state = self.supervised[crashed.ip]
+		delay = state["delay"]
+		state["delay"] = min(delay * 2, self.max_backoff)
+		print("Driver for {} crashed, restarting it in {:.1f} seconds".format(crashed.ip, delay))
+
+		state["timer"] = threading.Timer(delay, self._restart, (crashed,))
+		state["timer"].daemon = True
+		state["timer"].start()
 
-		for scanner in self.scanners.values():
+	def _restart(self, crashed):
+		"""Replaces a crashed driver with a new one that scans the same servers.
+		"""
+		with self.lock:
+			state = self.supervised[crashed.ip]
+			state["timer"] = None
+			if not self.running or state["driver"] is not crashed:
+				return
+
+			try:
+				scanner = self.scanner(self, crashed.ip, self.connection)
+			except Exception:
+				traceback.print_exc()
+				self._schedule(crashed)
+				return
+
+			scanner.servers = crashed.servers
+			scanner.rebuild_filter()
+			state["restarts"] += 1
+
+			for ip, other in list(self.scanners.items()):
+				if other is crashed:
+					self.scanners[ip] = scanner
+			self.start(scanner)
+
+	def forget(self, scanner, ips):
+		"""Called by a driver when some of its servers expired.
+		:param scanner: :class:`network.drivers.driver_base.DriverBase` the driver
+		:param ips: List[:class:`str`] the expired servers
+		"""
+		with self.lock:
+			for ip in ips:
+				print("Stopped scanning {}".format(ip))
+				if self.scanners.get(ip) is scanner:
+					del self.scanners[ip]
+
+		if not scanner.servers:
 			scanner.close()
-		self.scanners = {}
 
-		self.running = False
+	def drivers(self):
+		"""Returns every driver (capture handle) of this scanner.
+		:return: List[:class:`network.drivers.driver_base.DriverBase`]
+		"""
+		return list({id(scanner): scanner for scanner in list(self.scanners.values())}.values())
+
+	def status(self):
+		"""Returns the uptime and restart count of every driver, by the first ip it scanned.
+		:return: Dict[:class:`str`, :class:`dict`]
+		"""
+		now = time.monotonic()
+		with self.lock:
+			running = set(map(id, self.futures.values()))
+			return {
+				ip: {
+					"running": id(state["driver"]) in running,
+					"uptime": now - state["started"] if id(state["driver"]) in running else 0.0,
+					"restarts": state["restarts"],
+					"servers": list(state["driver"].servers),
+				}
+				for ip, state in self.supervised.items()
+			}
+
+	def stats(self):
+		"""Returns how many capture handles and threads the scanner holds, the
+		IPs being scanned and the flows of every driver, added together.
+		:return: :class:`dict`
+		"""
+		drivers = self.drivers()
+		flows = {}
+		for scanner in drivers:
+			for name, value in scanner.stats().items():
+				flows[name] = flows.get(name, 0) + value
+
+		return {
+			"handles": len(drivers),
+			"threads": len(self.futures),
+			"servers": list(self.scanners),
+			"flows": flows,
+		}
+
+	def stop(self, timeout=5.0):
+		"""Stops the network scanner and closes all the ip scanners.
+		:param timeout: Optional[:class:`float`] seconds to wait for the driver threads to end
+		:return: :class:`bool` whether every driver thread has ended
+		"""
+		with self.lock:
+			if not self.running:
+				return not self.futures
+			self.running = False
+
+			for state in self.supervised.values():
+				if state["timer"] is not None:
+					state["timer"].cancel()
+
+			for scanner in self.drivers():
+				scanner.close()
+			self.scanners = {}
+
+			futures = list(self.futures)
 
-	def add(self, ip):
-		"""Creates a new ip scanner (if needed) and returns it.
-		:param ip: :class:`str` the ip to scan.
+		_, pending = wait(futures, timeout)
+		return not pending
+
+	def add(self, ip, ttl=None):
+		"""Starts scanning an ip (if needed) and returns its scanner.
+		:param ip: :class:`str` the ip (or "ip/prefix" range) to scan.
+		:param ttl: Optional[:class:`float`] seconds after its last connection when the
+			ip stops being scanned. None (default) scans it until it is removed.
+			Only used when the driver is shared.
 		:return: :class:`network.drivers.driver_base.DriverBase`
 		"""
-		if ip not in self.scanners:
-			print("New scanner for {}".format(ip))
-			scanner = self.scanner(self, ip, self.connection)
-			self.futures.append(self.pool.submit(scanner.scan))
+		with self.lock:
+			if self.shared and self.scanners:
+				scanner = self.drivers()[0]
+				if scanner.add_server(ip, ttl):
+					print("Scanning {} with the same handle".format(ip))
+				self.scanners[ip] = scanner
+
+			elif ip not in self.scanners:
+				print("New scanner for {}".format(ip))
+				scanner = self.scanner(self, ip, self.connection)
+				# Its thread may add an ip (a bulle) before this returns.
+				self.scanners[ip] = scanner
+				self.start(scanner)
 
-			self.scanners[ip] = scanner
-		return self.scanners[ip]
+			return self.scanners[ip]
 
 	def remove(self, ip):
-		"""Closes and removes an ip scanner.
+		"""Stops scanning an ip, and closes its scanner if it was the last one.
 		"""
-		if ip not in self.scanners:
-			return
+		with self.lock:
+			if ip not in self.scanners:
+				return
 
-		self.scanners[ip].close()
-		del self.scanners[ip]
\ No newline at end of file
+			scanner = self.scanners.pop(ip)
+			scanner.remove_server(ip)
+
+		if not scanner.servers:
+			scanner.close()
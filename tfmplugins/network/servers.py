@@ -0,0 +1,173 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import ipaddress
+import threading
+import time
+
+
+class ServerSet:
+	"""A set of server IPs and CIDR ranges that can be updated while a driver is using it.
+	Entries may expire: they are kept as long as they have active connections, and
+	removed ``ttl`` seconds after their last one.
+
+	Lookups don't take the lock: updates replace the dictionaries instead of modifying
+	them, so a driver thread always sees a consistent set.
+
+	Attributes
+	----------
+	addresses: Dict[:class:`bytes`, :class:`str`]
+		The exact IPs, packed, with their text form
+	ranges: List[:class:`ipaddress.IPv4Network`]
+		The CIDR ranges
+	deadlines: Dict[:class:`str`, :class:`tuple`]
+		(ttl, deadline) of the entries that expire, by address
+	version: :class:`int`
+		Incremented on every change, so drivers know when to rebuild their filter
+	"""
+	def __init__(self, addresses=()):
+		self.lock = threading.Lock()
+		self.addresses = {}
+		self.ranges = []
+		self.deadlines = {}
+		self.version = 0
+
+		for address in addresses:
+			self.add(address)
+
+	def __contains__(self, packed):
+		if packed in self.addresses:
+			return True
+
+		if self.ranges:
+			address = ipaddress.IPv4Address(packed)
+			return any(address in network for network in self.ranges)
+		return False
+
+	def __len__(self):
+		return len(self.addresses) + len(self.ranges)
+
+	def __iter__(self):
+		return iter(list(self.addresses.values()) + [str(network) for network in self.ranges])
+
+	def add(self, address, ttl=None):
+		"""Adds an IP or a CIDR range. Adding an existing entry refreshes its deadline.
+		:param address: :class:`str` "ip" or "ip/prefix"
+		:param ttl: Optional[:class:`float`] seconds the entry is kept after its last
+			connection. None (default) keeps it forever. A ttl never makes a permanent
+			entry expire.
+		:return: :class:`bool` whether the entry is new
+		"""
+		with self.lock:
+			exists = self._has(address)
+			if ttl is None:
+				if address in self.deadlines:
+					self.deadlines = dict(self.deadlines)
+					del self.deadlines[address]
+
+			elif address in self.deadlines or not exists:
+				self.deadlines = dict(self.deadlines)
+				self.deadlines[address] = (ttl, time.monotonic() + ttl)
+
+			if exists:
+				return False
+
+			if "/" in address:
+				self.ranges = self.ranges + [ipaddress.IPv4Network(address, strict=False)]
+			else:
+				addresses = dict(self.addresses)
+				addresses[ipaddress.IPv4Address(address).packed] = address
+				self.addresses = addresses
+
+			self.version += 1
+			return True
+
+	def _has(self, address):
+		if "/" in address:
+			return ipaddress.IPv4Network(address, strict=False) in self.ranges
+		return ipaddress.IPv4Address(address).packed in self.addresses
+
+	def discard(self, address):
+		"""Removes an IP or a CIDR range.
+		:param address: :class:`str` "ip" or "ip/prefix"
+		:return: :class:`bool` whether it was in the set
+		"""
+		with self.lock:
+			if not self._has(address):
+				return False
+
+			if "/" in address:
+				network = ipaddress.IPv4Network(address, strict=False)
+				self.ranges = [other for other in self.ranges if other != network]
+			else:
+				addresses = dict(self.addresses)
+				del addresses[ipaddress.IPv4Address(address).packed]
+				self.addresses = addresses
+
+			if address in self.deadlines:
+				self.deadlines = dict(self.deadlines)
+				del self.deadlines[address]
+
+			self.version += 1
+			return True
+
+	def expire(self, active):
+		"""Refreshes the entries with active connections and removes the expired ones.
+		A CIDR range is active when any of the IPs it contains is.
+		:param active: Set[:class:`str`] the remote IPs with active connections
+		:return: List[:class:`str`] the removed entries
+		"""
+		now = time.monotonic()
+		expired = []
+		hosts = None
+
+		for address, (ttl, deadline) in list(self.deadlines.items()):
+			if "/" in address:
+				if hosts is None:
+					hosts = [ipaddress.IPv4Address(ip) for ip in active]
+				network = ipaddress.IPv4Network(address, strict=False)
+				live = any(host in network for host in hosts)
+			else:
+				live = address in active
+
+			if live:
+				with self.lock:
+					if address in self.deadlines:
+						self.deadlines = dict(self.deadlines)
+						self.deadlines[address] = (ttl, now + ttl)
+
+			elif now >= deadline:
+				self.discard(address)
+				expired.append(address)
+
+		return expired
+
+	def networks(self):
+		"""Returns every entry as an (address, netmask) pair of big endian :class:`int`,
+		which is what packet filters need.
+		:return: List[:class:`tuple`]
+		"""
+		networks = [(int.from_bytes(packed, "big"), 0xffffffff) for packed in self.addresses]
+		networks.extend((int(network.network_address), int(network.netmask)) for network in self.ranges)
+		return networks
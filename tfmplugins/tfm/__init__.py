@@ -22,6 +22,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from tfmplugins.tfm.builder import PacketBuilder
 from tfmplugins.tfm.client import TFMClient
 from tfmplugins.tfm.network import TFMConnection, main_ip
-from tfmplugins.tfm.packet import Packet
\ No newline at end of file
+from tfmplugins.tfm.packet import Packet
+from tfmplugins.tfm.recorder import SessionReader, SessionRecorder
+from tfmplugins.tfm.schema import PacketRegistry, PacketSchema, registry
+from tfmplugins.tfm.state import GameState, GameStateModel
\ No newline at end of file
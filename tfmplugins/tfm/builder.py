@@ -0,0 +1,246 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import struct
+
+from tfmplugins.tfm.packet import Packet
+
+
+u8 = struct.Struct(">B")
+u16 = struct.Struct(">H")
+u32 = struct.Struct(">I")
+
+structs = {}
+
+
+class PacketBuilder:
+	"""Builds packets in a preallocated buffer. Every write is a single
+	:func:`struct.pack_into` at the current offset, and the buffer only grows
+	(doubling) when it runs out of space.
+
+	The body starts after some headroom, so :meth:`frame` can write the varint length
+	prefix and the fingerprint right before it, without moving the body.
+	Builders come from a pool: ``with PacketBuilder.acquire() as builder: ...``
+	gives it back when done.
+
+	Parameters
+	----------
+	capacity: :class:`int`
+		The initial size of the body
+
+	Attributes
+	----------
+	HEADROOM: :class:`int`
+		The bytes reserved before the body: up to 5 for the length and 1 for the fingerprint
+	POOL_SIZE: :class:`int`
+		The maximum number of released builders kept for :meth:`acquire`
+	buffer: :class:`bytearray`
+		The buffer, with the headroom
+	pos: :class:`int`
+		The write offset inside the buffer
+	"""
+	HEADROOM = 6
+	POOL_SIZE = 64
+	_pool = []
+
+	def __init__(self, capacity=256):
+		self.buffer = bytearray(self.HEADROOM + capacity)
+		self.pos = self.HEADROOM
+		self._released = False
+
+	def __len__(self):
+		return self.pos - self.HEADROOM
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+	@classmethod
+	def acquire(cls):
+		"""Returns an empty builder from the pool, or a new one."""
+		try:
+			builder = cls._pool.pop()
+		except IndexError:
+			return cls()
+
+		builder.pos = cls.HEADROOM
+		builder._released = False
+		return builder
+
+	def release(self):
+		"""Gives the builder back to the pool. Views returned by :meth:`body` and
+		:meth:`frame` must not be used anymore. Releasing it again does nothing."""
+		if self._released:
+			return
+		self._released = True
+		if len(self._pool) < self.POOL_SIZE:
+			self._pool.append(self)
+
+	def reset(self):
+		"""Empties the builder to build another packet."""
+		self.pos = self.HEADROOM
+		return self
+
+	def reserve(self, size):
+		"""Makes sure there is room for some more bytes, doubling the buffer if needed.
+		A bigger buffer is a copy (a :class:`bytearray` can't be resized while it is
+		viewed), so the views returned by :meth:`body` and :meth:`frame` before that
+		don't see the next writes.
+		"""
+		needed = self.pos + size
+		if needed > len(self.buffer):
+			capacity = len(self.buffer)
+			while capacity < needed:
+				capacity <<= 1
+			buffer = bytearray(capacity)
+			buffer[:self.pos] = memoryview(self.buffer)[:self.pos]
+			self.buffer = buffer
+
+	def writeBytes(self, content):
+		"""Write raw bytes to the buffer"""
+		if isinstance(content, Packet):
+			content = content.buffer
+		size = len(content)
+		self.reserve(size)
+		self.buffer[self.pos:self.pos + size] = content
+		self.pos += size
+		return self
+
+	def writeCode(self, c, cc):
+		"""Write two bytes: c and cc."""
+		pos = self.pos
+		if pos + 2 > len(self.buffer):
+			self.reserve(2)
+		u16.pack_into(self.buffer, pos, (c & 0xff) << 8 | cc & 0xff)
+		self.pos = pos + 2
+		return self
+
+	def write8(self, value):
+		"""Write a single byte to the buffer"""
+		pos = self.pos
+		if pos >= len(self.buffer):
+			self.reserve(1)
+		self.buffer[pos] = value & 0xff
+		self.pos = pos + 1
+		return self
+
+	def write16(self, value):
+		"""Write a short (two bytes) to the buffer"""
+		pos = self.pos
+		if pos + 2 > len(self.buffer):
+			self.reserve(2)
+		u16.pack_into(self.buffer, pos, value & 0xffff)
+		self.pos = pos + 2
+		return self
+
+	def write24(self, value):
+		"""Write three bytes to the buffer"""
+		self.reserve(3)
+		u8.pack_into(self.buffer, self.pos, value >> 16 & 0xff)
+		u16.pack_into(self.buffer, self.pos + 1, value & 0xffff)
+		self.pos += 3
+		return self
+
+	def write32(self, value):
+		"""Write an int (four bytes) to the buffer"""
+		pos = self.pos
+		if pos + 4 > len(self.buffer):
+			self.reserve(4)
+		u32.pack_into(self.buffer, pos, value & 0xffffffff)
+		self.pos = pos + 4
+		return self
+
+	def pack(self, fmt, *values):
+		"""Writes several values at once with a :class:`struct.Struct` format (big endian
+		by default), which is faster than writing them one by one.
+		``builder.pack("BBI", 4, 4, 1)`` is the same as
+		``builder.writeCode(4, 4).write32(1)``
+		"""
+		packer = structs.get(fmt)
+		if packer is None:
+			packer = structs[fmt] = struct.Struct(fmt if fmt[:1] in "@=<>!" else ">" + fmt)
+
+		pos = self.pos
+		if pos + packer.size > len(self.buffer):
+			self.reserve(packer.size)
+		packer.pack_into(self.buffer, pos, *values)
+		self.pos = pos + packer.size
+		return self
+
+	def writeBool(self, value):
+		"""Write a boolean (one byte) to the buffer"""
+		return self.write8(1 if value else 0)
+
+	def writeString(self, string):
+		"""Write a string to the buffer"""
+		if isinstance(string, str):
+			string = string.encode()
+		size = len(string)
+		self.reserve(2 + size)
+		u16.pack_into(self.buffer, self.pos, size & 0xffff)
+		self.buffer[self.pos + 2:self.pos + 2 + size] = string
+		self.pos += 2 + size
+		return self
+
+	def writeUTF(self, string):
+		"""Write a string to the buffer. Alias for .writeString"""
+		return self.writeString(string)
+
+	def body(self):
+		"""Returns the packet (CCC and body) written so far.
+		:return: :class:`memoryview` a view on the builder's buffer
+		"""
+		return memoryview(self.buffer)[self.HEADROOM:self.pos]
+
+	def frame(self, fp=None):
+		"""Writes the length prefix (and the fingerprint of outbound packets) right
+		before the body and returns the whole frame, as it is sent on the wire.
+		:param fp: Optional[:class:`int`] the fingerprint. None (default) for inbound packets.
+		:return: :class:`memoryview` a view on the builder's buffer
+		"""
+		length = self.pos - self.HEADROOM
+		prefix = []
+		while True:
+			byte = length & 0x7f
+			length >>= 7
+			if not length:
+				prefix.append(byte)
+				break
+			prefix.append(byte | 0x80)
+
+		if fp is not None:
+			prefix.append(fp & 0xff)
+
+		start = self.HEADROOM - len(prefix)
+		self.buffer[start:self.HEADROOM] = bytes(prefix)
+		return memoryview(self.buffer)[start:self.pos]
+
+	def packet(self):
+		"""Returns a :class:`Packet` (from its pool) with a copy of what has been written,
+		so the builder can be reused.
+		:return: :class:`Packet`
+		"""
+		return Packet.acquire(self.buffer[self.HEADROOM:self.pos])
@@ -23,11 +23,15 @@ SOFTWARE.
 """
 
 import sys
+import time
 import asyncio
 import traceback
 
 from tfmplugins.utils import EventBased, PluginsWatcher
+from tfmplugins.utils.metrics import CPUTimed, metrics
 from tfmplugins.tfm.packet import Packet
+from tfmplugins.tfm.schema import registry
+from tfmplugins.tfm.state import GameStateModel
 
 
 main_loop = asyncio.get_event_loop()
@@ -67,8 +71,17 @@ class TFMClient(EventBased):
 		Whether the client has logged in as a souris.
 	msg_keys: Optional[:class:`list`]
 		Message keys. May be None if they haven't been calculated yet.
+	game: :class:`tfm.state.GameStateModel`
+		The game state model, updated once per inbound packet.
+
+	The raw socket events can be waited for by CCC, as in
+	``client.wait_for("on_raw_socket_inbound", key=(6, 6))``.
 	"""
 	watcher = PluginsWatcher()
+	waiter_keys = {
+		"on_raw_socket_outbound": lambda conn, fp, packet: tuple(packet.buffer[1:3]),
+		"on_raw_socket_inbound": lambda conn, packet: tuple(packet.buffer[:2]),
+	}
 
 	def __init__(self, main, loop=main_loop):
 		self.loop = loop
@@ -85,10 +98,19 @@ class TFMClient(EventBased):
 		self.msg_keys = None
 		self._msg_packet = None
 
+		self.game = GameStateModel()
+
 		super().__init__()
 
+	@property
+	def state(self):
+		""":class:`tfm.state.GameState` The latest snapshot of the game state: room,
+		players, map and tribe."""
+		return self.game.state
+
 	def packet_received(self, outbound, conn, packet):
-		"""Dispatches the events when receiving some data.
+		"""Dispatches the events when receiving some data. Called from the loop, and
+		the events run in the order the packets have been captured.
 
 		:param outbound: :class:`bool` whether the packet direction is outbound (True)
 			or inbound (False)
@@ -98,18 +120,21 @@ class TFMClient(EventBased):
 		"""
 		if outbound:
 			fp = packet.read8()
-			self.dispatch("raw_socket_outbound", conn, fp, packet)
+			self.queue("raw_socket_outbound", conn, fp, packet)
 		else:
-			self.dispatch("raw_socket_inbound", conn, packet)
+			self.queue("raw_socket_inbound", conn, packet)
 
-	async def on_trigger_plugin(self, plugin, sent, *args, **kwargs):
+	async def on_trigger_plugin(self, plugin, sent, stamps, *args, **kwargs):
 		"""|coro|
-		Dispatches the data event on a plugin.
+		Dispatches the data event on a plugin. Called by the plugin worker, in the
+		same order the packets have been captured.
 
 		:param plugin: the plugin (any class that implements packet_sent and
 			packet_received coroutines)
 		:param sent: :class:`bool` whether the packet is being sent (True)
 			or received (False)
+		:param stamps: Optional[:class:`tuple`] the (capture, task start)
+			:func:`time.perf_counter_ns` of the packet, to measure the plugin
 		:param *args: arguments to pass to the event
 		:param **kwargs: keyword arguments to pass to the event
 		"""
@@ -118,13 +143,91 @@ class TFMClient(EventBased):
 		else:
 			method = plugin.packet_received
 
+		name = getattr(plugin, "name", type(plugin).__module__)
+		try:
+			if stamps is None:
+				await method(self, *args, **kwargs)
+
+			else:
+				timed = CPUTimed(method(self, *args, **kwargs))
+				try:
+					await timed
+				finally:
+					done = time.perf_counter_ns()
+					metrics.plugin(name, done - stamps[1], timed.cpu)
+					metrics.stage("end_to_end", done - stamps[0])
+
+		except Exception:
+			message = 'Ignored exception on plugin "{0}" while parsing {2} packet:\n\n{1}'
+			tb = traceback.format_exc()
+			print(message.format(name, tb, "outbound" if sent else "inbound"), file=sys.stderr)
+
+	def trigger_plugin(self, plugin, sent, stamps, *args, **kwargs):
+		"""Same as :meth:`on_trigger_plugin`, for synchronous plugins: their methods are
+		plain functions, called right away from the client.
+		"""
+		if sent:
+			method = plugin.packet_sent
+		else:
+			method = plugin.packet_received
+
+		name = getattr(plugin, "name", type(plugin).__module__)
 		try:
-			await method(self, *args, **kwargs)
+			if stamps is None:
+				method(self, *args, **kwargs)
+
+			else:
+				cpu = time.thread_time()
+				try:
+					method(self, *args, **kwargs)
+				finally:
+					done = time.perf_counter_ns()
+					metrics.plugin(name, done - stamps[1], time.thread_time() - cpu)
+					metrics.stage("end_to_end", done - stamps[0])
 
 		except Exception:
-			message = 'Ignored exception on plugin "{0.name}" while parsing {2} packet:\n\n{1}'
+			message = 'Ignored exception on plugin "{0}" while parsing {2} packet:\n\n{1}'
 			tb = traceback.format_exc()
-			print(message.format(plugin, tb, "outbound" if sent else "inbound"), file=sys.stderr)
+			print(message.format(name, tb, "outbound" if sent else "inbound"), file=sys.stderr)
+
+	async def on_trigger_state(self, plugin, event, before, after):
+		"""|coro|
+		Dispatches a game state change on a plugin. Called by the plugin worker, in the
+		same order as the packets.
+
+		:param plugin: the plugin (any class that implements a state_changed coroutine)
+		:param event: :class:`str` what changed (see :meth:`tfm.state.GameStateModel.update`)
+		:param before: the previous value
+		:param after: the new value
+		"""
+		try:
+			await plugin.state_changed(self, event, before, after)
+		except Exception:
+			message = 'Ignored exception on plugin "{0}" while handling the {2} state change:\n\n{1}'
+			name = getattr(plugin, "name", type(plugin).__module__)
+			print(message.format(name, traceback.format_exc(), event), file=sys.stderr)
+
+	def trigger_state(self, plugin, event, before, after):
+		"""Same as :meth:`on_trigger_state`, for synchronous plugins."""
+		try:
+			plugin.state_changed(self, event, before, after)
+		except Exception:
+			message = 'Ignored exception on plugin "{0}" while handling the {2} state change:\n\n{1}'
+			name = getattr(plugin, "name", type(plugin).__module__)
+			print(message.format(name, traceback.format_exc(), event), file=sys.stderr)
+
+	def _started(self, packet):
+		"""Records the dispatch stage of a packet whose task just started.
+		:param packet: :class:`tfm.packet.Packet` the captured packet
+		:return: Optional[:class:`tuple`] the (capture, task start) timestamps to pass to
+			:meth:`on_trigger_plugin`, None if the packet hasn't been timestamped
+		"""
+		if packet.stamps is None:
+			return None
+
+		now = time.perf_counter_ns()
+		metrics.stage("dispatch", now - packet.stamps[1])
+		return packet.stamps[0], now
 
 	async def on_raw_socket_outbound(self, conn, fp, packet):
 		"""|coro|
@@ -135,17 +238,21 @@ class TFMClient(EventBased):
 		:param fp: :class:`int` the packet fingerprint
 		:param packet: :Class:`tfm.packet.Packet` the captured packet
 		"""
-		if self.logged:
-			CCC = packet.readCode()
+		stamps = self._started(packet)
+		CCC = packet.readCode() if len(packet.buffer) >= 3 else None
 
+		if self.logged:
 			if CCC == (6, 6): # chat message
 				if self.msg_keys is None and len(packet.buffer) > 22:
 					self._msg_packet = (fp, packet.readBytes(20))
 
-			packet.pos = 1
+		packet.pos = 1
 
-		async for plugin in self.watcher:
-			self.dispatch("trigger_plugin", plugin, True, conn, fp, packet.copy(copy_pos=True))
+		for worker in self.watcher.route(CCC, True):
+			if worker.synchronous:
+				worker.run(self.trigger_plugin, True, stamps, conn, fp, packet.view(copy_pos=True))
+			else:
+				await worker.put(self.on_trigger_plugin, True, stamps, conn, fp, packet.view(copy_pos=True))
 
 	async def on_raw_socket_inbound(self, conn, packet):
 		"""|coro|
@@ -155,23 +262,19 @@ class TFMClient(EventBased):
 			this packet
 		:param packet: :Class:`tfm.packet.Packet` the captured packet
 		"""
-		if not self.logged:
-			CCC = packet.readCode()
+		stamps = self._started(packet)
+		CCC = packet.readCode() if len(packet.buffer) >= 2 else None
 
+		if not self.logged:
 			if CCC == (26, 2):
+				login = registry.decode(CCC, packet)
 				self.logged = True
-				self.id = packet.read32()
-				self.name = packet.readUTF()
-				packet.read32() # played time
-				packet.read8() # community
-				self.pid = packet.read32()
+				self.id = login.id
+				self.name = login.name
+				self.pid = login.pid
 				self.is_souris = self.id == 0
 
-			packet.pos = 0
-
 		elif self.msg_keys is None and self._msg_packet is not None:
-			CCC = packet.readCode()
-
 			if CCC == (6, 6):
 				if packet.readUTF() == self.name:
 					fp, ciphered = self._msg_packet
@@ -188,7 +291,23 @@ class TFMClient(EventBased):
 					for byte in (deciphered.readBytes(start) + last):
 						self.msg_keys.append(byte)
 
-			packet.pos = 0
-
-		async for plugin in self.watcher:
-			self.dispatch("trigger_plugin", plugin, False, conn, packet.copy())
\ No newline at end of file
+		changes = None
+		if CCC in self.game.handlers:
+			packet.pos = 2
+			changes = self.game.update(CCC, packet)
+
+		packet.pos = 0
+
+		for worker in self.watcher.route(CCC, False):
+			if worker.synchronous:
+				worker.run(self.trigger_plugin, False, stamps, conn, packet.view())
+			else:
+				await worker.put(self.on_trigger_plugin, False, stamps, conn, packet.view())
+
+		if changes:
+			for worker in self.watcher.observers():
+				for change in changes:
+					if worker.synchronous:
+						worker.run(self.trigger_state, *change)
+					else:
+						await worker.put(self.on_trigger_state, *change)
\ No newline at end of file
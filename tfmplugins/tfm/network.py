@@ -22,19 +22,132 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
 from tfmplugins.network import Connection
 from tfmplugins.tfm.packet import Packet
 from tfmplugins.tfm.client import TFMClient
+from tfmplugins.tfm.schema import registry
+from tfmplugins.utils.metrics import metrics
 
 
 main_ip = "37.187.29.8"
-bulle_keys = {}
+
+
+class KeyCache:
+	"""Links the bulle keys sent by the main server to their clients until the bulle
+	connection uses them. Thread safe, since every driver thread uses it.
+
+	Keys expire after a while (the bulle connection was never seen or was ignored)
+	and the least recently added ones are evicted when the cache is full.
+
+	Parameters
+	----------
+	max_size: :class:`int`
+		The maximum number of keys
+	ttl: :class:`float`
+		Seconds a key is kept
+
+	Attributes
+	----------
+	entries: :class:`collections.OrderedDict`
+		(client, deadline) by key, from the oldest to the newest
+	hits: :class:`int`
+		The number of keys that have linked a bulle to its client
+	misses: :class:`int`
+		The number of bulle connections with an unknown key
+	expired: :class:`int`
+		The number of keys that expired before being used
+	evicted: :class:`int`
+		The number of keys evicted because the cache was full
+	"""
+	def __init__(self, max_size=1024, ttl=60.0):
+		self.max_size = max_size
+		self.ttl = ttl
+
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.expired = 0
+		self.evicted = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def put(self, key, client):
+		"""Stores the client a bulle key belongs to.
+		:param key: :class:`bytes` the key
+		:param client: :class:`tfm.client.TFMClient` the client
+		"""
+		now = time.monotonic()
+		with self.lock:
+			self.entries[key] = (client, now + self.ttl)
+			self.entries.move_to_end(key)
+
+			# Every key has the same ttl, so the first ones expire first.
+			while self.entries:
+				_, deadline = next(iter(self.entries.values()))
+				if deadline > now:
+					break
+				self.entries.popitem(last=False)
+				self.expired += 1
+
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+				self.evicted += 1
+
+	def pop(self, key):
+		"""Removes a bulle key and returns its client.
+		:param key: :class:`bytes` the key
+		:return: Optional[:class:`tfm.client.TFMClient`] None if the key is unknown or expired
+		"""
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			client, deadline = entry
+			if deadline <= time.monotonic():
+				self.expired += 1
+				self.misses += 1
+				return None
+
+			self.hits += 1
+			return client
+
+	def stats(self):
+		"""Returns the cache size and counters.
+		:return: :class:`dict`
+		"""
+		with self.lock:
+			return {
+				"size": len(self.entries),
+				"hits": self.hits,
+				"misses": self.misses,
+				"expired": self.expired,
+				"evicted": self.evicted,
+			}
+
+
+bulle_keys = KeyCache()
 
 
 class TFMPacketReader:
 	"""Represents a Transformice packet reader.
 	Every Transformice connection has two: one for inbound connections and other for outbound ones
 
+	Payloads are appended to a buffer and read through an offset, so consuming a packet
+	never shifts the unread bytes. Yielded packets are read-only views on that buffer:
+	since they may outlive the current call, the buffer is never modified behind them.
+	When it runs out of space a new one is allocated and only the unread bytes are moved.
+
 	Parameters
 	----------
 	extra: :class:`int`
@@ -45,40 +158,92 @@ class TFMPacketReader:
 	extra: :class:`int`
 		Extra bytes that are assumed to be in length (1 for outbound connections, 0 otherwise)
 	buffer: :class:`bytearray`
-		Unread bytes
+		Received bytes. Only the ones between ``pos`` and ``end`` are unread.
+	pos: :class:`int`
+		Read offset inside the buffer
+	end: :class:`int`
+		Write offset inside the buffer
 	length: :class:`int`
 		Expected length of the following packet. Generally 0 (not expecting anything yet).
 	"""
+	CAPACITY = 65536
+
 	def __init__(self, extra):
 		self.extra = extra
 
-		self.buffer = bytearray()
+		self.buffer = bytearray(self.CAPACITY)
+		self.view = memoryview(self.buffer).toreadonly()
+		self.pos = 0
+		self.end = 0
 		self.length = 0
 
+	def reserve(self, size):
+		"""Makes sure there is room for some more bytes after the unread ones.
+		If there isn't, the unread bytes are moved to a new buffer.
+		:param size: :class:`int` the amount of bytes that are going to be written
+		"""
+		if self.end + size <= len(self.buffer):
+			return
+
+		unread = self.end - self.pos
+		capacity = self.CAPACITY
+		while capacity < unread + size:
+			capacity <<= 1
+
+		buffer = bytearray(capacity)
+		buffer[:unread] = self.view[self.pos:self.end]
+
+		self.buffer = buffer
+		self.view = memoryview(buffer).toreadonly()
+		self.pos = 0
+		self.end = unread
+
+	def read_length(self):
+		"""Decodes the length prefix of the following packet
+		:return: :class:`bool` whether the whole prefix has been received or not
+		"""
+		view, pos, end = self.view, self.pos, self.end
+		length = 0
+
+		for shift in range(0, 35, 7):
+			if pos >= end:
+				return False
+
+			byte = view[pos]
+			pos += 1
+			length |= (byte & 0x7f) << shift
+
+			if not byte & 0x80:
+				break
+
+		else:
+			raise Exception("Malformed TFM packet payload")
+
+		self.pos = pos
+		self.length = length + self.extra
+		return True
+
 	def consume_payload(self, payload):
 		"""Consumes a packet payload and yields Transformice packets
 		:param payload: :class:`bytes` or :class:`bytearray` the packet payload
+		:return: an iterator of read-only :class:`memoryview`, one per packet
 		"""
-		self.buffer.extend(payload)
+		size = len(payload)
+		self.reserve(size)
+		self.buffer[self.end:self.end + size] = payload
+		self.end += size
 
-		while len(self.buffer) > self.length:
-			if self.length == 0:
-				for i in range(5):
-					byte = self.buffer.pop(0)
-					self.length |= (byte & 0x7f) << (i * 7)
+		while self.pos < self.end:
+			if self.length == 0 and not self.read_length():
+				break
 
-					if not byte & 0x80:
-						break
+			if self.end - self.pos < self.length:
+				break
 
-				else:
-					raise Exception("Malformed TFM packet payload")
-
-				self.length += self.extra
-
-			if len(self.buffer) >= self.length:
-				yield Packet(self.buffer[:self.length])
-				del self.buffer[:self.length]
-				self.length = 0
+			start = self.pos
+			self.pos += self.length
+			self.length = 0
+			yield self.view[start:self.pos]
 
 
 class TFMConnection(Connection):
@@ -92,7 +257,24 @@ class TFMConnection(Connection):
 		The local address ("ip", port)
 	remote: :class:`tuple`
 		The remote address ("ip", port)
+
+	Attributes
+	----------
+	recorder: Optional[:class:`tfm.recorder.SessionRecorder`]
+		Where to record every packet of the connections. Shared by all of them,
+		None (default) doesn't record anything.
+	payload_only: :class:`bool`
+		True: the protocol only needs the segments with payload
+	BULLE_TTL: :class:`float`
+		Seconds a bulle keeps being scanned after its last connection
+	rejected: :class:`bool`
+		Whether the handshake has failed (the connection existed before the scanner,
+		or its bulle key is unknown)
 	"""
+	recorder = None
+	payload_only = True
+	BULLE_TTL = 60.0
+
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 
@@ -103,12 +285,31 @@ class TFMConnection(Connection):
 
 		self.name = "main" if self.remote[0] == main_ip else "bulle"
 		self.needs_handshake = True
+		self.rejected = False
 
 		if self.name == "main":
 			self.handshake_ccc = (28, 1)
 		else:
 			self.handshake_ccc = (44, 1)
 
+	def reject(self):
+		"""Flags the connection as ignored because its handshake has failed."""
+		self.rejected = True
+		self.ignore()
+
+	def ready(self, callback):
+		"""Tells whether the client can take more packets: while its event queue is
+		backlogged (its plugins are too slow), the payloads wait in the ring.
+		:param callback: the function to call once the queue has room again
+		:return: :class:`bool` whether a payload can be parsed now
+		"""
+		client = self.client
+		if client is None or not client.backlogged:
+			return True
+
+		client.wait_space(callback)
+		return False
+
 	def create_reader(self, *args, **kwargs):
 		"""Creates a packet reader
 		:param *args: the arguments to pass to the reader factory
@@ -122,26 +323,34 @@ class TFMConnection(Connection):
 		return TFMClient(*args, **kwargs)
 
 	def parse_packet(self, payload, outbound):
-		"""Parses a packet (only called if the connection is not flagged as ignored)
-		:param payload: :class:`bytes` or :class:`bytearray` the packet payload
+		"""Parses a packet (only called if the connection is not flagged as ignored).
+		Called from the event loop, in the order the payloads have been captured.
+		:param payload: :class:`bytes`, :class:`bytearray` or :class:`memoryview` the packet
+			payload. It is only valid during the call.
 		:param outbound: :class:`bool` whether the packet direction is outbound (True)
 			or inbound (False)
 		:return: :class:`bool` whether to send the packet to the other end or not
 		"""
+		if self.rejected:
+			# Closed after a failed handshake: the rest of its payloads are meaningless
+			return True
+
 		reader = self.outbound if outbound else self.inbound
 
-		for packet in reader.consume_payload(payload):
+		for frame in reader.consume_payload(payload):
+			packet = Packet(frame)
+
 			if self.needs_handshake:
 				# Ignore already created connections
 
-				if not outbound:
-					self.ignore()
+				if not outbound or len(frame) < 3:
+					self.reject()
 					break
 
 				fp = packet.read8()
 				CCC = packet.readCode()
 				if CCC != self.handshake_ccc:
-					self.ignore()
+					self.reject()
 					break
 
 				if self.name == "main":
@@ -149,15 +358,19 @@ class TFMConnection(Connection):
 
 				else:
 					# link with main
-					key = bytes(packet.readBytes(12))
+					try:
+						key = registry.decode(CCC, packet, outbound=True).key
+					except (struct.error, ValueError): # truncated handshake
+						client = None
+					else:
+						client = bulle_keys.pop(key)
 
-					if key in bulle_keys:
-						self.client = bulle_keys[key]
+					if client is not None:
+						self.client = client
 						self.client.bulle = self
-						del bulle_keys[key]
 
 					else:
-						self.ignore()
+						self.reject()
 						break
 
 				packet.pos = 0
@@ -166,16 +379,29 @@ class TFMConnection(Connection):
 			elif not outbound and self.name == "main":
 				# Switch bulle
 
-				CCC = packet.readCode()
+				CCC = packet.readCode() if len(frame) >= 2 else None
 				if CCC == (44, 1):
-					key = bytes(packet.readBytes(12))
-					bulle_keys[key] = self.client
+					try:
+						switch = registry.decode(CCC, packet)
+					except (struct.error, ValueError): # truncated: the client won't switch either
+						switch = None
 
-					# listen for bulle
-					self.network.add(packet.readUTF())
+					if switch is not None:
+						bulle_keys.put(switch.key, self.client)
+
+						# listen for bulle
+						self.network.add(switch.ip, ttl=self.BULLE_TTL)
 
 				packet.pos = 0
 
+			if self.recorder is not None:
+				self.recorder.record(self, outbound, frame, self.capture_time)
+
+			if metrics.enabled and self.captured_at:
+				parsed = time.perf_counter_ns()
+				metrics.stage("framing", parsed - self.captured_at)
+				packet.stamps = (self.captured_at, parsed)
+
 			self.client.packet_received(outbound, self, packet)
 
 		return True
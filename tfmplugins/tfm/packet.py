@@ -2,6 +2,45 @@
 
 import struct
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+XOR_BATCH_SIZE = 16384
+
+
+def xor_keystream(key, fp, length):
+	"""Returns the bytes the XOR algorithm mixes with a buffer of the given length.
+	:param key: the 20 message keys (:class:`list` of :class:`int` or any bytes-like)
+	:param fp: :class:`int` the packet fingerprint
+	:param length: :class:`int` the amount of bytes to cipher
+	"""
+	start = (fp + 1) % 20
+	key = bytes(key[:20])
+	key = key[start:] + key[:start]
+	return (key * (length // 20 + 1))[:length]
+
+
+def xor_bytes(data, stream):
+	"""XORs two bytes-like objects of the same length at once.
+	Uses NumPy when it is installed and Python big integers otherwise.
+	"""
+	if numpy is not None:
+		return (numpy.frombuffer(data, numpy.uint8) ^ numpy.frombuffer(stream, numpy.uint8)).tobytes()
+
+	length = len(data)
+	return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(length, 'big')
+
+
+def _read_string(packet):
+	return bytes(packet.readBytes(packet.read16()))
+
+
+def _read_utf(packet):
+	return str(packet.readBytes(packet.read16()), "utf-8")
+
 
 class Packet:
 	"""Represents a network packet.
@@ -11,22 +50,72 @@ class Packet:
 	buffer: Optional[:class:`bytes`]
 		The packet's buffer. The :class:`Packet` will be read-only if given.
 		If ``None`` is provided instead the :class:`Packet` will be in write-only mode.
+		A :class:`memoryview` is used as is, without copying it.
+
+	Packets backed by a :class:`memoryview` are shared: :meth:`view` hands out new
+	cursors over the same buffer, and the first write made through any of them
+	copies the buffer so the others are left untouched. They also share a cache of
+	the decoded strings and records, so a field is only decoded once, by the first
+	cursor that reads it.
 
 	Attributes
 	----------
-	buffer: :class:`bytearray`
+	buffer: :class:`bytearray` or :class:`memoryview`
 		The content of the packet.
 	pos: :class:`int`
 		The position inside the buffer.
+	stamps: Optional[:class:`tuple`]
+		The (capture, parse) :func:`time.perf_counter_ns` of a captured packet, when
+		the metrics are enabled. Views don't have them.
+	cache: Optional[:class:`dict`]
+		The decoded values, as (value, end position) by (kind, position). Shared by
+		the packet and its views, and None while the buffer can be modified.
+	POOL_SIZE: :class:`int`
+		The maximum number of released packets kept for :meth:`acquire`
 	"""
+	__slots__ = ("buffer", "pos", "stamps", "cache")
+
+	POOL_SIZE = 256
+	_pool = []
+
 	def __init__(self, buffer=None):
 		if buffer is None:
 			buffer = bytearray()
-		elif not isinstance(buffer, bytearray):
+		elif not isinstance(buffer, (bytearray, memoryview)):
 			buffer = bytearray(buffer)
 
 		self.buffer = buffer
 		self.pos = 0
+		self.stamps = None
+		self.cache = {} if isinstance(buffer, memoryview) else None
+
+	@classmethod
+	def acquire(cls, buffer=None):
+		"""Same as ``Packet(buffer)``, but reuses a released packet if there is any.
+		Subclasses aren't pooled unless they define their own ``_pool`` list.
+		"""
+		pool = cls.__dict__.get("_pool")
+		if pool:
+			try:
+				packet = pool.pop()
+			except IndexError: # emptied by another thread
+				pass
+			else:
+				packet.__init__(buffer)
+				return packet
+		return cls(buffer)
+
+	def release(self):
+		"""Gives the packet back to the pool. It must not be used anymore. Releasing it
+		again does nothing."""
+		if self.buffer is None: # already in the pool
+			return
+		pool = type(self).__dict__.get("_pool")
+		if pool is not None and len(pool) < self.POOL_SIZE:
+			self.buffer = None
+			self.stamps = None
+			self.cache = None
+			pool.append(self)
 
 	def __repr__(self):
 		return '<Packet {!r}>'.format(bytes(self))
@@ -40,9 +129,9 @@ class Packet:
 		if isinstance(c, (tuple, list)):
 			c, cc = c
 		elif cc is None:
-			return cls().write16(c)
+			return cls.acquire().write16(c)
 
-		return cls().write8(c).write8(cc)
+		return cls.acquire().write8(c).write8(cc)
 
 	def copy(self, copy_pos=False):
 		"""Returns a copy of the Packet"""
@@ -50,9 +139,52 @@ class Packet:
 		if copy_pos:
 			p.pos = self.pos
 
-		p.buffer = self.buffer.copy()
+		p.buffer = bytearray(self.buffer)
 		return p
 
+	def view(self, copy_pos=False):
+		"""Returns a new Packet sharing the same buffer, with its own position.
+		The buffer is frozen first if it could still be modified."""
+		if isinstance(self.buffer, bytearray):
+			self.buffer = memoryview(bytes(self.buffer))
+			self.cache = {}
+
+		p = Packet(self.buffer)
+		p.cache = self.cache
+		if copy_pos:
+			p.pos = self.pos
+		return p
+
+	def writable(self):
+		"""Returns the buffer, copying it first if it is shared (copy-on-write)."""
+		if not isinstance(self.buffer, bytearray):
+			self.buffer = bytearray(self.buffer)
+			self.cache = None
+		return self.buffer
+
+	def cached(self, kind, decode):
+		"""Decodes a value from the current position once per buffer: the packet and
+		its views get the same value, and skip it, without decoding it again.
+		:param kind: a hashable telling what is decoded (the same kind must always
+			be decoded the same way)
+		:param decode: a callable that decodes the value from the packet, moving it
+			after the value
+		:return: the value
+		"""
+		cache = self.cache
+		if cache is None:
+			return decode(self)
+
+		key = (kind, self.pos)
+		hit = cache.get(key)
+		if hit is None:
+			value = decode(self)
+			cache[key] = (value, self.pos)
+			return value
+
+		self.pos = hit[1]
+		return hit[0]
+
 	def readBytes(self, nbr=1):
 		"""Read raw bytes from the buffer."""
 		self.pos += nbr
@@ -85,18 +217,18 @@ class Packet:
 
 	def readString(self):
 		"""return a encoded string (in bytes)"""
-		return bytes(self.readBytes(self.read16()))
+		return self.cached("string", _read_string)
 
 	def readUTF(self):
 		"""return a decoded string"""
-		return self.readString().decode()
+		return self.cached("utf", _read_utf)
 
 	def writeBytes(self, content):
 		"""Write raw bytes to the buffer"""
 		if isinstance(content, Packet):
-			self.buffer.extend(content.buffer)
+			self.writable().extend(content.buffer)
 		else:
-			self.buffer.extend(content)
+			self.writable().extend(content)
 		return self
 
 	def writeCode(self, c, cc):
@@ -105,22 +237,22 @@ class Packet:
 
 	def write8(self, value):
 		"""Write a single byte to the buffer"""
-		self.buffer.append(value & 0xff)
+		self.writable().append(value & 0xff)
 		return self
 
 	def write16(self, value):
 		"""Write a short (two bytes) to the buffer"""
-		self.buffer.extend(struct.pack('>H', value & 0xffff))
+		self.writable().extend(struct.pack('>H', value & 0xffff))
 		return self
 
 	def write24(self, value):
 		"""Write three bytes to the buffer"""
-		self.buffer.extend((value & 0xffffff).to_bytes(3, 'big'))
+		self.writable().extend((value & 0xffffff).to_bytes(3, 'big'))
 		return self
 
 	def write32(self, value):
 		"""Write an int (four bytes) to the buffer"""
-		self.buffer.extend(struct.pack('>I', value & 0xffffffff))
+		self.writable().extend(struct.pack('>I', value & 0xffffffff))
 		return self
 
 	def writeBool(self, value):
@@ -139,9 +271,49 @@ class Packet:
 
 	def xor_cipher(self, key, fp, offset=2):
 		"""Cipher the packet with the XOR algorithm."""
-		self.buffer[offset:] = (byte ^ key[i % 20] for i, byte in enumerate(self.buffer[offset:], fp + 1))
+		buffer = self.writable()
+		buffer[offset:] = xor_bytes(buffer[offset:], xor_keystream(key, fp, len(buffer) - offset))
 		return self
 
 	def xor_decipher(self, key, fp):
 		"""Decipher the packet with the XOR algorithm."""
-		return self.xor_decipher(key, fp, offset=3)
\ No newline at end of file
+		return self.xor_cipher(key, fp, offset=3)
+
+	@staticmethod
+	def xor_decipher_many(key, packets, fps=None):
+		"""Decipher many packets with the XOR algorithm, a few kilobytes at a time
+		instead of packet by packet.
+		:param key: the 20 message keys
+		:param packets: :class:`list` of :class:`Packet` to decipher in place
+		:param fps: Optional[:class:`list`] the fingerprint of every packet. If ``None``
+			is passed (default), the first byte of every packet is used (0 for an empty
+			packet, which has nothing to decipher anyway).
+		:return: :class:`list` the given packets
+		"""
+		if fps is None:
+			fps = [packet.buffer[0] if len(packet.buffer) else 0 for packet in packets]
+
+		def flush():
+			result = memoryview(xor_bytes(b"".join(data), b"".join(stream)))
+			offset = 0
+			for packet in pending:
+				buffer = packet.writable()
+				end = offset + max(len(buffer) - 3, 0)
+				buffer[3:] = result[offset:end]
+				offset = end
+
+		data, stream, pending, size = [], [], [], 0
+		for packet, fp in zip(packets, fps):
+			body = packet.buffer[3:]
+			data.append(body)
+			stream.append(xor_keystream(key, fp, len(body)))
+			pending.append(packet)
+
+			size += len(body)
+			if size >= XOR_BATCH_SIZE:
+				flush()
+				data, stream, pending, size = [], [], [], 0
+
+		if pending:
+			flush()
+		return packets
@@ -0,0 +1,336 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bisect
+import gzip
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from collections import namedtuple
+
+
+MAGIC = b"TFMREC\x01\n"
+# payload length, timestamp, connection (0 main, 1 bulle), outbound, fingerprint, C, CC
+RECORD = struct.Struct("<IdBBBBB")
+# timestamp, offset in the (uncompressed) segment, C, CC
+INDEX = struct.Struct("<dQBB")
+
+SEGMENT_NAME = re.compile(r"^segment-(\d+)\.rec(\.gz)?$")
+
+Frame = namedtuple("Frame", "timestamp connection outbound fingerprint ccc payload")
+
+
+class SessionRecorder:
+	"""Records Transformice packets to disk.
+
+	Packets are queued from the event loop, as they are parsed, and written by a
+	background thread in large chunks. The files are append-only segments (``segment-N.rec``, or
+	``segment-N.rec.gz`` when compressed) that are never overwritten: a new recorder
+	continues the numbering. Every segment has a sidecar index (``segment-N.idx``)
+	with the timestamp, offset and CCC of every packet, which :class:`SessionReader`
+	uses to seek.
+
+	Parameters
+	----------
+	directory: :class:`str`
+		Where to write the segments. Created if needed.
+	segment_size: :class:`int`
+		Size (in bytes, before compression) after which a new segment is started
+	compress: :class:`bool`
+		Whether to gzip the segments
+	flush_interval: :class:`float`
+		Maximum number of seconds a packet stays in memory before being written
+
+	Attributes
+	----------
+	directory: :class:`str`
+		Where the segments are written
+	recorded: :class:`int`
+		The number of packets written to disk
+	dropped: :class:`int`
+		The number of packets that couldn't be queued: MAX_PENDING packets were
+		waiting already, or the writer thread has failed
+	error: Optional[:class:`Exception`]
+		Why the writer thread has stopped, if it has failed
+	MAX_PENDING: :class:`int`
+		The maximum number of packets waiting to be written
+	"""
+	BUFFER_SIZE = 1 << 20
+	MAX_PENDING = 1 << 16
+
+	def __init__(self, directory, segment_size=64 << 20, compress=False, flush_interval=1.0):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.compress = compress
+		self.flush_interval = flush_interval
+
+		os.makedirs(directory, exist_ok=True)
+		numbers = [
+			int(match.group(1)) for match in map(SEGMENT_NAME.match, os.listdir(directory))
+			if match is not None
+		]
+		self.segment = max(numbers, default=-1)
+
+		self.file = None
+		self.index = None
+		self.offset = 0
+		self.recorded = 0
+		self.dropped = 0
+		self.error = None
+
+		self.lock = threading.Lock()
+		self.pending = []
+		self.wakeup = threading.Event()
+		self.running = True
+
+		self.thread = threading.Thread(target=self._write, name="SessionRecorder", daemon=True)
+		self.thread.start()
+
+	def record(self, conn, outbound, frame, timestamp=None):
+		"""Queues a packet. Called from the event loop.
+		:param conn: :class:`tfm.network.TFMConnection` the connection that captured it
+		:param outbound: :class:`bool` the packet direction
+		:param frame: :class:`bytes`-like the whole packet (fingerprint, CCC and body).
+			It is copied, so a :class:`memoryview` of the packet reader doesn't keep its
+			buffer alive until the next flush.
+		:param timestamp: Optional[:class:`float`] the :func:`time.time` when the packet
+			was captured. None (default) uses the current time.
+		"""
+		if self.error is not None or len(self.pending) >= self.MAX_PENDING:
+			self.dropped += 1
+			return
+
+		if outbound:
+			fp, code = frame[0], frame[1:3]
+		else:
+			fp, code = 0, frame[0:2]
+		c, cc = (code[0], code[1]) if len(code) == 2 else (0, 0)
+
+		frame = bytes(frame)
+		connection = 0 if conn.name == "main" else 1
+		if timestamp is None:
+			timestamp = time.time()
+
+		with self.lock:
+			header = RECORD.pack(len(frame), timestamp, connection, outbound, fp, c, cc)
+			self.pending.append((header, frame, INDEX.pack(timestamp, 0, c, cc)))
+
+	def open_segment(self):
+		"""Closes the current segment and starts a new one."""
+		self.close_segment()
+
+		self.segment += 1
+		name = os.path.join(self.directory, "segment-{:06d}".format(self.segment))
+		if self.compress:
+			self.file = gzip.open(name + ".rec.gz", "xb", compresslevel=6)
+		else:
+			self.file = open(name + ".rec", "xb", buffering=self.BUFFER_SIZE)
+		self.index = open(name + ".idx", "xb", buffering=self.BUFFER_SIZE)
+
+		self.file.write(MAGIC)
+		self.offset = len(MAGIC)
+
+	def close_segment(self):
+		if self.file is not None:
+			self.file.close()
+			self.index.close()
+			self.file = self.index = None
+
+	def flush(self):
+		"""Writes the queued packets. Only called by the writer thread."""
+		with self.lock:
+			pending, self.pending = self.pending, []
+
+		if not pending:
+			return
+
+		chunk, entries = [], []
+		for header, frame, entry in pending:
+			if self.file is None or self.offset >= self.segment_size:
+				self._write_chunk(chunk, entries)
+				chunk, entries = [], []
+				self.open_segment()
+
+			entry = bytearray(entry)
+			struct.pack_into("<Q", entry, 8, self.offset)
+			entries.append(entry)
+			chunk.append(header)
+			chunk.append(frame)
+			self.offset += len(header) + len(frame)
+
+		self._write_chunk(chunk, entries)
+		self.file.flush()
+		self.index.flush()
+		self.recorded += len(pending)
+
+	def _write_chunk(self, chunk, entries):
+		if chunk:
+			self.file.write(b"".join(chunk))
+			self.index.write(b"".join(entries))
+
+	def _write(self):
+		"""The writer thread."""
+		try:
+			while self.running:
+				self.wakeup.wait(self.flush_interval)
+				self.wakeup.clear()
+				self.flush()
+
+			self.flush()
+		except Exception as e:
+			self.error = e
+			with self.lock:
+				self.pending = []
+			print("The session recorder has stopped:", file=sys.stderr)
+			traceback.print_exc()
+		finally:
+			self.close_segment()
+
+	def close(self):
+		"""Writes the queued packets and stops the writer thread."""
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
+
+
+class SessionReader:
+	"""Reads the packets written by :class:`SessionRecorder`.
+
+	The uncompressed segments are mapped in memory while they are read. Use the
+	reader as a context manager, or call :meth:`close`, to unmap the last one.
+
+	Parameters
+	----------
+	directory: :class:`str`
+		Where the segments are
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+		self.mapping = None
+		self.data = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		"""Unmaps the segment being read, if any."""
+		if self.data is not None:
+			self.data.release()
+			self.data = None
+		if self.mapping is not None:
+			self.mapping.close()
+			self.mapping = None
+
+	def segments(self):
+		"""Returns the (number, data path, index path) of every segment, in order."""
+		segments = []
+		for name in os.listdir(self.directory):
+			match = SEGMENT_NAME.match(name)
+			if match is not None:
+				number = int(match.group(1))
+				index = os.path.join(self.directory, "segment-{:06d}.idx".format(number))
+				segments.append((number, os.path.join(self.directory, name), index))
+		return sorted(segments)
+
+	def load_index(self, path):
+		"""Returns the (timestamp, offset, ccc) of every packet in a segment."""
+		with open(path, "rb") as file:
+			data = file.read()
+		usable = len(data) - len(data) % INDEX.size # the last entry may be incomplete
+		return [(ts, offset, (c, cc)) for ts, offset, c, cc in INDEX.iter_unpack(data[:usable])]
+
+	def read(self, start=None, end=None, codes=None):
+		"""Yields the recorded packets, in order. Uses the indexes to skip the segments
+		and packets outside of the time range and the unwanted codes.
+		:param start: Optional[:class:`float`] the minimum timestamp
+		:param end: Optional[:class:`float`] the maximum timestamp
+		:param codes: Optional[Iterable[:class:`tuple`]] the (C, CC) codes to read
+		:return: an iterator of :class:`Frame`
+		"""
+		if codes is not None:
+			codes = set(map(tuple, codes))
+
+		for _, path, index_path in self.segments():
+			entries = self.load_index(index_path)
+			if not entries:
+				continue
+			if start is not None and entries[-1][0] < start:
+				continue
+			if end is not None and entries[0][0] > end:
+				continue
+
+			timestamps = [entry[0] for entry in entries]
+			first = 0 if start is None else bisect.bisect_left(timestamps, start)
+			last = len(entries) if end is None else bisect.bisect_right(timestamps, end)
+			wanted = [
+				offset for _, offset, ccc in entries[first:last]
+				if codes is None or ccc in codes
+			]
+			if not wanted:
+				continue
+
+			for frame in self.read_segment(path, wanted):
+				yield frame
+
+	def read_segment(self, path, offsets):
+		"""Yields the packets at the given offsets of a segment. The segment is unmapped
+		once they have been read."""
+		self.close()
+		if path.endswith(".gz"):
+			with gzip.open(path, "rb") as file:
+				data = memoryview(file.read())
+		else:
+			with open(path, "rb") as file:
+				self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			data = memoryview(self.mapping)
+		self.data = data
+
+		try:
+			yield from self._frames(data, offsets)
+		finally:
+			if self.data is data: # not replaced by another read in the meantime
+				self.close()
+
+	@staticmethod
+	def _frames(data, offsets):
+		for offset in offsets:
+			length, timestamp, connection, outbound, fp, c, cc = RECORD.unpack_from(data, offset)
+			offset += RECORD.size
+			yield Frame(
+				timestamp,
+				"bulle" if connection else "main",
+				bool(outbound),
+				fp if outbound else None,
+				(c, cc),
+				bytes(data[offset:offset + length])
+			)
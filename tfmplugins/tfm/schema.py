@@ -0,0 +1,260 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import struct
+
+from collections import namedtuple
+
+from tfmplugins.tfm.packet import Packet
+
+
+# Field types that have a fixed size, and their struct format
+FIXED_TYPES = {
+	"8": "B",
+	"16": "H",
+	"32": "I",
+	"bool": "?",
+}
+# Field types that are prefixed by their length (a short)
+STRING_TYPES = ("string", "utf")
+
+length_struct = struct.Struct(">H")
+
+
+class InvalidSchema(Exception):
+	"""Exception thrown when a packet schema declares an unknown field type.
+	"""
+
+
+class PacketSchema:
+	"""Represents the layout of a packet body (everything after its CCC).
+
+	The fields are compiled once: consecutive fixed size fields are grouped
+	in a single :class:`struct.Struct`, so decoding a packet takes a single pass
+	with one ``unpack_from`` per group and one slice per string.
+
+	Parameters
+	----------
+	ccc: :class:`tuple`
+		The packet code (C, CC)
+	name: :class:`str`
+		The name of the record type
+	fields: List[:class:`tuple`]
+		A list of ("name", "type") pairs. Valid types are ``"8"``, ``"16"``,
+		``"32"``, ``"bool"``, ``"string"`` (bytes), ``"utf"`` (decoded string)
+		and ``"bytes:N"`` (N raw bytes)
+
+	Attributes
+	----------
+	ccc: :class:`tuple`
+		The packet code (C, CC)
+	record: :class:`type`
+		The :func:`collections.namedtuple` returned when decoding a packet
+	steps: List[:class:`tuple`]
+		The compiled decoding steps: (:class:`struct.Struct`, count) for a group
+		of ``count`` fixed size fields or (None, decode) for a string, where
+		``decode`` tells whether the string has to be decoded.
+	"""
+	def __init__(self, ccc, name, fields):
+		self.ccc = tuple(ccc)
+		self.record = namedtuple(name, [field for field, _ in fields])
+		self.steps = []
+
+		fmt = []
+		for field, kind in fields:
+			if kind in FIXED_TYPES:
+				fmt.append(FIXED_TYPES[kind])
+
+			elif kind.startswith("bytes:"):
+				fmt.append("{}s".format(int(kind[6:])))
+
+			elif kind in STRING_TYPES:
+				if fmt:
+					self.steps.append((struct.Struct(">" + "".join(fmt)), len(fmt)))
+					fmt = []
+				self.steps.append((None, kind == "utf"))
+
+			else:
+				raise InvalidSchema("Unknown type {!r} for the field {!r}.".format(kind, field))
+
+		if fmt:
+			self.steps.append((struct.Struct(">" + "".join(fmt)), len(fmt)))
+
+	def __repr__(self):
+		return "<PacketSchema {} {}>".format(self.ccc, self.record.__name__)
+
+	def decode(self, packet):
+		"""Decodes the packet body from its current position, and moves it
+		to the end of the body. The record is decoded once per shared buffer
+		(see :meth:`tfm.packet.Packet.cached`).
+		:param packet: :class:`tfm.packet.Packet` the packet
+		:return: the record
+		"""
+		return packet.cached(self, self._decode)
+
+	def _decode(self, packet):
+		buffer, pos = packet.buffer, packet.pos
+		values = []
+
+		for fixed, arg in self.steps:
+			if fixed is not None:
+				values.extend(fixed.unpack_from(buffer, pos))
+				pos += fixed.size
+
+			else:
+				length, = length_struct.unpack_from(buffer, pos)
+				pos += 2 + length
+				if arg:
+					values.append(str(buffer[pos - length:pos], "utf-8"))
+				else:
+					values.append(bytes(buffer[pos - length:pos]))
+
+		packet.pos = pos
+		return self.record._make(values)
+
+	def encode(self, *args, **kwargs):
+		"""Creates a packet (CCC and body) out of the field values.
+		:param *args: the field values, in order
+		:param **kwargs: the field values, by name
+		:return: :class:`tfm.packet.Packet`
+		"""
+		values = iter(self.record(*args, **kwargs))
+		chunks = [bytes(self.ccc)]
+
+		for fixed, arg in self.steps:
+			if fixed is not None:
+				chunks.append(fixed.pack(*(next(values) for _ in range(arg))))
+
+			else:
+				string = next(values)
+				if isinstance(string, str):
+					string = string.encode()
+
+				chunks.append(length_struct.pack(len(string)))
+				chunks.append(string)
+
+		return Packet(b"".join(chunks))
+
+
+class PacketRegistry:
+	"""A collection of packet schemas, indexed by direction and CCC.
+
+	Attributes
+	----------
+	schemas: Dict[:class:`tuple`, :class:`PacketSchema`]
+		The schemas, indexed by (outbound, CCC)
+	"""
+	def __init__(self):
+		self.schemas = {}
+
+	def register(self, ccc, name, fields, outbound=False):
+		"""Declares the layout of a packet.
+		:param ccc: :class:`tuple` the packet code (C, CC)
+		:param name: :class:`str` the name of the record type
+		:param fields: List[:class:`tuple`] ("name", "type") pairs
+		:param outbound: :class:`bool` whether the packet is sent to the server (True)
+			or received from it (False)
+		:return: :class:`PacketSchema`
+		"""
+		schema = PacketSchema(ccc, name, fields)
+		self.schemas[(outbound, schema.ccc)] = schema
+		return schema
+
+	def get(self, ccc, outbound=False):
+		"""Gets the schema of a packet, if it has been declared.
+		:param ccc: :class:`tuple` the packet code (C, CC)
+		:param outbound: :class:`bool` the packet direction
+		:return: Optional[:class:`PacketSchema`]
+		"""
+		return self.schemas.get((outbound, ccc))
+
+	def decode(self, ccc, packet, outbound=False):
+		"""Decodes a packet body if its layout has been declared. Otherwise, the
+		packet has to be read with the :class:`tfm.packet.Packet` methods.
+		:param ccc: :class:`tuple` the packet code (C, CC), already read
+		:param packet: :class:`tfm.packet.Packet` the packet, positioned after its CCC
+		:param outbound: :class:`bool` the packet direction
+		:return: the record, or None if there is no schema for this packet
+		"""
+		schema = self.schemas.get((outbound, ccc))
+		if schema is None:
+			return None
+		return schema.decode(packet)
+
+
+registry = PacketRegistry()
+
+registry.register((26, 2), "Login", [
+	("id", "32"),
+	("name", "utf"),
+	("played_time", "32"),
+	("community", "8"),
+	("pid", "32"),
+])
+registry.register((44, 1), "BulleSwitch", [
+	("key", "bytes:12"),
+	("ip", "utf"),
+])
+registry.register((44, 1), "BulleHandshake", [
+	("key", "bytes:12"),
+], outbound=True)
+
+# Game state (see tfm.state). They only decode what the state needs, except for
+# Player, which is repeated in the player list and has to be complete.
+registry.register((5, 21), "RoomJoin", [
+	("official", "bool"),
+	("name", "utf"),
+])
+registry.register((5, 2), "NewMap", [
+	("code", "32"),
+])
+registry.register((144, 2), "Player", [
+	("name", "utf"),
+	("pid", "32"),
+	("shaman", "bool"),
+	("dead", "bool"),
+	("score", "16"),
+	("cheeses", "8"),
+	("title", "16"),
+	("title_stars", "8"),
+	("gender", "8"),
+	("unknown1", "utf"),
+	("look", "utf"),
+	("unknown2", "bool"),
+	("mouse_color", "32"),
+	("shaman_color", "32"),
+	("unknown3", "32"),
+	("name_color", "32"),
+	("unknown4", "8"),
+])
+registry.register((8, 6), "PlayerWon", [
+	("unknown", "8"),
+	("pid", "32"),
+	("score", "16"),
+	("order", "8"),
+	("time", "16"),
+])
+registry.register((8, 7), "PlayerLeft", [
+	("pid", "32"),
+])
@@ -0,0 +1,204 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import struct
+
+from collections import namedtuple
+
+from tfmplugins.tfm.schema import registry
+
+
+Room = namedtuple("Room", ("name", "official"))
+Tribe = namedtuple("Tribe", ("name",))
+
+# Tribe houses are rooms named after their tribe, with this prefix.
+TRIBE_HOUSE = "*\x03"
+
+# Player list: the number of players (a short) and then a Player record for each one.
+count_struct = struct.Struct(">H")
+
+
+class GameState:
+	"""A snapshot of what the client knows about the game. Snapshots are never
+	modified: every change creates a new one, so plugins can keep them.
+
+	Attributes
+	----------
+	room: Optional[:class:`Room`]
+		The current room
+	players: Dict[:class:`int`, :class:`tuple`]
+		The players in the room, by pid, as decoded by the ``Player`` schema
+		(name, pid, shaman, dead, score, cheeses, look, ...)
+	map: Optional[:class:`tuple`]
+		The current map, as decoded by the ``NewMap`` schema
+	tribe: Optional[:class:`Tribe`]
+		The tribe of the player, once they have entered its tribe house
+	"""
+	__slots__ = ("room", "players", "map", "tribe")
+
+	def __init__(self, room=None, players=None, map=None, tribe=None):
+		self.room = room
+		self.players = {} if players is None else players
+		self.map = map
+		self.tribe = tribe
+
+	def __repr__(self):
+		return "<GameState room={!r} players={} map={!r} tribe={!r}>".format(
+			self.room and self.room.name, len(self.players), self.map and self.map.code,
+			self.tribe and self.tribe.name
+		)
+
+	def replace(self, **changes):
+		"""Returns a new snapshot with some attributes changed."""
+		state = GameState(self.room, self.players, self.map, self.tribe)
+		for name, value in changes.items():
+			setattr(state, name, value)
+		return state
+
+	def get_player(self, name=None, pid=None):
+		"""Gets a player of the room by name or pid.
+		:return: Optional[:class:`tuple`]
+		"""
+		if pid is not None:
+			return self.players.get(pid)
+
+		for player in self.players.values():
+			if player.name == name:
+				return player
+		return None
+
+
+class GameStateModel:
+	"""Keeps the :class:`GameState` of a client up to date, once per packet, whatever
+	the number of plugins. Only a few inbound packets change it: their layouts are
+	declared in :data:`tfm.schema.registry`, so they can be updated without touching
+	this class.
+
+	Attributes
+	----------
+	state: :class:`GameState`
+		The latest snapshot
+	handlers: Dict[:class:`tuple`, :class:`str`]
+		The name of the method that handles every packet, by CCC
+	errors: :class:`int`
+		The number of packets that couldn't be decoded
+	"""
+	handlers = {
+		(5, 21): "room_joined",
+		(5, 2): "new_map",
+		(144, 1): "player_list",
+		(144, 2): "player_joined",
+		(8, 6): "player_won",
+		(8, 7): "player_left",
+	}
+
+	def __init__(self):
+		self.state = GameState()
+		self.errors = 0
+
+	def update(self, ccc, packet):
+		"""Updates the state with an inbound packet.
+		:param ccc: :class:`tuple` the packet code, already read
+		:param packet: :class:`tfm.packet.Packet` the packet, positioned after its CCC
+		:return: List[:class:`tuple`] the changes, as (event, before, after). Events are
+			``"room"``, ``"map"``, ``"tribe"``, ``"players"`` (the whole list),
+			``"player_joined"``, ``"player_updated"`` and ``"player_left"``.
+		"""
+		handler = self.handlers.get(ccc)
+		if handler is None:
+			return []
+
+		try:
+			return getattr(self, handler)(ccc, packet)
+		except (struct.error, UnicodeDecodeError, ValueError):
+			self.errors += 1
+			return []
+
+	def room_joined(self, ccc, packet):
+		joined = registry.decode(ccc, packet)
+		before = self.state
+		room = Room(joined.name, joined.official)
+
+		tribe = before.tribe
+		if room.name.startswith(TRIBE_HOUSE):
+			tribe = Tribe(room.name[len(TRIBE_HOUSE):])
+
+		self.state = GameState(room, {}, None, tribe)
+		changes = [("room", before.room, room)]
+		if before.players:
+			changes.append(("players", before.players, {}))
+		if tribe != before.tribe:
+			changes.append(("tribe", before.tribe, tribe))
+		return changes
+
+	def new_map(self, ccc, packet):
+		before = self.state.map
+		self.state = self.state.replace(map=registry.decode(ccc, packet))
+		return [("map", before, self.state.map)]
+
+	def player_list(self, ccc, packet):
+		schema = registry.get((144, 2))
+		count, = count_struct.unpack_from(packet.buffer, packet.pos)
+		packet.pos += count_struct.size
+
+		players = {}
+		for _ in range(count):
+			player = schema.decode(packet)
+			players[player.pid] = player
+
+		before = self.state.players
+		self.state = self.state.replace(players=players)
+		return [("players", before, players)]
+
+	def player_joined(self, ccc, packet):
+		player = registry.decode(ccc, packet)
+		players = dict(self.state.players)
+		before = players.get(player.pid)
+		players[player.pid] = player
+
+		self.state = self.state.replace(players=players)
+		if before is None:
+			return [("player_joined", None, player)]
+		return [("player_updated", before, player)]
+
+	def player_won(self, ccc, packet):
+		won = registry.decode(ccc, packet)
+		before = self.state.players.get(won.pid)
+		if before is None:
+			return []
+
+		players = dict(self.state.players)
+		players[won.pid] = after = before._replace(score=won.score, cheeses=0)
+		self.state = self.state.replace(players=players)
+		return [("player_updated", before, after)]
+
+	def player_left(self, ccc, packet):
+		pid = registry.decode(ccc, packet).pid
+		if pid not in self.state.players:
+			return []
+
+		players = dict(self.state.players)
+		player = players.pop(pid)
+		self.state = self.state.replace(players=players)
+		return [("player_left", player, None)]
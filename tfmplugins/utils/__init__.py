@@ -23,4 +23,8 @@ SOFTWARE.
 """
 
 from tfmplugins.utils.eventbased import EventBased
-from tfmplugins.utils.watchdog import Watcher, PluginsWatcher
\ No newline at end of file
+from tfmplugins.utils.metrics import Histogram, Metrics, metrics
+from tfmplugins.utils.process import ProcessPlugin, SharedRing
+from tfmplugins.utils.router import PluginRouter, subscribe
+from tfmplugins.utils.watchdog import Watcher, PluginsWatcher
+from tfmplugins.utils.worker import PluginWorker
\ No newline at end of file
@@ -2,41 +2,104 @@
 
 import sys
 import asyncio
+import threading
 import traceback
 
+from collections import deque
+
 
 class InvalidEvent(Exception):
 	"""Exception thrown when you added an invalid event to the client.
-	An event is valid only if its name begin by 'on_' and it is coroutine.
+	An event is valid only if its name begin by 'on_' and it is callable.
 	"""
 
 
 class EventBased:
 	"""A class that implements asynchronous events
+
+	Events dispatched from other threads are queued and run in order by a single
+	task on the loop, which drains the queue in batches: the loop is only woken up
+	when the queue goes from empty to non-empty (or fills a whole batch).
+
+	Handlers are looked up once per event. Handlers that are plain functions instead
+	of coroutines run right away, without a task.
+
+	Attributes
+	----------
+	BATCH_SIZE: :class:`int`
+		Maximum number of queued events run before yielding to the loop.
+	BATCH_LATENCY: :class:`float`
+		Seconds the first queued event may wait for others before the batch runs.
+		0 runs it on the next loop iteration.
+	MAX_PENDING: :class:`int`
+		Number of queued events from which the queue is :attr:`backlogged`. Producers
+		that check it (like the payload ring) wait until it is half empty.
+	SWEEP_SIZE: :class:`int`
+		Minimum number of waiters before the cancelled ones are swept.
+	waiter_keys: Dict[:class:`str`, `function`]
+		The discriminator of some events (with 'on_', like in :meth:`wait_for`): a
+		function that gets the event arguments and returns a key, so :meth:`wait_for` can wait for a key
+		and a dispatch only checks the waiters of its key.
 	"""
+	BATCH_SIZE = 256
+	BATCH_LATENCY = 0.0
+	MAX_PENDING = 1024
+	SWEEP_SIZE = 256
+
+	waiter_keys = {}
+
 	def __init__(self):
+		self._handlers = {}
 		self._waiters = {}
+		self._keyed = {}
+		self._waiting = 0
+		self._sweep_at = self.SWEEP_SIZE
+
+		self._pending = deque()
+		self._space_waiters = []
+		self._scheduled = False
+		self._runner = None
+		self._loop_thread = None
 
 	def event(self, coro):
-		"""A decorator that registers an event.
+		"""A decorator that registers an event. The handler may be a coroutine function
+		or, if it doesn't need to wait for anything, a plain function.
 		"""
 		name = coro.__name__
 		if not name.startswith('on_'):
 			raise InvalidEvent("'{}' isn't a correct event naming.".format(name))
-		if not asyncio.iscoroutinefunction(coro):
-			message = "Couldn't register a non-coroutine function for the event {}.".format(name)
+		if not callable(coro):
+			message = "Couldn't register a non-callable object for the event {}.".format(name)
 			raise InvalidEvent(message)
 
 		setattr(self, name, coro)
+		self._handlers.clear()
 		return coro
 
-	def wait_for(self, event, condition=None, timeout=None, stopPropagation=False):
+	def _resolve(self, event):
+		"""Looks the handler of an event up and caches it until :meth:`event` is called.
+		:param event: :class:`str` event's name. (without 'on_')
+		:return: :class:`tuple` the handler (None if there is none), the method name and
+			whether the handler is a plain function
+		"""
+		method = 'on_' + event
+		coro = getattr(self, method, None)
+		handler = (coro, method, coro is not None and not asyncio.iscoroutinefunction(coro))
+		self._handlers[event] = handler
+		return handler
+
+	def wait_for(self, event, condition=None, timeout=None, stopPropagation=False, key=None):
 		"""Wait for an event.
 		:param event: :class:`str` the event name.
 		:param condition: Optional[`function`] A predicate to check what to wait for.
 			The arguments must meet the parameters of the event being waited for.
 		:param timeout: Optional[:class:`int`] the number of seconds before
 			throwing asyncio.TimeoutError
+		:param stopPropagation: :class:`bool` whether the event stops there once the
+			waiter gets it
+		:param key: Optional the key to wait for, as returned by the discriminator of
+			the event (see :attr:`waiter_keys`). Only the dispatches with this key
+			check the condition. Keyed waiters are checked before the other ones.
 		:return: [`asyncio.Future`](https://docs.python.org/3/library/asyncio-future.html#asyncio.Future)
 			a future that you must await.
 		"""
@@ -48,13 +111,48 @@ class EventBased:
 				return True
 			condition = everything
 
-		if event not in self._waiters:
-			self._waiters[event] = []
+		if key is None:
+			waiters = self._waiters.setdefault(event, [])
+		else:
+			if event not in self.waiter_keys:
+				raise InvalidEvent("The event {} can't be waited for by key.".format(event))
+			waiters = self._keyed.setdefault(event, {}).setdefault(key, [])
 
-		self._waiters[event].append((condition, future, stopPropagation))
+		waiters.append((condition, future, stopPropagation))
+
+		self._waiting += 1
+		if self._waiting >= self._sweep_at:
+			self._sweep()
 
 		return asyncio.wait_for(future, timeout)
 
+	def _sweep(self):
+		"""Removes the waiters that are done (cancelled, mostly because of a timeout).
+		Runs once the number of waiters doubles, so it takes constant time per waiter.
+		"""
+		waiting = 0
+
+		for method, waiters in list(self._waiters.items()):
+			waiters[:] = [waiter for waiter in waiters if not waiter[1].done()]
+			if waiters:
+				waiting += len(waiters)
+			else:
+				del self._waiters[method]
+
+		for method, buckets in list(self._keyed.items()):
+			for key, waiters in list(buckets.items()):
+				waiters[:] = [waiter for waiter in waiters if not waiter[1].done()]
+				if waiters:
+					waiting += len(waiters)
+				else:
+					del buckets[key]
+
+			if not buckets:
+				del self._keyed[method]
+
+		self._waiting = waiting
+		self._sweep_at = max(self.SWEEP_SIZE, waiting * 2)
+
 	async def _run_event(self, coro, event_name, *args, **kwargs):
 		"""|coro|
 		Runs an event and handle the error if any.
@@ -74,53 +172,188 @@ class EventBased:
 				await self.on_error(event_name, e, *args, **kwargs)
 		return False
 
+	def _run_sync(self, handler, event_name, args, kwargs):
+		"""Runs a plain function handler right away. If it fails, on_error runs in a task.
+		:return: :class:`bool` whether the event ran successfully or not
+		"""
+		try:
+			handler(*args, **kwargs)
+			return True
+		except Exception as e:
+			if hasattr(self, 'on_error'):
+				self.loop.create_task(self.on_error(event_name, e, *args, **kwargs))
+		return False
+
+	def _notify_waiters(self, method, args):
+		"""Resolves the futures waiting for an event: the ones waiting for its key
+		first, then the other ones.
+		:return: :class:`bool` whether a waiter stopped the propagation of the event
+		"""
+		buckets = self._keyed.get(method)
+		if buckets is not None:
+			key = self.waiter_keys[method](*args)
+			waiters = buckets.get(key)
+			if waiters is not None:
+				stopped = self._notify_bucket(waiters, args)
+				if not waiters:
+					del buckets[key]
+					if not buckets:
+						del self._keyed[method]
+				if stopped:
+					return True
+
+		waiters = self._waiters.get(method)
+		if waiters is not None:
+			stopped = self._notify_bucket(waiters, args)
+			if not waiters:
+				del self._waiters[method]
+			return stopped
+		return False
+
+	def _notify_bucket(self, waiters, args):
+		"""Checks a list of waiters in order and removes the ones that are done, in a
+		single pass.
+		:return: :class:`bool` whether a waiter stopped the propagation of the event
+		"""
+		kept = []
+		stopped = False
+		checked = 0
+		for cond, fut, stop in waiters:
+			checked += 1
+			if fut.done(): # cancelled
+				continue
+
+			try:
+				result = bool(cond(*args))
+			except Exception as e:
+				fut.set_exception(e)
+				continue
+
+			if not result:
+				kept.append((cond, fut, stop))
+				continue
+
+			fut.set_result(args[0] if len(args) == 1 else args if len(args) > 0 else None)
+			if stop:
+				stopped = True
+				break
+
+		# A condition may have added waiters: they are kept too
+		kept.extend(waiters[checked:])
+		self._waiting -= len(waiters) - len(kept)
+		waiters[:] = kept
+		return stopped
+
 	def dispatch(self, event, *args, **kwargs):
 		"""Dispatches events
 		:param event: :class:`str` event's name. (without 'on_')
 		:param args: arguments to pass to the coro.
 		:param kwargs: keyword arguments to pass to the coro.
-		:return: [`Task`](https://docs.python.org/3/library/asyncio-task.html#asyncio.Task)
-			the _run_event wrapper task
+		:return: Optional[[`Task`](https://docs.python.org/3/library/asyncio-task.html#asyncio.Task)]
+			the _run_event wrapper task, or None if the event has been queued from another
+			thread or its handler has already run
 		"""
-		method = 'on_' + event
+		coro, method, sync = self._handlers.get(event) or self._resolve(event)
 
-		if method in self._waiters:
-			to_remove = []
-			waiters = self._waiters[method]
-			for i, (cond, fut, stop) in enumerate(waiters):
-				if fut.cancelled():
-					to_remove.append(i)
-					continue
-
-				try:
-					result = bool(cond(*args))
-				except Exception as e:
-					fut.set_exception(e)
-				else:
-					if result:
-						fut.set_result(args[0] if len(args) == 1 else args if len(args) > 0 else None)
-						if stop:
-							del waiters[i]
-							return None
-						to_remove.append(i)
-
-			if len(to_remove) == len(waiters):
-				del self._waiters[method]
-			else:
-				for i in to_remove[::-1]:
-					del waiters[i]
+		if (method in self._waiters or method in self._keyed) and self._notify_waiters(method, args):
+			return None
+
+		if coro is not None:
+			if threading.get_ident() == self._loop_thread:
+				if sync:
+					self._run_sync(coro, method, args, kwargs)
+					return None
+				return self.loop.create_task(self._run_event(coro, method, *args, **kwargs))
+
+			self._enqueue(coro, method, sync, args, kwargs)
+
+	def queue(self, event, *args, **kwargs):
+		"""Same as :meth:`dispatch`, but the event always runs after the queued ones,
+		in order, even when it is dispatched from the loop.
+		:param event: :class:`str` event's name. (without 'on_')
+		:param args: arguments to pass to the coro.
+		:param kwargs: keyword arguments to pass to the coro.
+		"""
+		coro, method, sync = self._handlers.get(event) or self._resolve(event)
+
+		if (method in self._waiters or method in self._keyed) and self._notify_waiters(method, args):
+			return
 
-		coro = getattr(self, method, None)
 		if coro is not None:
-			dispatch = self._run_event(coro, method, *args, **kwargs)
-			return self.loop.call_soon_threadsafe(
-				self.loop.create_task,
-				dispatch
-			)
+			self._enqueue(coro, method, sync, args, kwargs)
+
+	@property
+	def backlogged(self):
+		""":class:`bool` Whether there are MAX_PENDING queued events or more"""
+		return len(self._pending) >= self.MAX_PENDING
+
+	def wait_space(self, callback):
+		"""Calls a function, from the loop, once the queue is half empty. Called by the
+		producers that stop queuing events while the queue is :attr:`backlogged`.
+		:param callback: the function, called without arguments
+		"""
+		if len(self._pending) <= self.MAX_PENDING // 2:
+			self.loop.call_soon(callback)
+		else:
+			self._space_waiters.append(callback)
+
+	def _enqueue(self, coro, method, sync, args, kwargs):
+		"""Queues an event and makes sure the loop runs the queue."""
+		self._pending.append((coro, method, sync, args, kwargs))
+		if not self._scheduled:
+			self._scheduled = True
+			if threading.get_ident() == self._loop_thread:
+				call_soon = self.loop.call_soon
+			else:
+				call_soon = self.loop.call_soon_threadsafe
+
+			if self.BATCH_LATENCY > 0:
+				call_soon(self.loop.call_later, self.BATCH_LATENCY, self._drain)
+			else:
+				call_soon(self._drain)
+
+		elif self.BATCH_LATENCY > 0 and len(self._pending) == self.BATCH_SIZE:
+			# Don't wait for the latency bound if a whole batch is ready
+			self.loop.call_soon_threadsafe(self._drain)
+
+	def _drain(self):
+		"""Starts the task that runs the queued events, unless it is running already.
+		Always called from the loop.
+		"""
+		self._loop_thread = threading.get_ident()
+
+		if self._runner is None or self._runner.done():
+			self._runner = self.loop.create_task(self._run_pending())
+
+	async def _run_pending(self):
+		"""|coro|
+		Runs the queued events in order, BATCH_SIZE at a time, until the queue is empty.
+		"""
+		pending = self._pending
+		while True:
+			for _ in range(min(len(pending), self.BATCH_SIZE)):
+				coro, method, sync, args, kwargs = pending.popleft()
+				if self._space_waiters and len(pending) <= self.MAX_PENDING // 2:
+					callbacks, self._space_waiters = self._space_waiters, []
+					for callback in callbacks:
+						callback()
+				if sync:
+					self._run_sync(coro, method, args, kwargs)
+				else:
+					await self._run_event(coro, method, *args, **kwargs)
+
+			if not pending:
+				self._scheduled = False
+				# An event may have been queued right before the flag was cleared
+				if not pending:
+					return
+				self._scheduled = True
+
+			await asyncio.sleep(0)
 
 	async def on_error(self, event, err, *a, **kw):
 		"""Default on_error event handler. Prints the traceback of the error."""
 		message = '\nAn error occurred while dispatching the event "{0}":\n\n{2}'
-		tb = traceback.format_exc(limit=-3)
+		tb = "".join(traceback.format_exception(type(err), err, err.__traceback__, limit=-3))
 		print(message.format(event, err, tb), file=sys.stderr)
 		return message.format(event, err, tb)
\ No newline at end of file
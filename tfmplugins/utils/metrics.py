@@ -0,0 +1,277 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+	"""A log-linear (HDR style) histogram of durations in nanoseconds.
+
+	Every power of two is split in :data:`SUB_BUCKETS` buckets, so any value is
+	kept with a relative error under 1/16, in a fixed array of counters: recording
+	a value is an index computation and an increment.
+
+	Attributes
+	----------
+	counts: List[:class:`int`]
+		The counter of every bucket
+	count: :class:`int`
+		The number of recorded values
+	total: :class:`int`
+		The sum of the recorded values
+	max: :class:`int`
+		The highest recorded value
+	"""
+	def __init__(self):
+		self.counts = [0] * (64 * SUB_BUCKETS)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	@staticmethod
+	def index(value):
+		if value < SUB_BUCKETS:
+			return max(value, 0)
+		shift = value.bit_length() - SUB_BITS - 1
+		return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+	@staticmethod
+	def upper(index):
+		"""Returns the highest value of a bucket."""
+		if index < SUB_BUCKETS:
+			return index
+		shift = index // SUB_BUCKETS - 1
+		return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+	def record(self, value):
+		"""Records a duration.
+		:param value: :class:`int` nanoseconds
+		"""
+		self.counts[self.index(value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, quantile):
+		"""Returns the value under which a proportion of the recorded values are.
+		:param quantile: :class:`float` between 0 and 1
+		:return: :class:`int` nanoseconds
+		"""
+		if not self.count:
+			return 0
+
+		rank = quantile * self.count
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= rank:
+				return min(self.upper(index), self.max)
+		return self.max
+
+
+class CPUTimed:
+	"""Wraps a coroutine and counts the CPU time (of the loop thread) it uses, only
+	while it runs: the time spent by other tasks while it waits isn't counted.
+
+	Attributes
+	----------
+	cpu: :class:`float`
+		The CPU seconds used so far
+	"""
+	def __init__(self, coro):
+		self.coro = coro
+		self.cpu = 0.0
+
+	def __await__(self):
+		send, throw = self.coro.send, self.coro.throw
+		value, error = None, None
+
+		while True:
+			start = time.thread_time()
+			try:
+				if error is None:
+					future = send(value)
+				else:
+					future = throw(error)
+			except StopIteration as e:
+				return e.value
+			finally:
+				self.cpu += time.thread_time() - start
+
+			try:
+				value, error = (yield future), None
+			except BaseException as e:
+				value, error = None, e
+
+
+class Metrics:
+	"""Latency histograms of every packet stage and plugin, and the CPU time used by
+	every plugin. Nothing is measured until :attr:`enabled` is set.
+
+	Stages:
+
+	- ``framing``: from the capture (in the driver) to the end of :meth:`parse_packet`
+	- ``dispatch``: from there to the start of the client task handling the packet
+	- ``end_to_end``: from the capture to the end of every plugin handler
+
+	Plugins are measured from the start of the client task to the end of their handler.
+
+	Attributes
+	----------
+	enabled: :class:`bool`
+		Whether the packets are timestamped
+	stages: Dict[:class:`str`, :class:`Histogram`]
+		The histogram of every stage
+	plugins: Dict[:class:`str`, :class:`Histogram`]
+		The histogram of every plugin
+	cpu: Dict[:class:`str`, :class:`float`]
+		The CPU seconds used by every plugin
+	"""
+	def __init__(self):
+		self.enabled = False
+		self.stages = {}
+		self.plugins = {}
+		self.cpu = {}
+
+	def stage(self, name, value):
+		"""Records the duration of a stage.
+		:param name: :class:`str` the stage
+		:param value: :class:`int` nanoseconds
+		"""
+		histogram = self.stages.get(name)
+		if histogram is None:
+			histogram = self.stages[name] = Histogram()
+		histogram.record(value)
+
+	def plugin(self, name, value, cpu):
+		"""Records a plugin handler call.
+		:param name: :class:`str` the plugin
+		:param value: :class:`int` nanoseconds since the start of the client task
+		:param cpu: :class:`float` the CPU seconds it used
+		"""
+		histogram = self.plugins.get(name)
+		if histogram is None:
+			histogram = self.plugins[name] = Histogram()
+			self.cpu[name] = 0.0
+		histogram.record(value)
+		self.cpu[name] += cpu
+
+	def prometheus(self):
+		"""Returns every metric in the Prometheus text format.
+		:return: :class:`str`
+		"""
+		lines = []
+
+		def summary(metric, label, histograms, help):
+			lines.append("# HELP {} {}".format(metric, help))
+			lines.append("# TYPE {} summary".format(metric))
+			for name, histogram in sorted(histograms.items()):
+				for quantile in QUANTILES:
+					lines.append('{}{{{}="{}",quantile="{}"}} {:.9f}'.format(
+						metric, label, name, quantile, histogram.percentile(quantile) / 1e9
+					))
+				lines.append('{}_sum{{{}="{}"}} {:.9f}'.format(metric, label, name, histogram.total / 1e9))
+				lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, name, histogram.count))
+
+		summary("tfmplugins_stage_latency_seconds", "stage", dict(self.stages), "Latency of every packet stage.")
+		summary("tfmplugins_plugin_latency_seconds", "plugin", dict(self.plugins), "Latency of every plugin handler.")
+
+		lines.append("# HELP tfmplugins_plugin_cpu_seconds_total CPU time used by every plugin handler.")
+		lines.append("# TYPE tfmplugins_plugin_cpu_seconds_total counter")
+		for name, cpu in sorted(dict(self.cpu).items()):
+			lines.append('tfmplugins_plugin_cpu_seconds_total{{plugin="{}"}} {:.9f}'.format(name, cpu))
+
+		return "\n".join(lines) + "\n"
+
+	def summary(self):
+		"""Returns a human readable summary of every stage and plugin.
+		:return: :class:`str`
+		"""
+		lines = ["{:<24} {:>10} {:>10} {:>10} {:>10} {:>10}".format("", "count", "p50 ms", "p99 ms", "max ms", "cpu s")]
+		rows = [(name, histogram, None) for name, histogram in sorted(dict(self.stages).items())]
+		rows += [("plugin " + name, histogram, self.cpu.get(name)) for name, histogram in sorted(dict(self.plugins).items())]
+
+		for name, histogram, cpu in rows:
+			lines.append("{:<24} {:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}".format(
+				name, histogram.count, histogram.percentile(0.5) / 1e6, histogram.percentile(0.99) / 1e6,
+				histogram.max / 1e6, "" if cpu is None else "{:.3f}".format(cpu)
+			))
+		return "\n".join(lines)
+
+	def serve(self, port, host="127.0.0.1"):
+		"""Serves the metrics in the Prometheus text format at http://host:port/metrics,
+		from a background thread. Enables the metrics.
+		:return: :class:`http.server.ThreadingHTTPServer`
+		"""
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path != "/metrics":
+					self.send_error(404)
+					return
+
+				body = metrics.prometheus().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.enabled = True
+		server = ThreadingHTTPServer((host, port), Handler)
+		threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+		return server
+
+	def report(self, interval, file=sys.stderr):
+		"""Prints the summary every interval, from a background thread. Enables the metrics.
+		:param interval: :class:`float` seconds between two summaries
+		:return: :class:`threading.Thread`
+		"""
+		def run():
+			while True:
+				time.sleep(interval)
+				print(self.summary(), file=file)
+
+		self.enabled = True
+		thread = threading.Thread(target=run, name="MetricsReport", daemon=True)
+		thread.start()
+		return thread
+
+
+metrics = Metrics()
@@ -0,0 +1,425 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import pickle
+import signal
+import struct
+import traceback
+import weakref
+
+from multiprocessing.shared_memory import SharedMemory
+
+
+# Ring header: the producer position, the consumer position and whether the consumer
+# is sleeping, each one in its own cache line.
+HEAD = 0
+TAIL = 64
+WAITING = 128
+HEADER_SIZE = 192
+
+position = struct.Struct("<Q")
+flag = struct.Struct("<I")
+
+# Every record: payload size, kind, fingerprint, packet position and connection
+RECORD = struct.Struct("<IBBHI")
+ALIGN = 8
+
+PAD = 0
+SENT = 1
+RECEIVED = 2
+CONNECTION = 3
+CLIENT = 4
+STOP = 5
+
+
+class SharedRing:
+	"""A single producer, single consumer ring of records in shared memory.
+
+	Positions only grow; the producer owns the head and the consumer owns the tail.
+	Records never wrap: when one doesn't fit at the end of the ring, the end is
+	skipped. The consumer sleeps on a pipe when the ring is empty, and the producer
+	only writes to the pipe when the consumer says it is sleeping.
+
+	Attributes
+	----------
+	shm: :class:`multiprocessing.shared_memory.SharedMemory`
+		The shared memory block
+	capacity: :class:`int`
+		The size of the data area
+	"""
+	def __init__(self, shm):
+		self.shm = shm
+		self.buf = shm.buf
+		self.capacity = (shm.size - HEADER_SIZE) & ~(ALIGN - 1)
+		self.data = shm.buf[HEADER_SIZE:HEADER_SIZE + self.capacity]
+
+		self.head = position.unpack_from(self.buf, HEAD)[0]
+		self.tail = position.unpack_from(self.buf, TAIL)[0]
+
+	@classmethod
+	def create(cls, size):
+		return cls(SharedMemory(create=True, size=HEADER_SIZE + size))
+
+	@classmethod
+	def attach(cls, name):
+		try:
+			shm = SharedMemory(name, track=False)
+		except TypeError: # before Python 3.13; spawned processes share the tracker of their parent
+			shm = SharedMemory(name)
+		return cls(shm)
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def write(self, kind, payload=b"", fp=0, pos=0, conn=0):
+		"""Writes a record (producer side).
+		:return: Optional[:class:`bool`] None if the ring is full, otherwise whether the
+			consumer has to be woken up
+		"""
+		size = RECORD.size + len(payload)
+		total = (size + ALIGN - 1) & ~(ALIGN - 1)
+		if total > self.capacity:
+			raise ValueError("A {} bytes record doesn't fit in the ring".format(size))
+
+		offset = self.head % self.capacity
+		skip = self.capacity - offset if offset + total > self.capacity else 0
+
+		tail = position.unpack_from(self.buf, TAIL)[0]
+		if self.head + skip + total - tail > self.capacity:
+			return None
+
+		if skip:
+			if skip >= RECORD.size:
+				RECORD.pack_into(self.data, offset, skip - RECORD.size, PAD, 0, 0, 0)
+			offset = 0
+
+		RECORD.pack_into(self.data, offset, len(payload), kind, fp, pos, conn)
+		self.data[offset + RECORD.size:offset + size] = payload
+
+		self.head += skip + total
+		position.pack_into(self.buf, HEAD, self.head)
+
+		if flag.unpack_from(self.buf, WAITING)[0]:
+			flag.pack_into(self.buf, WAITING, 0)
+			return True
+		return False
+
+	def read(self):
+		"""Reads every available record (consumer side).
+		:return: List[:class:`tuple`] (kind, fp, pos, conn, payload) where payload is a
+			:class:`bytearray` copy
+		"""
+		head = position.unpack_from(self.buf, HEAD)[0]
+		records = []
+
+		while self.tail < head:
+			offset = self.tail % self.capacity
+			if self.capacity - offset < RECORD.size: # skipped end
+				self.tail += self.capacity - offset
+				continue
+
+			size, kind, fp, pos, conn = RECORD.unpack_from(self.data, offset)
+			self.tail += (RECORD.size + size + ALIGN - 1) & ~(ALIGN - 1)
+			if kind != PAD:
+				start = offset + RECORD.size
+				records.append((kind, fp, pos, conn, bytearray(self.data[start:start + size])))
+
+		position.pack_into(self.buf, TAIL, self.tail)
+		return records
+
+	def wait(self, pipe, timeout):
+		"""Sleeps until the producer writes something or the timeout expires (consumer side).
+		"""
+		flag.pack_into(self.buf, WAITING, 1)
+		if position.unpack_from(self.buf, HEAD)[0] == self.tail and pipe.poll(timeout):
+			while pipe.poll():
+				pipe.recv_bytes()
+		flag.pack_into(self.buf, WAITING, 0)
+
+	def close(self, unlink=False):
+		self.data.release()
+		self.buf = None
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+
+
+class ConnectionSnapshot:
+	"""What a plugin running in another process knows about a
+	:class:`tfm.network.TFMConnection`.
+
+	Attributes
+	----------
+	name: :class:`str`
+		"main" or "bulle"
+	local: :class:`tuple`
+		The local address ("ip", port)
+	remote: :class:`tuple`
+		The remote address ("ip", port)
+	client: :class:`ClientSnapshot`
+		The client it belongs to
+	"""
+	def __init__(self, name, local, remote, client):
+		self.name = name
+		self.local = local
+		self.remote = remote
+		self.client = client
+
+
+class ClientSnapshot:
+	"""What a plugin running in another process knows about a :class:`tfm.client.TFMClient`:
+	its attributes as they were when the packet was captured, but none of its methods.
+
+	Attributes
+	----------
+	main: Optional[:class:`ConnectionSnapshot`]
+		The connection to the main server
+	bulle: Optional[:class:`ConnectionSnapshot`]
+		The connection to the bulle server
+	logged, id, name, pid, is_souris, msg_keys
+		Same as :class:`tfm.client.TFMClient`
+	"""
+	FIELDS = ("logged", "id", "name", "pid", "is_souris", "msg_keys")
+
+	def __init__(self):
+		self.main = None
+		self.bulle = None
+
+		self.logged = False
+		self.id = None
+		self.name = None
+		self.pid = None
+		self.is_souris = False
+		self.msg_keys = None
+
+	def update(self, state, connections):
+		main, bulle, *values = state
+		self.main = connections.get(main)
+		self.bulle = connections.get(bulle)
+		for field, value in zip(self.FIELDS, values):
+			setattr(self, field, value)
+
+
+async def host(module, name, pipe):
+	"""|coro|
+	Runs a plugin in a worker process: reads its records from the ring until it is stopped.
+	:param module: :class:`str` the plugin module
+	:param name: :class:`str` the shared memory name of the ring
+	:param pipe: :class:`multiprocessing.connection.Connection` where the producer wakes it up
+	"""
+	from tfmplugins.tfm.packet import Packet
+
+	plugin = importlib.import_module(module).plugin
+	ring = SharedRing.attach(name)
+	loop = asyncio.get_running_loop()
+	parent = multiprocessing.parent_process()
+
+	clients = {}
+	connections = {}
+
+	try:
+		while True:
+			records = ring.read()
+			if not records:
+				if parent is not None and not parent.is_alive():
+					return
+				await loop.run_in_executor(None, ring.wait, pipe, 0.05)
+				continue
+
+			for kind, fp, pos, index, payload in records:
+				if kind == STOP:
+					try:
+						await plugin.tear_down()
+					except Exception:
+						traceback.print_exc()
+					return
+
+				elif kind == CLIENT:
+					index, state = pickle.loads(payload)
+					clients.setdefault(index, ClientSnapshot()).update(state, connections)
+
+				elif kind == CONNECTION:
+					index, client, *address = pickle.loads(payload)
+					connections[index] = ConnectionSnapshot(*address, clients.setdefault(client, ClientSnapshot()))
+
+				else:
+					packet = Packet(payload)
+					packet.pos = pos
+					conn = connections[index]
+					try:
+						if kind == SENT:
+							await plugin.packet_sent(conn.client, conn, fp, packet)
+						else:
+							await plugin.packet_received(conn.client, conn, packet)
+					except Exception:
+						traceback.print_exc()
+
+	finally:
+		ring.close()
+
+
+def run(module, name, pipe):
+	"""The entry point of a plugin worker process. Ctrl+C is left to the main process,
+	which stops the worker with the plugin once its packets have been delivered."""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	asyncio.run(host(module, name, pipe))
+
+
+class ProcessPlugin:
+	"""Stands for a plugin that runs in its own process, so it doesn't use the GIL of
+	the capture threads and the loop. Plugins ask for it with ``process = True``.
+
+	The worker process is spawned with the first packet. Packets are written to a
+	:class:`SharedRing` with the connection and client they belong to; the plugin gets
+	a copy of the packet, a :class:`ConnectionSnapshot` and a :class:`ClientSnapshot`.
+
+	Parameters
+	----------
+	module: :class:`str`
+		The plugin module, imported again by the worker process
+	plugin:
+		The plugin object of this process, to read its attributes
+
+	Attributes
+	----------
+	RING_SIZE: :class:`int`
+		The default ring size, in bytes. Plugins can change it with ``ring_size``.
+	name: :class:`str`
+		The plugin name
+	process: Optional[:class:`multiprocessing.Process`]
+		The worker process, once started
+	ring: Optional[:class:`SharedRing`]
+		The ring, once started
+	"""
+	RING_SIZE = 4 << 20
+
+	def __init__(self, module, plugin):
+		self.module = module
+		self.name = getattr(plugin, "name", type(plugin).__module__)
+		for attribute in ("inbound_codes", "outbound_codes", "queue_size", "queue_policy"):
+			if hasattr(plugin, attribute):
+				setattr(self, attribute, getattr(plugin, attribute))
+		self.ring_size = getattr(plugin, "ring_size", self.RING_SIZE)
+
+		self.process = None
+		self.ring = None
+		self.pipe = None
+
+		self.indexes = itertools.count(1)
+		self.connections = weakref.WeakKeyDictionary()
+		self.clients = weakref.WeakKeyDictionary()
+		self.states = {}
+
+	def __repr__(self):
+		return "<ProcessPlugin {} pid={}>".format(self.name, self.process and self.process.pid)
+
+	def start(self):
+		"""Creates the ring and spawns the worker process."""
+		context = multiprocessing.get_context("spawn")
+		self.ring = SharedRing.create(self.ring_size)
+		reader, self.pipe = context.Pipe(duplex=False)
+
+		self.process = context.Process(
+			target=run, args=(self.module, self.ring.name, reader),
+			name="plugin {}".format(self.name), daemon=True
+		)
+		self.process.start()
+		reader.close()
+
+	async def send(self, kind, payload=b"", fp=0, pos=0, conn=0):
+		"""|coro|
+		Writes a record to the ring, waiting while it is full.
+		"""
+		if self.process is None:
+			self.start()
+
+		while True:
+			wake = self.ring.write(kind, payload, fp, pos, conn)
+			if wake is not None:
+				break
+
+			if not self.process.is_alive():
+				raise RuntimeError("The worker process of {} has stopped.".format(self.name))
+			await asyncio.sleep(0.001)
+
+		if wake:
+			self.pipe.send_bytes(b"\x00")
+
+	async def link(self, client, conn):
+		"""|coro|
+		Sends the connection and the client snapshot if they are new or have changed.
+		:return: :class:`int` the connection index
+		"""
+		client_index = self.clients.get(client)
+		if client_index is None:
+			client_index = self.clients[client] = next(self.indexes)
+
+		indexes = []
+		for other in (client.main, client.bulle, conn):
+			index = None if other is None else self.connections.get(other)
+			if other is not None and index is None:
+				index = self.connections[other] = next(self.indexes)
+				await self.send(CONNECTION, pickle.dumps((index, client_index, other.name, other.local, other.remote)))
+			indexes.append(index)
+
+		state = (
+			indexes[0], indexes[1], client.logged, client.id, client.name, client.pid, client.is_souris,
+			None if client.msg_keys is None else list(client.msg_keys)
+		)
+		if self.states.get(client_index) != state:
+			self.states[client_index] = state
+			await self.send(CLIENT, pickle.dumps((client_index, state)))
+
+		return indexes[2]
+
+	async def packet_sent(self, client, conn, fp, packet):
+		index = await self.link(client, conn)
+		await self.send(SENT, packet.buffer, fp, packet.pos, index)
+
+	async def packet_received(self, client, conn, packet):
+		index = await self.link(client, conn)
+		await self.send(RECEIVED, packet.buffer, 0, packet.pos, index)
+
+	async def tear_down(self):
+		"""|coro|
+		Tears the plugin down in its process and waits for the process to end.
+		"""
+		if self.process is None:
+			return
+
+		try:
+			if self.process.is_alive():
+				await self.send(STOP)
+				await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+			if self.process.is_alive():
+				self.process.terminate()
+		finally:
+			self.pipe.close()
+			self.ring.close(unlink=True)
+			self.process = None
@@ -0,0 +1,116 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+def subscribe(inbound=None, outbound=None):
+	"""A class decorator that declares which packets a plugin wants.
+	It just sets the ``inbound_codes`` and ``outbound_codes`` attributes, which
+	can also be written by hand.
+	:param inbound: Optional[Iterable[:class:`tuple`]] the (C, CC) codes passed to
+		packet_received. If ``None`` is passed (default), every packet is passed.
+	:param outbound: Optional[Iterable[:class:`tuple`]] the (C, CC) codes passed to
+		packet_sent. If ``None`` is passed (default), every packet is passed.
+	"""
+	def decorator(cls):
+		if inbound is not None:
+			cls.inbound_codes = frozenset(tuple(ccc) for ccc in inbound)
+		if outbound is not None:
+			cls.outbound_codes = frozenset(tuple(ccc) for ccc in outbound)
+		return cls
+	return decorator
+
+
+class PluginRouter:
+	"""Indexes plugins by the packets they subscribe to, so routing a packet
+	is a single dictionary lookup.
+	A plugin without ``inbound_codes`` (or ``outbound_codes``) receives every
+	inbound (or outbound) packet.
+
+	Attributes
+	----------
+	plugins: List
+		The indexed plugins, in order
+	index: Dict[:class:`tuple`, :class:`tuple`]
+		The plugins that want a packet, indexed by (outbound, CCC)
+	everything: Dict[:class:`bool`, :class:`tuple`]
+		The plugins that want every packet, indexed by direction
+	observers: :class:`tuple`
+		The plugins that want the game state changes (the ones with a
+		``state_changed`` coroutine)
+	"""
+	def __init__(self, plugins=()):
+		self.build(plugins)
+
+	@staticmethod
+	def codes(plugin, outbound):
+		"""Gets the codes a plugin subscribes to in a direction.
+		:param plugin: the plugin
+		:param outbound: :class:`bool` the packet direction
+		:return: Optional[:class:`frozenset`] None if it wants every packet
+		"""
+		codes = getattr(plugin, "outbound_codes" if outbound else "inbound_codes", None)
+		if codes is None:
+			return None
+		return frozenset(tuple(ccc) for ccc in codes)
+
+	def build(self, plugins):
+		"""Rebuilds the index.
+		:param plugins: Iterable the plugins to index, in dispatch order
+		"""
+		self.plugins = list(plugins)
+		self.observers = tuple(
+			plugin for plugin in self.plugins
+			if getattr(plugin, "state_changed", None) is not None
+		)
+
+		codes = {
+			outbound: [(plugin, self.codes(plugin, outbound)) for plugin in self.plugins]
+			for outbound in (True, False)
+		}
+
+		self.everything = {
+			outbound: tuple(plugin for plugin, wanted in codes[outbound] if wanted is None)
+			for outbound in (True, False)
+		}
+
+		self.index = {}
+		for outbound, subscriptions in codes.items():
+			keys = set()
+			for plugin, wanted in subscriptions:
+				if wanted is not None:
+					keys.update(wanted)
+
+			for ccc in keys:
+				self.index[(outbound, ccc)] = tuple(
+					plugin for plugin, wanted in subscriptions
+					if wanted is None or ccc in wanted
+				)
+
+	def route(self, ccc, outbound):
+		"""Gets the plugins that want a packet.
+		:param ccc: Optional[:class:`tuple`] the packet code (C, CC)
+		:param outbound: :class:`bool` the packet direction
+		:return: :class:`tuple` the plugins, in order
+		"""
+		return self.index.get((outbound, ccc), self.everything[outbound])
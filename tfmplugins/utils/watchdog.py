@@ -1,74 +1,341 @@
 # Based on code provided by Athesdrake
 
 import os
+import sys
 import time
+import errno
+import select
+import asyncio
+import threading
 import importlib
+import traceback
 
+from tfmplugins.utils.process import ProcessPlugin
+from tfmplugins.utils.router import PluginRouter
+from tfmplugins.utils.worker import PluginWorker
 
-class Watcher:
-	INTERVAL = 1.0
 
-	def __init__(self, name, filename):
-		self.name = name
-		self.filename = f"./plugins/{filename}"
-		self.module = importlib.import_module(f"plugins.{name}")
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+
+
+def signature(path):
+	"""Returns something that changes whenever a plugin is modified, added or deleted:
+	the modification time of a file, or the latest modification time and file count
+	of a directory."""
+	if os.path.isfile(path):
+		return os.stat(path).st_mtime
+
+	latest, count = 0, 0
+	for root, dirs, files in os.walk(path):
+		dirs[:] = [name for name in dirs if name != "__pycache__"]
+		for name in files:
+			latest = max(latest, os.stat(os.path.join(root, name)).st_mtime)
+			count += 1
+	return latest, count
+
 
-		self.next_check = time.perf_counter() + self.INTERVAL
-		self.timestamp = os.stat(self.filename).st_mtime
+class PollingMonitor:
+	"""Wakes the watcher thread up every interval."""
+	def wait(self, timeout):
+		time.sleep(timeout)
+		return True
 
-	def check(self):
-		if time.perf_counter() >= self.next_check:
-			last = self.timestamp
+	def close(self):
+		pass
 
-			self.timestamp = os.stat(self.filename).st_mtime
-			self.next_check = time.perf_counter() + self.INTERVAL
 
-			return self.timestamp != last
+class InotifyMonitor:
+	"""Wakes the watcher thread up when something changes in the plugins directory.
+	Only available on Linux."""
+	MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	DEBOUNCE = 0.1
 
-	async def get_plugin(self):
-		if self.check():
+	def __init__(self, path):
+		import ctypes
+
+		self.libc = ctypes.CDLL(None, use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			code = ctypes.get_errno()
+			raise OSError(code, os.strerror(code))
+
+		self.dirs = {}
+		for root, dirs, _ in os.walk(path):
+			dirs[:] = [name for name in dirs if name != "__pycache__"]
+			self.add(root)
+
+	def add(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+		if wd >= 0:
+			self.dirs[wd] = path
+
+	def wait(self, timeout):
+		"""Returns whether there has been any change before the timeout."""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return False
+
+		# Editors usually write a file in a few steps.
+		time.sleep(self.DEBOUNCE)
+		while True:
 			try:
-				start = time.perf_counter()
-				await self.module.plugin.tear_down()
-				self.module = importlib.reload(self.module)
-				taken = time.perf_counter() - start
-				print(f"Reloaded module {self.name} in {taken} seconds.")
-			except Exception as e:
-				print(f"An error occured while reloading {self.filename}: {e}")
+				data = os.read(self.fd, 65536)
+			except OSError as e:
+				if e.errno == errno.EAGAIN:
+					return True
+				raise
 
-		return self.module.plugin
+			offset = 0
+			while offset < len(data):
+				wd, mask, _, length = (int.from_bytes(data[offset + i:offset + i + 4], sys.byteorder) for i in (0, 4, 8, 12))
+				name = data[offset + 16:offset + 16 + length].rstrip(b"\x00")
+				offset += 16 + length
 
+				if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name != b"__pycache__":
+					if wd in self.dirs:
+						self.add(os.path.join(self.dirs[wd], os.fsdecode(name)))
 
-class PluginsWatcherIterator:
-	def __init__(self, watchers):
-		self.watchers = watchers
-		self.index = 0
-		self.limit = len(self.watchers)
+	def close(self):
+		os.close(self.fd)
 
-	async def __anext__(self):
-		if self.index < self.limit:
-			watcher = self.watchers[self.index]
-			self.index += 1
-			return await watcher.get_plugin()
 
+class Watcher:
+	def __init__(self, name, filename, path="./plugins"):
+		self.name = name
+		self.filename = f"{path}/{filename}"
+		self.module = importlib.import_module(f"plugins.{name}")
+		self.wrap()
+
+	def wrap(self):
+		"""Plugins with ``process = True`` run in their own process: the router gets
+		a proxy that sends them the packets."""
+		plugin = self.module.plugin
+		if getattr(plugin, "process", False):
+			self.proxy = ProcessPlugin(f"plugins.{self.name}", plugin)
 		else:
-			raise StopAsyncIteration
+			self.proxy = None
+
+	@property
+	def plugin(self):
+		if self.proxy is not None:
+			return self.proxy
+		return self.module.plugin
+
+	async def tear_down(self):
+		try:
+			await self.plugin.tear_down()
+		except Exception as e:
+			print(f"An error occured while tearing down {self.filename}: {e}")
+
+	def reload(self):
+		start = time.perf_counter()
+		self.module = importlib.reload(self.module)
+		self.wrap()
+		taken = time.perf_counter() - start
+		print(f"Reloaded module {self.name} in {taken} seconds.")
 
 
 class PluginsWatcher:
-	def __init__(self):
-		self.watchers = []
+	"""Loads the plugins and keeps them up to date.
 
-		with os.scandir("./plugins") as it:
+	A background thread waits for changes in the plugins directory (with inotify
+	when available, polling every INTERVAL otherwise). Modified plugins are taken
+	out of the router, get the packets already queued for them and are then torn
+	down and reloaded, new ones are loaded and deleted ones are torn down, without
+	touching the packet path: the router used to dispatch packets is replaced at
+	once when everything is ready.
+	"""
+	INTERVAL = 1.0
+
+	def __init__(self, path="./plugins"):
+		self.path = path
+		self.watchers = {}
+		self.state = self.scan()
+
+		for name, filename in self.files().items():
+			self.watchers[name] = Watcher(name, filename, path)
+
+		self.router = PluginRouter()
+		self.loop = None
+		self.thread = None
+		self.stopping = threading.Event()
+
+	def files(self):
+		"""Returns the filename of every plugin in the directory, by module name."""
+		files = {}
+		with os.scandir(self.path) as it:
 			for entry in it:
 				if entry.name == "__pycache__":
 					continue
 
 				if entry.is_file():
 					if entry.name.endswith(".py"):
-						self.watchers.append(Watcher(entry.name[:-3], entry.name))
+						files[entry.name[:-3]] = entry.name
 				else:
-					self.watchers.append(Watcher(entry.name, entry.name))
+					files[entry.name] = entry.name
+		return files
+
+	def scan(self):
+		"""Returns the signature of every plugin in the directory, by module name."""
+		state = {}
+		for name, filename in self.files().items():
+			try:
+				state[name] = signature(f"{self.path}/{filename}")
+			except OSError: # deleted while scanning
+				pass
+		return state
+
+	async def __aiter__(self):
+		for watcher in list(self.watchers.values()):
+			yield watcher.plugin
+
+	def start(self):
+		"""Builds the router and starts the watcher thread. Must be called from the loop."""
+		self.loop = asyncio.get_running_loop()
+		self.update_router()
+
+		self.thread = threading.Thread(target=self._watch, name="PluginsWatcher", daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""Stops the watcher thread."""
+		self.stopping.set()
+
+	async def close(self):
+		"""|coro|
+		Stops the watcher thread, delivers the packets already queued for the plugins
+		and tears them all down (process plugins are stopped and their shared rings
+		unlinked).
+		"""
+		self.stop()
+		if self.thread is not None:
+			# It may be waiting for a change to be applied on the loop.
+			await self.loop.run_in_executor(None, self.thread.join, self.INTERVAL * 2)
+
+		workers, self.router = self.router.plugins, PluginRouter()
+		for worker in workers:
+			await worker.close()
+
+		for watcher in list(self.watchers.values()):
+			await watcher.tear_down()
+
+	def _watch(self):
+		"""The watcher thread. Waits for changes and applies them on the loop, one at a time."""
+		try:
+			monitor = InotifyMonitor(self.path)
+		except Exception: # not on Linux
+			monitor = PollingMonitor()
+
+		try:
+			while not self.stopping.is_set():
+				if not monitor.wait(self.INTERVAL):
+					continue
+
+				state = self.scan()
+				if state != self.state:
+					future = asyncio.run_coroutine_threadsafe(self.apply(state), self.loop)
+					try:
+						future.result()
+					except Exception:
+						traceback.print_exc()
+		finally:
+			monitor.close()
+
+	async def apply(self, state):
+		"""|coro|
+		Tears down, reloads, loads and unloads the plugins that changed.
+		:param state: the result of :meth:`scan`
+		"""
+		files = self.files()
+
+		for name in sorted(set(self.state) | set(state)):
+			if self.state.get(name) == state.get(name):
+				continue
+
+			watcher = self.watchers.get(name)
+			if watcher is not None:
+				await self.detach(watcher)
+				await watcher.tear_down()
+
+			if name not in state:
+				del self.watchers[name]
+				sys.modules.pop(f"plugins.{name}", None)
+				print(f"Unloaded module {name}.")
+				continue
+
+			try:
+				if watcher is None:
+					importlib.invalidate_caches()
+					watcher = await self.loop.run_in_executor(None, Watcher, name, files[name], self.path)
+					self.watchers[name] = watcher
+					print(f"Loaded module {name}.")
+				else:
+					await self.loop.run_in_executor(None, watcher.reload)
+			except Exception as e:
+				print(f"An error occured while loading {self.path}/{files.get(name, name)}: {e}")
+
+		self.state = state
+		self.update_router()
+
+	async def detach(self, watcher):
+		"""|coro|
+		Stops routing packets to a plugin and waits until its worker has delivered the
+		queued ones, so nothing reaches the plugin once it is torn down.
+		:param watcher: :class:`Watcher` the plugin watcher
+		"""
+		workers = []
+		for worker in self.router.plugins:
+			if worker.plugin is watcher.plugin:
+				detached = worker
+			else:
+				workers.append(worker)
+
+		if len(workers) == len(self.router.plugins):
+			return
+
+		self.router = PluginRouter(workers)
+		await detached.close()
+
+	def update_router(self):
+		"""Gives a worker to every plugin that doesn't have one yet, replaces the router
+		and closes the workers of the plugins that are gone once they are done."""
+		old = {id(worker.plugin): worker for worker in self.router.plugins}
+		workers = []
+
+		for watcher in self.watchers.values():
+			worker = old.pop(id(watcher.plugin), None)
+			if worker is None:
+				worker = PluginWorker(watcher.name, watcher.plugin, self.loop)
+			workers.append(worker)
+
+		self.router = PluginRouter(workers)
+
+		for worker in old.values():
+			self.loop.create_task(worker.close())
+
+	def stats(self):
+		"""Returns the queue depth and dropped packets of every plugin worker."""
+		return {
+			worker.name: {"depth": worker.depth, "dropped": worker.dropped, "delivered": worker.delivered}
+			for worker in self.router.plugins
+		}
+
+	def route(self, ccc, outbound):
+		"""Returns the workers of the plugins subscribed to a packet."""
+		if self.thread is None:
+			self.start()
+
+		return self.router.route(ccc, outbound)
+
+	def observers(self):
+		"""Returns the workers of the plugins that want the game state changes."""
+		if self.thread is None:
+			self.start()
 
-	def __aiter__(self):
-		return PluginsWatcherIterator(self.watchers)
\ No newline at end of file
+		return self.router.observers
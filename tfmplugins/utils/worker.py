@@ -0,0 +1,160 @@
+"""
+MIT License
+
+Copyright (c) 2020 Iván Gabriel (Tocutoeltuco)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+import sys
+import traceback
+
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+
+class PluginWorker:
+	"""Delivers packets to a single plugin, in order, from a bounded queue.
+	The queue size and overflow policy can be overriden by the plugin with the
+	``queue_size`` and ``queue_policy`` attributes. Plugins with ``synchronous = True``
+	skip the queue: their methods are plain functions, called right away with :meth:`run`.
+
+	Parameters
+	----------
+	name: :class:`str`
+		The plugin name
+	plugin:
+		The plugin object
+	loop: event loop
+		The event loop the worker runs on
+
+	Attributes
+	----------
+	name: :class:`str`
+		The plugin name
+	plugin:
+		The plugin object
+	policy: :class:`str`
+		What to do when the queue is full: ``"block"`` waits for a free slot,
+		``"drop-oldest"`` discards the oldest queued packet and ``"drop-newest"``
+		discards the packet being queued.
+	synchronous: :class:`bool`
+		Whether the plugin methods are plain functions, called without the queue
+	queue: :class:`asyncio.Queue`
+		The queued (callback, args) pairs
+	delivered: :class:`int`
+		The number of packets delivered to the plugin
+	dropped: :class:`int`
+		The number of packets discarded because the queue was full
+	"""
+	QUEUE_SIZE = 1024
+	QUEUE_POLICY = BLOCK
+
+	def __init__(self, name, plugin, loop):
+		self.name = name
+		self.plugin = plugin
+		self.policy = getattr(plugin, "queue_policy", self.QUEUE_POLICY)
+		if self.policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+			raise ValueError("Unknown queue policy {!r} for the plugin {}.".format(self.policy, name))
+
+		self.synchronous = bool(getattr(plugin, "synchronous", False))
+		self.queue = asyncio.Queue(getattr(plugin, "queue_size", self.QUEUE_SIZE))
+		self.delivered = 0
+		self.dropped = 0
+
+		self.task = loop.create_task(self._work())
+
+	def __repr__(self):
+		return "<PluginWorker {} depth={} dropped={}>".format(self.name, self.depth, self.dropped)
+
+	@property
+	def inbound_codes(self):
+		"""The inbound codes the plugin subscribes to, so the worker can be routed in its place"""
+		return getattr(self.plugin, "inbound_codes", None)
+
+	@property
+	def outbound_codes(self):
+		"""The outbound codes the plugin subscribes to, so the worker can be routed in its place"""
+		return getattr(self.plugin, "outbound_codes", None)
+
+	@property
+	def state_changed(self):
+		"""The state_changed coroutine of the plugin, if any, so the worker can be routed in its place"""
+		return getattr(self.plugin, "state_changed", None)
+
+	@property
+	def depth(self):
+		""":class:`int` The number of queued packets"""
+		return self.queue.qsize()
+
+	async def put(self, callback, *args):
+		"""|coro|
+		Queues a packet for the plugin. Only waits if the queue is full and the
+		policy is ``"block"``.
+		:param callback: the coroutine function that delivers it, called with the plugin
+			and the arguments
+		:param *args: the arguments to pass to the callback
+		"""
+		if self.queue.full():
+			if self.policy == DROP_NEWEST:
+				self.dropped += 1
+				return
+
+			if self.policy == DROP_OLDEST:
+				self.queue.get_nowait()
+				self.queue.task_done()
+				self.dropped += 1
+
+		await self.queue.put((callback, args))
+
+	def run(self, callback, *args):
+		"""Delivers a packet to a synchronous plugin right away.
+		:param callback: the function that delivers it, called with the plugin and the
+			arguments
+		:param *args: the arguments to pass to the callback
+		"""
+		try:
+			callback(self.plugin, *args)
+			self.delivered += 1
+		except Exception:
+			traceback.print_exc(file=sys.stderr)
+
+	async def _work(self):
+		"""|coro|
+		Delivers the queued packets one by one.
+		"""
+		while True:
+			callback, args = await self.queue.get()
+			try:
+				await callback(self.plugin, *args)
+				self.delivered += 1
+			except Exception:
+				traceback.print_exc(file=sys.stderr)
+			finally:
+				self.queue.task_done()
+
+	async def close(self):
+		"""|coro|
+		Waits until every queued packet has been delivered and stops the worker.
+		"""
+		await self.queue.join()
+		self.task.cancel()